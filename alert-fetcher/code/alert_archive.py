@@ -0,0 +1,299 @@
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+from avro_decoder import AvroDecoder
+from cutouts import CUTOUTS
+
+
+# segment file: 16-byte header (magic, complete flag, reserved),
+# then a frame per avro packet: <uint32 packet size><uint16 name size><packet name><packet>
+MAGIC = b'ZTFALRT1'
+HEADER_SIZE = 16
+FRAME = struct.Struct('<IH')
+
+# one row per alert, sorted by candid. offsets are into the segment file, cutout offsets of their stampData,
+# -1 if it's not stored as is (e.g. deflate-compressed packets)
+INDEX_DTYPE = np.dtype([('candid', '<i8'), ('objectId', 'S16'), ('member', 'S64'),
+                        ('offset', '<i8'), ('size', '<u4'), ('record', '<u4'),
+                        ('cutout_offset', '<i8', (len(CUTOUTS),)), ('cutout_size', '<u4', (len(CUTOUTS),))])
+
+
+def get_paths(_path):
+    """
+
+    :param _path: archive path without extension, e.g. <path_alerts>/20180713
+    :return: segment file, index file
+    """
+    return f'{_path}.alerts', f'{_path}.index.npy'
+
+
+def index_rows(_data, _records):
+    """
+        Index entries of the alerts in an avro packet, with offsets relative to the packet
+
+    :param _data: raw avro packet
+    :param _records: its alerts as decoded, before any projection
+    :return: list of (candid, objectId, record number, cutout offsets, cutout sizes)
+    """
+    rows = []
+    for i, record in enumerate(_records):
+        offsets, sizes = [], []
+        for cutout in CUTOUTS:
+            stamp = (record.get(f'cutout{cutout}') or dict()).get('stampData')
+            # bytes are stored verbatim in uncompressed avro
+            offset = _data.find(stamp) if stamp else -1
+            offsets.append(offset)
+            sizes.append(len(stamp) if offset >= 0 else 0)
+        rows.append((record['candid'], record['objectId'], i, offsets, sizes))
+    return rows
+
+
+class ArchiveWriter(object):
+    """
+        Pack the avro packets of a night into one append-only segment file and a sorted index,
+        see AlertArchive for reading them back.
+
+        The index is written on close. If a run is interrupted, it is rebuilt from the segment when reopened,
+        and packets already in the segment are not appended again
+    """
+    def __init__(self, _path):
+        """
+
+        :param _path: archive path without extension, e.g. <path_alerts>/20180713
+        """
+        self.path = _path
+        self.path_segment, self.path_index = get_paths(_path)
+        self.lock = threading.Lock()
+        self.rows = []
+        self.members = set()
+        self.decoder = AvroDecoder()
+
+        if os.path.exists(self.path_segment):
+            self.recover()
+            self.segment = open(self.path_segment, 'r+b')
+            self.segment.seek(0, os.SEEK_END)
+        else:
+            self.segment = open(self.path_segment, 'w+b')
+            self.segment.write(MAGIC + b'\x00' * (HEADER_SIZE - len(MAGIC)))
+        self.size = self.segment.tell()
+
+    def recover(self):
+        """
+            Pick up an existing segment: index rows from its index file if it's up to date, from the packets if not.
+            Members come from the frames, packets without alerts have no index rows.
+            A frame cut short by a crash is truncated
+        :return:
+        """
+        index = np.load(self.path_index) if os.path.exists(self.path_index) else np.empty(0, dtype=INDEX_DTYPE)
+        self.rows = [tuple(_r) for _r in index.tolist()]
+        indexed = set(index['offset'].tolist())
+
+        with open(self.path_segment, 'r+b') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'Not an alert archive: {self.path_segment}')
+            file_size = os.fstat(f.fileno()).st_size
+            end = HEADER_SIZE
+            f.seek(end)
+            while True:
+                frame = f.read(FRAME.size)
+                if len(frame) < FRAME.size:
+                    break
+                size, name_size = FRAME.unpack(frame)
+                member = f.read(name_size)
+                offset = end + FRAME.size + name_size
+                if (len(member) < name_size) or (offset + size > file_size):
+                    break
+                if offset in indexed:
+                    f.seek(size, os.SEEK_CUR)
+                else:
+                    # appended after the index was last written
+                    self.add_rows(f.read(size), member.decode(), offset)
+                self.members.add(member)
+                end = offset + size
+            f.truncate(end)
+
+    def add_rows(self, _data, _member, _offset, _rows=None):
+        if _rows is None:
+            _rows = index_rows(_data, self.decoder.decode(_data))
+        member = _member.encode()
+        for candid, object_id, record, cutout_offsets, cutout_sizes in _rows:
+            self.rows.append((candid, object_id.encode(), member, _offset, len(_data), record,
+                              [_offset + _o if _o >= 0 else -1 for _o in cutout_offsets], cutout_sizes))
+
+    def has(self, _member):
+        return _member.encode() in self.members
+
+    def append(self, _data, _member, _rows=None):
+        """
+
+        :param _data: raw avro packet
+        :param _member: its name
+        :param _rows: see index_rows, computed from _data if None
+        :return: False if _member is in the archive already
+        """
+        with self.lock:
+            member = _member.encode()
+            if member in self.members:
+                return False
+            self.segment.write(FRAME.pack(len(_data), len(member)))
+            self.segment.write(member)
+            self.segment.write(_data)
+            self.add_rows(_data, _member, self.size + FRAME.size + len(member), _rows)
+            self.members.add(member)
+            self.size += FRAME.size + len(member) + len(_data)
+            return True
+
+    def close(self, _complete=False):
+        """
+            Write out the index
+
+        :param _complete: all packets of the night are in?
+        :return:
+        """
+        with self.lock:
+            if _complete:
+                self.segment.seek(len(MAGIC))
+                self.segment.write(b'\x01')
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            self.segment.close()
+
+            index = np.array(self.rows, dtype=INDEX_DTYPE)
+            # keep the last copy of an alert if it came in twice: the one furthest into the segment,
+            # rows recovered from the segment may come after those of packets appended later
+            index = index[np.argsort(-index['offset'], kind='stable')]
+            _, unique = np.unique(index['candid'], return_index=True)
+            index = index[unique]
+            # written next to the old one and moved into place: a crash leaves one or the other
+            with open(f'{self.path_index}.tmp', 'wb') as f:
+                np.save(f, index)
+            os.replace(f'{self.path_index}.tmp', self.path_index)
+
+
+class AlertArchive(object):
+    """
+        Read-only access to a night packed by ArchiveWriter: the segment is memory-mapped,
+        packets and cutouts are returned as memoryview slices of it, nothing is copied until decoded.
+        Alerts are looked up by candid or objectId with a binary search of the index
+    """
+    def __init__(self, _path):
+        """
+
+        :param _path: archive path without extension, e.g. <path_alerts>/20180713
+        """
+        self.path_segment, self.path_index = get_paths(_path)
+        self.index = np.load(self.path_index, mmap_mode='r')
+        with open(self.path_segment, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'Not an alert archive: {self.path_segment}')
+            self.complete = f.read(1) == b'\x01'
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.mmap)
+        self.decoder = AvroDecoder()
+        # index positions sorted by objectId, on first use
+        self.by_object = None
+
+    @staticmethod
+    def exists(_path):
+        return all(os.path.exists(_p) for _p in get_paths(_path))
+
+    @staticmethod
+    def is_complete(_path):
+        """
+
+        :param _path: archive path without extension
+        :return: is there an archive with all packets of the night at _path?
+        """
+        if not AlertArchive.exists(_path):
+            return False
+        with open(get_paths(_path)[0], 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        return header[:len(MAGIC)] == MAGIC and header[len(MAGIC):len(MAGIC) + 1] == b'\x01'
+
+    def __len__(self):
+        return len(self.index)
+
+    def locate(self, _candid):
+        """
+
+        :param _candid:
+        :return: index row
+        """
+        i = int(np.searchsorted(self.index['candid'], _candid))
+        if (i == len(self.index)) or (self.index['candid'][i] != _candid):
+            raise KeyError(_candid)
+        return self.index[i]
+
+    def packet(self, _candid):
+        """
+
+        :param _candid:
+        :return: memoryview of the avro packet with the alert
+        """
+        row = self.locate(_candid)
+        return self.buffer[row['offset']:row['offset'] + row['size']]
+
+    def get(self, _candid):
+        """
+
+        :param _candid:
+        :return: decoded alert
+        """
+        row = self.locate(_candid)
+        records = self.decoder.decode(bytes(self.buffer[row['offset']:row['offset'] + row['size']]))
+        return records[row['record']]
+
+    def cutout(self, _candid, _cutout='Science'):
+        """
+
+        :param _candid:
+        :param _cutout: Science, Template, or Difference
+        :return: memoryview of gzipped FITS stampData, None if the alert does not have it
+        """
+        row = self.locate(_candid)
+        i = CUTOUTS.index(_cutout)
+        offset = int(row['cutout_offset'][i])
+        if offset >= 0:
+            return self.buffer[offset:offset + row['cutout_size'][i]]
+        # not stored verbatim
+        stamp = (self.get(_candid).get(f'cutout{_cutout}') or dict()).get('stampData')
+        return memoryview(stamp) if stamp is not None else None
+
+    def find(self, _object_id):
+        """
+
+        :param _object_id:
+        :return: candids of the object's alerts
+        """
+        if self.by_object is None:
+            self.by_object = np.argsort(self.index['objectId'], kind='stable')
+        object_ids = self.index['objectId'][self.by_object]
+        key = _object_id.encode()
+        lo, hi = np.searchsorted(object_ids, key, side='left'), np.searchsorted(object_ids, key, side='right')
+        return self.index['candid'][self.by_object[lo:hi]].tolist()
+
+    def packets(self):
+        """
+            Avro packets in the order they were archived, e.g. to replay a night
+
+        :return: iterator over (member, memoryview of the packet)
+        """
+        order = np.argsort(self.index['offset'], kind='stable')
+        offsets = self.index['offset'][order]
+        # multi-alert packets have a row per alert
+        first = np.concatenate([[True], offsets[1:] != offsets[:-1]]) if len(offsets) > 0 else []
+        for i in np.flatnonzero(first):
+            row = self.index[order[i]]
+            yield row['member'].decode(), self.buffer[row['offset']:row['offset'] + row['size']]
+
+    def close(self):
+        """
+            Unmap the segment: memoryviews of packets and cutouts must have been released
+        :return:
+        """
+        self.buffer.release()
+        self.mmap.close()
@@ -0,0 +1,193 @@
+import importlib
+
+import numpy as np
+
+
+# comparisons of numbers, missing values (NaN) never match
+COMPARISONS = {'$gt': np.greater, '$gte': np.greater_equal, '$lt': np.less, '$lte': np.less_equal}
+
+
+def get_value(_doc, _path):
+    """
+
+    :param _doc: (nested) dict
+    :param _path: tuple of keys
+    :return: value at _path, None if it's not there
+    """
+    for key in _path:
+        if not isinstance(_doc, dict):
+            return None
+        _doc = _doc.get(key)
+    return _doc
+
+
+class Columns(object):
+    """
+        Values of the fields predicates look at, one numpy array per field over a batch of alerts,
+        extracted once per batch however many predicates use them
+    """
+    def __init__(self, _documents):
+        self.documents = _documents
+        self.n = len(_documents)
+        self.objects = dict()
+        self.numbers = dict()
+
+    def get(self, _path):
+        """
+
+        :param _path: tuple
+        :return: object array, None where missing
+        """
+        if _path not in self.objects:
+            column = np.empty(self.n, dtype=object)
+            for i, doc in enumerate(self.documents):
+                column[i] = get_value(doc, _path)
+            self.objects[_path] = column
+        return self.objects[_path]
+
+    def numeric(self, _path):
+        """
+
+        :param _path: tuple
+        :return: float array, NaN where missing
+        """
+        if _path not in self.numbers:
+            column = self.get(_path)
+            self.numbers[_path] = np.array([np.nan if _v is None else _v for _v in column], dtype=float)
+        return self.numbers[_path]
+
+
+def compile_condition(_path, _condition):
+    """
+        Compile the condition on one field: {'$gt': 0.5}, {'$in': [...]}, or a value to be equal to
+
+    :param _path: tuple
+    :param _condition:
+    :return: callable(Columns) -> bool array
+    """
+    if not (isinstance(_condition, dict) and all(_k.startswith('$') for _k in _condition)):
+        return compile_condition(_path, {'$eq': _condition})
+
+    checks = []
+    for operator, value in _condition.items():
+        if operator in COMPARISONS:
+            def check(_columns, _op=COMPARISONS[operator], _value=float(value)):
+                return _op(_columns.numeric(_path), _value)
+        elif operator == '$eq':
+            def check(_columns, _value=value):
+                return np.array(_columns.get(_path) == _value, dtype=bool)
+        elif operator == '$ne':
+            def check(_columns, _value=value):
+                return ~np.array(_columns.get(_path) == _value, dtype=bool)
+        elif operator in ('$in', '$nin'):
+            if not isinstance(value, (list, tuple)):
+                raise ValueError(f'{operator} needs a list: {".".join(_path)}')
+
+            def check(_columns, _values=tuple(value), _negate=(operator == '$nin')):
+                column = _columns.get(_path)
+                mask = np.zeros(len(column), dtype=bool)
+                for _value in _values:
+                    mask |= np.array(column == _value, dtype=bool)
+                return ~mask if _negate else mask
+        elif operator == '$exists':
+            def check(_columns, _value=bool(value)):
+                return np.array(_columns.get(_path) != None, dtype=bool) == _value  # noqa: E711
+        elif operator == '$not':
+            def check(_columns, _check=compile_condition(_path, value)):
+                return ~_check(_columns)
+        else:
+            raise ValueError(f'Unsupported operator {operator} on {".".join(_path)}')
+        checks.append(check)
+
+    return all_of(checks)
+
+
+def all_of(_checks):
+    if len(_checks) == 1:
+        return _checks[0]
+
+    def check(_columns):
+        mask = np.ones(_columns.n, dtype=bool)
+        for _check in _checks:
+            mask &= _check(_columns)
+        return mask
+    return check
+
+
+def compile_query(_query):
+    """
+        Compile a MongoDB-style query into a vectorized predicate over batches of alerts.
+        Supported: implicit equality, $gt, $gte, $lt, $lte, $eq, $ne, $in, $nin, $exists, $not on fields;
+        $and, $or, $nor of queries. Fields are dotted paths: {"candidate.rb": {"$gt": 0.5}}
+
+    :param _query: dict
+    :return: callable(Columns) -> bool array
+    """
+    checks = []
+    for key, value in _query.items():
+        if key in ('$and', '$or', '$nor'):
+            sub_checks = [compile_query(_q) for _q in value]
+
+            def check(_columns, _sub_checks=sub_checks, _op=key):
+                masks = [_c(_columns) for _c in _sub_checks]
+                if _op == '$and':
+                    return np.logical_and.reduce(masks) if masks else np.ones(_columns.n, dtype=bool)
+                mask = np.logical_or.reduce(masks) if masks else np.zeros(_columns.n, dtype=bool)
+                return mask if _op == '$or' else ~mask
+        elif key.startswith('$'):
+            raise ValueError(f'Unsupported top-level operator {key}')
+        else:
+            check = compile_condition(tuple(key.split('.')), value)
+        checks.append(check)
+
+    if len(checks) == 0:
+        return lambda _columns: np.ones(_columns.n, dtype=bool)
+    return all_of(checks)
+
+
+def load_plugin(_plugin):
+    """
+
+    :param _plugin: 'module:function' or callable
+    :return: callable
+    """
+    if callable(_plugin):
+        return _plugin
+    module, _, name = _plugin.partition(':')
+    if len(name) == 0:
+        raise ValueError(f'Plugin must be given as module:function, got {_plugin}')
+    return getattr(importlib.import_module(module), name)
+
+
+class AlertFilter(object):
+    """
+        Ingest-time filtering and enrichment of mongified alerts, before they are batched for db.
+
+        Alerts not matching the query (config['misc']['filter']) are dropped.
+        Then the plugins (config['misc']['plugins'], 'module:function') are called in order on what is left,
+        each as plugin(documents) -> documents: to add derived fields (e.g. in place) or to drop more alerts
+    """
+    def __init__(self, _query=None, _plugins=()):
+        """
+
+        :param _query: MongoDB-style query, see compile_query, or None to keep everything
+        :param _plugins: list of 'module:function' or callables
+        """
+        self.query = _query or dict()
+        self.predicate = compile_query(self.query) if len(self.query) > 0 else None
+        self.plugins = [load_plugin(_p) for _p in _plugins]
+
+    def __call__(self, _documents):
+        """
+
+        :param _documents: mongified alerts
+        :return: those to keep
+        """
+        if (self.predicate is not None) and (len(_documents) > 0):
+            mask = self.predicate(Columns(_documents))
+            _documents = [_d for _d, _keep in zip(_documents, mask) if _keep]
+        for plugin in self.plugins:
+            if len(_documents) == 0:
+                break
+            _documents = plugin(_documents)
+        return _documents
@@ -0,0 +1,430 @@
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+import traceback
+
+import bson
+import pymongo
+
+
+def async_mongo_client(**kwargs):
+    """
+        asyncio Mongo client: PyMongo's own if it has one (4.9+), Motor otherwise
+
+    :param kwargs: passed on to the client
+    :return:
+    """
+    try:
+        from pymongo import AsyncMongoClient
+    except ImportError:
+        # optional dependency, only needed for async ingest
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    return AsyncMongoClient(**kwargs)
+
+
+class InMemoryAsyncCollection(object):
+    """
+        In-process fake of an asyncio Mongo collection, for testing async ingest without mongod.
+        insert_many behaves like the real thing, including BulkWriteError's on duplicate _id's
+    """
+    def __init__(self, _latency=0.0):
+        """
+
+        :param _latency: [s] time every insert_many takes, to see inserts overlap
+        """
+        self.latency = _latency
+        # {_id: document}
+        self.documents = dict()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def insert_many(self, documents, ordered=True):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency > 0:
+                await asyncio.sleep(self.latency)
+
+            write_errors = []
+            n_inserted = 0
+            for i, doc in enumerate(documents):
+                if '_id' not in doc:
+                    doc['_id'] = bson.ObjectId()
+                if doc['_id'] in self.documents:
+                    write_errors.append({'index': i, 'code': 11000, 'errmsg': 'E11000 duplicate key error',
+                                         'op': doc})
+                    if ordered:
+                        break
+                    continue
+                self.documents[doc['_id']] = doc
+                n_inserted += 1
+
+            if len(write_errors) > 0:
+                raise pymongo.errors.BulkWriteError({'writeErrors': write_errors, 'writeConcernErrors': [],
+                                                     'nInserted': n_inserted})
+        finally:
+            self.in_flight -= 1
+
+    async def count_documents(self, _filter):
+        assert len(_filter) == 0, 'only counting everything is supported'
+        return len(self.documents)
+
+
+class AsyncStreamReader(object):
+    """
+        Blocking file-like view of a download running on an event loop,
+        for readers in other threads, e.g. tarfile in streaming mode
+    """
+    def __init__(self, _loop, _queue, _task):
+        """
+
+        :param _loop: event loop the download runs on
+        :param _queue: asyncio.Queue of chunks: bytes, None at the end, or the exception the download failed with
+        :param _task: the download
+        """
+        self.loop = _loop
+        self.queue = _queue
+        self.task = _task
+        self.chunk = b''
+        self.offset = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        parts = []
+        while (size != 0) and (not self.eof):
+            if self.offset >= len(self.chunk):
+                chunk = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop).result()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if chunk is None:
+                    self.eof = True
+                else:
+                    self.chunk, self.offset = chunk, 0
+                continue
+            n = len(self.chunk) - self.offset if size < 0 else min(size, len(self.chunk) - self.offset)
+            parts.append(self.chunk[self.offset:self.offset + n])
+            self.offset += n
+            if size > 0:
+                size -= n
+
+        return b''.join(parts)
+
+    def close(self):
+        """
+            Stop downloading, e.g. if the reader bailed out early
+        :return:
+        """
+        self.loop.call_soon_threadsafe(self.task.cancel)
+
+
+class AsyncIngestPipeline(object):
+    """
+        asyncio counterpart of fetcher.IngestPipeline: avro packets are decoded in an executor,
+        up to _inserts insert_many batches are kept in flight at once on an asyncio Mongo client
+        (fewer if the fetcher's write_tuner.WriteTuner says so),
+        and tarballs can be streamed in over async HTTP.
+
+        The event loop runs in a background thread, so the pipeline has the same blocking interface
+        as IngestPipeline (submit/close) and plugs into FetcherArchive as is. submit() blocks while
+        2 * _workers packets are being decoded or waiting for an insert slot, which bounds memory.
+        Batches complete out of order, which the manifest does not mind
+    """
+    def __init__(self, _fetcher, _connect, _decode, _workers=1, _inserts=4, _chunk_size=1024 * 1024,
+                 _stream_queue=16):
+        """
+
+        :param _fetcher: FetcherArchive to get batching, cutouts, light curves, and bookkeeping from
+        :param _connect: callable() -> (client or None, async collection), called on the event loop.
+                         The client, if any, is closed with the pipeline
+        :param _decode: callable(data) -> (documents, bounds on their BSON sizes, decode time [s], mongify time [s],
+                        archive index rows or None), see fetcher.decode_avro
+        :param _workers: number of decoder processes, decode in a thread if 1
+        :param _inserts: max number of insert_many batches in flight, see also _fetcher.write_tuner
+        :param _chunk_size: [bytes] download chunk size when streaming
+        :param _stream_queue: max number of downloaded chunks waiting to be read
+        """
+        self.fetcher = _fetcher
+        self.connect = _connect
+        self.decode = _decode
+        self.inserts = max(int(_inserts), 1)
+        self.chunk_size = _chunk_size
+        self.stream_queue = _stream_queue
+
+        # either way, decoding does not hold up the event loop
+        if _workers > 1:
+            from fetcher import process_pool
+            self.pool = process_pool(_workers)
+        else:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.max_pending = 2 * max(int(_workers), 1)
+        # cutouts, light curves and manifest go through the blocking client
+        self.threads = concurrent.futures.ThreadPoolExecutor(max_workers=self.inserts)
+
+        self.client = None
+        self.timer = None
+        self.collection = None
+        self.tasks = set()
+        self.n_pending = 0
+        self.n_in_flight = 0
+        # full batches waiting for an insert slot
+        self.ready = collections.deque()
+
+        self.batcher = _fetcher.make_batcher(
+            lambda _documents, _sources, _n_bytes: self.ready.append((_documents, _sources, _n_bytes)))
+
+        self.pending_depth = _fetcher.metrics.gauge('pending_decodes', 'avro packets submitted for decoding')
+        self.in_flight_depth = _fetcher.metrics.gauge('inserts_in_flight', 'insert_many batches in flight')
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='ingest-loop', daemon=True)
+        self.thread.start()
+        self.run(self.setup())
+
+    def run(self, _coroutine):
+        """
+            Run a coroutine on the pipeline's event loop and wait for its result
+        """
+        return asyncio.run_coroutine_threadsafe(_coroutine, self.loop).result()
+
+    def spawn(self, _coroutine):
+        task = self.loop.create_task(_coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def setup(self):
+        # asyncio primitives and clients belong to the loop they are made on
+        self.pending = asyncio.Semaphore(self.max_pending)
+        # signalled when an insert completes
+        self.slots = asyncio.Condition()
+        self.client, self.collection = self.connect()
+        # partial batches go out on time even while no packets come in, e.g. the download stalls
+        self.stopped = asyncio.Event()
+        if self.batcher.max_age is not None:
+            self.timer = self.loop.create_task(self.watch())
+
+    async def watch(self):
+        """
+            Flush the current batch once it is past the batcher's max_age and send it off, until stopped
+        :return:
+        """
+        # how late an age flush can be
+        interval = min(self.batcher.max_age / 4, 1.0)
+        while True:
+            try:
+                await asyncio.wait_for(self.stopped.wait(), interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            if await self.loop.run_in_executor(self.threads, self.batcher.flush_if_stale):
+                await self.drain()
+
+    def submit(self, _data, _member=None):
+        """
+            Queue an avro packet for decoding
+
+        :param _data: path to avro file or its raw contents
+        :param _member: name of the avro packet
+        :return:
+        """
+        self.run(self.submit_async(_data, _member))
+
+    async def submit_async(self, _data, _member):
+        await self.pending.acquire()
+        self.spawn(self.collect(_data, _member))
+        self.n_pending += 1
+        self.pending_depth.set(self.n_pending)
+
+    async def collect(self, _data, _member):
+        """
+            Decode a packet and add its documents to the current batch, send full batches off to db
+        """
+        try:
+            try:
+                decoded = await self.loop.run_in_executor(self.pool, self.decode, _data)
+                documents, sizes, t_decode, t_mongify, rows = decoded
+            except Exception as _e:
+                print(_e)
+                traceback.print_exc()
+                self.fetcher.n_failed += 1
+                self.fetcher.metrics.counter('packets_failed_total', 'avro packets that failed to ingest').inc()
+                return
+
+            self.fetcher.metrics.histogram('decode_seconds',
+                                           'avro decode time per packet or polled batch').observe(t_decode)
+            self.fetcher.metrics.histogram('mongify_seconds',
+                                           'mongify time per packet or polled batch').observe(t_mongify)
+            self.fetcher.metrics.counter('alerts_total', 'alerts decoded').inc(len(documents))
+            if rows is not None:
+                await self.loop.run_in_executor(self.threads, self.fetcher.archive_packet, _data, _member, rows)
+            if self.fetcher.alert_filter is not None:
+                # plugins may take a while
+                documents = await self.loop.run_in_executor(self.threads, self.fetcher.filter_alerts,
+                                                            documents, sizes)
+
+            if self.fetcher.manifest is not None:
+                self.fetcher.manifest.expect(_member, len(documents))
+
+            # sizes documents a plugin replaced by BSON-encoding them: not on the loop
+            await self.loop.run_in_executor(self.threads, self.batcher.add, documents, [_member] * len(documents),
+                                            sizes)
+            self.fetcher.n_alerts += len(documents)
+
+            # hold on to the decode slot until our batches are in flight: that is the backpressure
+            await self.drain()
+        finally:
+            self.pending.release()
+            self.n_pending -= 1
+            self.pending_depth.set(self.n_pending)
+
+    async def drain(self):
+        """
+            Start inserting full batches, waiting for free insert slots
+        :return:
+        """
+        while len(self.ready) > 0:
+            documents, sources, n_bytes = self.ready.popleft()
+            async with self.slots:
+                await self.slots.wait_for(lambda: self.n_in_flight < min(self.inserts,
+                                                                         self.fetcher.write_tuner.in_flight))
+                self.n_in_flight += 1
+            self.spawn(self.write(documents, sources, n_bytes))
+            self.in_flight_depth.set(self.n_in_flight)
+
+    async def write(self, _documents, _sources, _n_bytes=None):
+        """
+            Same as FetcherArchive.insert_batch, with insert_many on the asyncio client
+        """
+        try:
+            documents = await self.loop.run_in_executor(self.threads, self.fetcher.drop_existing, _documents)
+            # light curves before alerts, as in FetcherArchive.insert_batch
+            acknowledged = await self.loop.run_in_executor(self.threads, self.fetcher.store_cutouts, documents) and \
+                await self.loop.run_in_executor(self.threads, self.fetcher.update_lightcurves, documents) and \
+                await self.insert(documents, _n_bytes if len(documents) == len(_documents) else None)
+            await self.loop.run_in_executor(self.threads, self.fetcher.record_batch, _documents, _sources,
+                                            acknowledged)
+        except Exception as _e:
+            print(_e)
+            traceback.print_exc()
+            self.fetcher.logger.error(f'Failed to write batch: {_e}')
+        finally:
+            async with self.slots:
+                self.n_in_flight -= 1
+                self.slots.notify()
+            self.in_flight_depth.set(self.n_in_flight)
+
+    async def insert(self, _documents, _n_bytes=None):
+        """
+            insert_many(ordered=False) a batch, counted, tuned, and retried the same way as
+            Fetcher.insert_multiple_db_entries
+
+        :param _documents:
+        :param _n_bytes: BSON size of the batch, if known
+        :return: True if db acknowledged the whole batch (duplicates count as acknowledged)
+        """
+        if len(_documents) == 0:
+            return True
+        metrics = self.fetcher.metrics
+        metrics.histogram('batch_documents', 'documents per insert_many',
+                          _buckets=(1, 10, 50, 100, 200, 500, 1000, 5000, 10000)).observe(len(_documents))
+        _msg = f'inserting batch of {len(_documents)}'
+        print(_msg)
+        self.fetcher.logger.info(_msg)
+        tic = time.time()
+        try:
+            await self.fetcher.write_tuner.write_async(lambda: self.collection.insert_many(_documents, ordered=False),
+                                                       len(_documents), _n_bytes)
+        except pymongo.errors.BulkWriteError as bwe:
+            return self.fetcher.bulk_write_error_acknowledged(bwe)
+        except Exception as _e:
+            traceback.print_exc()
+            print(_e)
+            metrics.counter('insert_errors_total', 'batches not acknowledged by db').inc()
+            return False
+        finally:
+            metrics.histogram('insert_seconds', 'insert_many latency per batch').observe(time.time() - tic)
+
+        metrics.counter('inserted_total', 'documents inserted into db').inc(len(_documents))
+
+        return True
+
+    def stream(self, url):
+        """
+            Start downloading url on the event loop
+
+        :param url:
+        :return: AsyncStreamReader, content length or None
+        """
+        return self.run(self.open_stream(url))
+
+    async def open_stream(self, url):
+        queue = asyncio.Queue(maxsize=self.stream_queue)
+        headers = self.loop.create_future()
+        task = self.loop.create_task(self.download(url, queue, headers))
+        # raises if the request failed
+        size = await headers
+        return AsyncStreamReader(self.loop, queue, task), size
+
+    async def download(self, url, _queue, _headers):
+        """
+            GET url, put the response body into _queue chunk by chunk, waiting while the reader is behind
+
+        :param url:
+        :param _queue:
+        :param _headers: future to set to content length once the response is in
+        :return:
+        """
+        # optional dependency, only needed for async streaming
+        import aiohttp
+
+        try:
+            # no limit on the total time: nightly tarballs take a while
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=60)) as session:
+                async with session.get(url) as r:
+                    r.raise_for_status()
+                    _headers.set_result(r.headers.get('Content-Length'))
+                    async for chunk in r.content.iter_chunked(self.chunk_size):
+                        await _queue.put(chunk)
+            await _queue.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as _e:
+            if not _headers.done():
+                _headers.set_exception(_e)
+            else:
+                await _queue.put(_e)
+
+    def close(self):
+        """
+            Wait for all submitted packets to be decoded and written, then shut down the loop and executors
+        :return:
+        """
+        self.run(self.close_async())
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+        self.pool.shutdown()
+        self.threads.shutdown()
+
+    async def close_async(self):
+        while len(self.tasks) > 0:
+            await asyncio.gather(*list(self.tasks))
+
+        # not in the middle of sending a batch off: stopped only between checks
+        self.stopped.set()
+        if self.timer is not None:
+            await self.timer
+
+        self.batcher.close()
+        await self.drain()
+        while len(self.tasks) > 0:
+            await asyncio.gather(*list(self.tasks))
+
+        if self.client is not None:
+            closed = self.client.close()
+            # PyMongo's async client closes asynchronously, Motor's does not
+            if asyncio.iscoroutine(closed):
+                await closed
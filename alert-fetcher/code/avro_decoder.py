@@ -0,0 +1,390 @@
+import io
+import json
+import threading
+import zlib
+
+import fastavro
+
+
+MAGIC = b'Obj\x01'
+
+
+def read_long(fo):
+    """
+        Zig-zag varint, as in avro headers and block counts
+    """
+    b = fo.read(1)
+    if len(b) == 0:
+        raise EOFError
+    b = b[0]
+    n = b & 0x7F
+    shift = 7
+    while b & 0x80:
+        b = fo.read(1)[0]
+        n |= (b & 0x7F) << shift
+        shift += 7
+    return (n >> 1) ^ -(n & 1)
+
+
+def read_header(fo):
+    """
+        Avro container file header
+
+    :param fo: file-like object at the start of the file
+    :return: {key: value bytes} metadata, 16-byte sync marker
+    """
+    if fo.read(4) != MAGIC:
+        raise ValueError('Not an avro container file')
+    metadata = dict()
+    while True:
+        n = read_long(fo)
+        if n == 0:
+            break
+        if n < 0:
+            # block size follows negative counts
+            n = -n
+            read_long(fo)
+        for _ in range(n):
+            key = fo.read(read_long(fo)).decode()
+            metadata[key] = fo.read(read_long(fo))
+    return metadata, fo.read(16)
+
+
+def read_schema(_data):
+    """
+        Writer schema of an avro container file
+
+    :param _data: file contents (bytes) or path
+    :return: schema json
+    """
+    if isinstance(_data, bytes):
+        return read_header(io.BytesIO(_data))[0]['avro.schema']
+    with open(_data, 'rb') as f:
+        return read_header(f)[0]['avro.schema']
+
+
+def split_path(_path):
+    return tuple(_path.split('.')) if isinstance(_path, str) else tuple(_path)
+
+
+class Projection(object):
+    """
+        Which fields of an alert to keep, as dotted paths through records: 'candidate.magpsf', 'cutoutScience'.
+        Arrays and unions are transparent: 'prv_candidates.magpsf' is magpsf of every prv_candidate.
+        A field is kept if it is on or under an include path (everything if include is None)
+        and not on or under an exclude path. Applied to decoded records, see AvroDecoder
+    """
+    def __init__(self, _include=None, _exclude=(), _required=()):
+        """
+
+        :param _include: paths to keep, everything if None
+        :param _exclude: paths to drop
+        :param _required: paths kept no matter what, e.g. what mongify needs
+        """
+        required = [split_path(_r) for _r in _required]
+        self.include = None if _include is None else [split_path(_p) for _p in _include] + required
+        # excluding a required field or anything it is in would lose it
+        self.exclude = [split_path(_p) for _p in _exclude
+                        if not any(_r[:len(split_path(_p))] == split_path(_p) for _r in required)]
+
+    def key(self):
+        return (None if self.include is None else tuple(sorted(self.include)), tuple(sorted(self.exclude)))
+
+    def keeps(self, _path):
+        """
+
+        :param _path: tuple
+        :return: keep field at _path?, keep all of what is under it?
+        """
+        n = len(_path)
+        if any(_path[:len(_e)] == _e for _e in self.exclude):
+            return False, False
+        if self.include is None:
+            whole = True
+        else:
+            whole = any(_path[:len(_i)] == _i for _i in self.include)
+            if not whole and not any(_i[:n] == _path for _i in self.include):
+                return False, False
+        # something further down may still be excluded
+        return True, whole and not any(len(_e) > n and _e[:n] == _path for _e in self.exclude)
+
+    def plan(self, _schema):
+        """
+            Compile the projection against a writer schema
+
+        :param _schema: avro schema as in the file header
+        :return: None to keep records as they are, otherwise {field: sub-plan} for the top-level record
+        """
+        return self.compile(_schema, (), '', dict())
+
+    def compile(self, _schema, _path, _namespace, _named):
+        """
+            Walk the schema collecting, for every record along the kept paths, which of its fields to keep
+
+        :param _schema:
+        :param _path: of the field whose type _schema is
+        :param _namespace: enclosing namespace, to resolve names
+        :param _named: {full name: schema} of named types seen so far
+        :return: None if values are kept whole, {field: sub-plan} for records to prune
+        """
+        if isinstance(_schema, str):
+            name = _schema if ('.' in _schema or not _namespace) else f'{_namespace}.{_schema}'
+            _schema = _named.get(name, _named.get(_schema, _schema))
+            if isinstance(_schema, str):
+                # primitive
+                return None
+
+        if isinstance(_schema, list):
+            # union: values are of one of the branches, records with the same field names prune the same
+            plans = [self.compile(_s, _path, _namespace, _named) for _s in _schema]
+            plans = [_p for _p in plans if _p is not None]
+            if len(plans) == 0:
+                return None
+            merged = dict()
+            for _p in plans:
+                merged.update(_p)
+            return merged
+
+        _type = _schema['type']
+        if _type in ('record', 'error', 'enum', 'fixed'):
+            name = _schema['name']
+            if '.' not in name:
+                namespace = _schema.get('namespace', _namespace)
+                name = f'{namespace}.{name}' if namespace else name
+            _named[name] = _schema
+            _namespace = name.rsplit('.', 1)[0] if '.' in name else ''
+
+        if _type == 'array':
+            return self.compile(_schema['items'], _path, _namespace, _named)
+        if _type == 'map':
+            return self.compile(_schema['values'], _path, _namespace, _named)
+        if _type not in ('record', 'error'):
+            return None
+
+        plan = dict()
+        whole = True
+        for field in _schema['fields']:
+            path = _path + (field['name'],)
+            keep, keep_whole = self.keeps(path)
+            if not keep:
+                whole = False
+                continue
+            # named types defined inside must be registered even if kept whole
+            sub_plan = self.compile(field['type'], path, _namespace, _named)
+            if keep_whole and sub_plan is None:
+                plan[field['name']] = None
+            else:
+                plan[field['name']] = sub_plan
+                whole = False
+
+        return None if whole else plan
+
+
+def prune(_value, _plan):
+    """
+        Apply a compiled projection to a decoded value
+
+    :param _value: record (dict), array of them (list), or anything else
+    :param _plan: None or {field: sub-plan}
+    :return:
+    """
+    if (_plan is None) or (_value is None):
+        return _value
+    if isinstance(_value, list):
+        return [prune(_v, _plan) for _v in _value]
+    if isinstance(_value, dict):
+        return {key: (_value[key] if sub_plan is None else prune(_value[key], sub_plan))
+                for key, sub_plan in _plan.items() if key in _value}
+    return _value
+
+
+# how much larger than its avro encoding a value can get as BSON: e.g. a float becomes an 8-byte double,
+# a string gets a 4-byte length and a NUL instead of a varint length
+BSON_OVERHEAD = {'null': 0, 'boolean': 0, 'int': 3, 'long': 7, 'float': 4, 'double': 0, 'string': 4, 'bytes': 4}
+
+
+def bson_overhead(_schema, _namespace='', _named=None):
+    """
+        Compile an avro type into how much larger a value of it can be as BSON than as avro,
+        for upper bounds on document sizes that cost next to nothing next to BSON-encoding them
+
+    :param _schema:
+    :param _namespace: enclosing namespace, to resolve names
+    :param _named: {full name: overhead} of named types seen so far
+    :return: [bytes] if the same for all values, callable(decoded value) -> [bytes] if not, None if unbounded
+    """
+    if _named is None:
+        _named = dict()
+
+    if isinstance(_schema, str):
+        if _schema in BSON_OVERHEAD:
+            return BSON_OVERHEAD[_schema]
+        name = _schema if ('.' in _schema or not _namespace) else f'{_namespace}.{_schema}'
+        # None for (recursive) types not compiled yet
+        return _named.get(name, _named.get(_schema))
+
+    if isinstance(_schema, list):
+        branches = [bson_overhead(_s, _namespace, _named) for _s in _schema if _s != 'null']
+        if any(_b is None for _b in branches):
+            return None
+        if not any(callable(_b) for _b in branches):
+            return max(branches, default=0)
+        if len(branches) > 1:
+            # would have to tell which branch a value is of
+            return None
+        branch = branches[0]
+        return lambda _v: 0 if _v is None else branch(_v)
+
+    _type = _schema['type']
+    if _type in BSON_OVERHEAD:
+        # annotated primitive
+        return BSON_OVERHEAD[_type]
+    if _type in ('array', 'map'):
+        items = bson_overhead(_schema['items' if _type == 'array' else 'values'], _namespace, _named)
+        if items is None:
+            return None
+        # embedded document, every item with a type byte, a key (index in arrays) and a NUL
+        if _type == 'map':
+            if callable(items):
+                return lambda _v: 5 + sum(2 + items(_i) for _i in _v.values())
+            return lambda _v: 5 + len(_v) * (2 + items)
+        if callable(items):
+            return lambda _v: 5 + sum(2 + len(str(_n)) + items(_i) for _n, _i in enumerate(_v))
+        return lambda _v: 5 + len(_v) * (2 + len(str(len(_v))) + items)
+
+    name = _schema['name']
+    if '.' not in name:
+        namespace = _schema.get('namespace', _namespace)
+        name = f'{namespace}.{name}' if namespace else name
+    _namespace = name.rsplit('.', 1)[0] if '.' in name else ''
+
+    if _type == 'enum':
+        # index -> string
+        overhead = 5 + max(len(_s.encode()) for _s in _schema['symbols'])
+    elif _type == 'fixed':
+        # binary subtype
+        overhead = 5
+    else:
+        _named[name] = None
+        # embedded document
+        fixed = 5
+        fields = []
+        for field in _schema['fields']:
+            sub = bson_overhead(field['type'], _namespace, _named)
+            if sub is None:
+                return None
+            # type byte, name, NUL
+            fixed += 2 + len(field['name'].encode())
+            if callable(sub):
+                fields.append((field['name'], sub))
+            else:
+                fixed += sub
+        if len(fields) == 0:
+            overhead = fixed
+        else:
+            def overhead(_v):
+                return fixed + sum(_sub(_v[_name]) for _name, _sub in fields)
+    _named[name] = overhead
+    return overhead
+
+
+class AvroDecoder(object):
+    """
+        Decode avro container files (alert packets) with their writer schemas parsed once and cached:
+        fastavro.reader parses the schema in the header of every file it opens,
+        which for single-alert ZTF packets is a large share of decode time.
+        Records are decoded in full with fastavro.schemaless_reader against the cached schema, cutouts included,
+        then pruned to the projection compiled for that schema. The projection does not make decoding cheaper:
+        what it saves is memory, BSON to send, and space in db downstream.
+
+        (Not decoding dropped fields in the first place does not pay off with fastavro:
+        a pruned avro reader schema costs more in schema resolution than it saves, ~1.4x slower than a full decode,
+        and skipping fields by decoding the others one by one is no faster than decoding them all,
+        bytes fields such as cutouts being cheap to decode)
+
+        Along the way, an upper bound on the BSON size of every record comes for free from the bytes it took up
+        in the block and bson_overhead, see batcher.Batcher
+    """
+    def __init__(self, _projection=None):
+        """
+
+        :param _projection: Projection, keep everything if None
+        """
+        self.projection = _projection
+        # {schema json: (parsed schema, compiled projection)}
+        self.schemas = dict()
+        self.lock = threading.Lock()
+
+    def get_schema(self, _schema_json):
+        """
+
+        :param _schema_json: bytes, avro.schema from file header
+        :return: parsed schema, compiled projection, compiled bson_overhead
+        """
+        cached = self.schemas.get(_schema_json)
+        if cached is None:
+            schema = json.loads(_schema_json)
+            plan = self.projection.plan(schema) if self.projection is not None else None
+            cached = (fastavro.parse_schema(schema), plan, bson_overhead(schema))
+            with self.lock:
+                self.schemas[_schema_json] = cached
+        return cached
+
+    def records(self, fo, _unpruned=None, _sizes=None):
+        """
+            All records in an avro container file
+
+        :param fo: file-like object opened in binary mode
+        :param _unpruned: list to also put the records in as decoded, before projection
+        :param _sizes: list to put upper bounds on the BSON size of the records in, None where there is none
+        :return: list of records
+        """
+        metadata, sync = read_header(fo)
+        codec = metadata.get('avro.codec', b'null')
+        schema, plan, overhead = self.get_schema(metadata['avro.schema'])
+
+        if codec not in (b'null', b'deflate'):
+            # let fastavro deal with other codecs
+            fo.seek(0)
+            records = list(fastavro.reader(fo))
+            if _unpruned is not None:
+                _unpruned.extend(records)
+            if _sizes is not None:
+                _sizes.extend([None] * len(records))
+            return [prune(record, plan) for record in records]
+
+        records = []
+        while True:
+            try:
+                n = read_long(fo)
+            except EOFError:
+                break
+            size = read_long(fo)
+            block = fo if codec == b'null' else io.BytesIO(zlib.decompress(fo.read(size), -15))
+            for _ in range(n):
+                if _sizes is not None:
+                    start = block.tell()
+                record = fastavro.schemaless_reader(block, schema, None)
+                if _unpruned is not None:
+                    _unpruned.append(record)
+                if _sizes is not None:
+                    if overhead is None:
+                        _sizes.append(None)
+                    else:
+                        _sizes.append(block.tell() - start + (overhead(record) if callable(overhead) else overhead))
+                records.append(prune(record, plan))
+            if fo.read(16) != sync:
+                raise ValueError('Bad avro sync marker')
+
+        return records
+
+    def decode(self, _data):
+        """
+
+        :param _data: path to avro file or its raw contents
+        :return: list of records
+        """
+        if isinstance(_data, bytes):
+            return self.records(io.BytesIO(_data))
+        with open(_data, 'rb') as f_avro:
+            return self.records(f_avro)
@@ -0,0 +1,166 @@
+import threading
+import time
+
+import bson
+
+
+class Batcher(object):
+    """
+        Accumulate documents and hand them over to flush() in batches bounded by
+        number of documents, total BSON size, and age of the oldest buffered document.
+
+        The buffer never holds more than max_documents documents or max_bytes of BSON
+        (unless a single document is larger than that), which is what bounds ingest memory.
+        Documents are BSON-encoded to size them unless their sizes are passed in,
+        e.g. as estimated by avro_decoder.AvroDecoder.records: pymongo encodes them again on insert
+    """
+    def __init__(self, _flush, _max_documents=200, _max_bytes=32 * 1024 * 1024, _max_age=None, _slack=0):
+        """
+
+        :param _flush: callable(documents, sources, BSON size) that takes a full batch
+        :param _max_documents: flush once this many documents are buffered,
+                               or callable() returning that, read on every add(), e.g. to follow write_tuner.WriteTuner
+        :param _max_bytes: flush before buffered BSON size would exceed this. Keep below Mongo's 48 MB message size
+        :param _max_age: [s] flush if the oldest buffered document is older than that, checked on add(),
+                         flush_if_stale(), and by the timer if started
+        :param _slack: [bytes] added to every size passed in to add(), for fields added to documents after sizing
+        """
+        self.flush_batch = _flush
+        self.max_documents = _max_documents
+        self.max_bytes = int(_max_bytes)
+        self.max_age = _max_age
+        self.slack = int(_slack)
+
+        self.lock = threading.Lock()
+        # see start_timer
+        self.timer = None
+        self.stopped = threading.Event()
+
+        self.documents = []
+        # where each document came from, passed on to flush
+        self.sources = []
+        self.n_bytes = 0
+        self.t_first = None
+
+        # metrics
+        self.n_batches = 0
+        self.n_documents = 0
+        self.n_bytes_total = 0
+        self.flushes = {'count': 0, 'bytes': 0, 'age': 0, 'final': 0}
+        self.max_batch_documents = 0
+        self.max_batch_bytes = 0
+
+    def add(self, _documents, _sources=None, _sizes=None):
+        """
+
+        :param _documents: list of documents
+        :param _sources: list of the same length: where each document came from
+        :param _sizes: list of the same length: upper bounds on the BSON size of each document, None if not known
+        :return:
+        """
+        if _sources is None:
+            _sources = [None] * len(_documents)
+        if _sizes is None:
+            _sizes = [None] * len(_documents)
+
+        with self.lock:
+            max_documents = max(int(self.max_documents() if callable(self.max_documents) else self.max_documents), 1)
+            for doc, source, size in zip(_documents, _sources, _sizes):
+                size = len(bson.BSON.encode(doc)) if size is None else size + self.slack
+
+                if (len(self.documents) > 0) and (self.n_bytes + size > self.max_bytes):
+                    self.flush('bytes')
+
+                if len(self.documents) == 0:
+                    self.t_first = time.time()
+                self.documents.append(doc)
+                self.sources.append(source)
+                self.n_bytes += size
+
+                if len(self.documents) >= max_documents:
+                    self.flush('count')
+
+            if self.stale():
+                self.flush('age')
+
+    def stale(self):
+        """
+            Is the oldest buffered document past max_age? Call with self.lock held
+        :return:
+        """
+        return (self.max_age is not None) and (len(self.documents) > 0) and \
+            (time.time() - self.t_first >= self.max_age)
+
+    def flush_if_stale(self):
+        """
+            Flush if the oldest buffered document is past max_age, for when no add() is coming,
+            e.g. while a download stalls
+        :return: flushed?
+        """
+        with self.lock:
+            if not self.stale():
+                return False
+            self.flush('age')
+            return True
+
+    def start_timer(self):
+        """
+            Check max_age from a background thread until close(), so that a partial batch does not outlive it
+            while the producer is stuck. flush() is then called from that thread too
+        :return:
+        """
+        if (self.max_age is None) or (self.timer is not None):
+            return
+        # how late an age flush can be
+        interval = min(self.max_age / 4, 1.0)
+
+        def watch():
+            while not self.stopped.wait(interval):
+                self.flush_if_stale()
+
+        self.timer = threading.Thread(target=watch, name='batcher-timer', daemon=True)
+        self.timer.start()
+
+    def flush(self, _reason):
+        """
+            Hand over whatever is buffered. Call with self.lock held
+        :param _reason: count, bytes, age, or final
+        :return:
+        """
+        if len(self.documents) == 0:
+            return
+
+        documents, sources, n_bytes = self.documents, self.sources, self.n_bytes
+        self.documents, self.sources, self.n_bytes, self.t_first = [], [], 0, None
+
+        self.n_batches += 1
+        self.n_documents += len(documents)
+        self.n_bytes_total += n_bytes
+        self.flushes[_reason] += 1
+        self.max_batch_documents = max(self.max_batch_documents, len(documents))
+        self.max_batch_bytes = max(self.max_batch_bytes, n_bytes)
+
+        self.flush_batch(documents, sources, n_bytes)
+
+    def close(self):
+        """
+            Stop the timer, flush what is left
+        :return:
+        """
+        self.stopped.set()
+        if self.timer is not None:
+            self.timer.join()
+            self.timer = None
+        with self.lock:
+            self.flush('final')
+
+    def metrics(self):
+        """
+
+        :return: dict
+        """
+        return {'n_batches': self.n_batches, 'n_documents': self.n_documents, 'n_bytes': self.n_bytes_total,
+                'flushes': dict(self.flushes),
+                'max_batch_documents': self.max_batch_documents, 'max_batch_bytes': self.max_batch_bytes,
+                'mean_batch_documents': self.n_documents / self.n_batches if self.n_batches > 0 else 0.0,
+                'mean_document_bytes': self.n_bytes_total / self.n_documents if self.n_documents > 0 else 0.0}
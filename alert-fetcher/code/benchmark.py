@@ -0,0 +1,727 @@
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import bson
+import fastavro
+import numpy as np
+import pymongo
+
+from alert_archive import AlertArchive, ArchiveWriter, index_rows
+from alert_filter import AlertFilter
+from avro_decoder import AvroDecoder, Projection
+from batcher import Batcher
+from crossmatch import CrossMatch, to_radians
+from cutouts import CUTOUTS
+from fetcher import Fetcher, REQUIRED_FIELDS
+from lightcurves import POINT_FIELDS
+from query_service import QueryService
+from synthetic import AlertGenerator
+from write_tuner import WriteTuner
+
+
+def make_positions(_n, _seed=42):
+    """
+        Minimal alerts with just what coordinate enrichment needs
+
+    :param _n: number of alerts
+    :param _seed:
+    :return:
+    """
+    rs = np.random.RandomState(_seed)
+    ra = rs.uniform(0.0, 360.0, _n).tolist()
+    dec = np.degrees(np.arcsin(rs.uniform(-1.0, 1.0, _n))).tolist()
+    jd = (2458312.5 + rs.uniform(0.0, 1.0, _n)).tolist()
+    return [{'objectId': f'ZTF18{i:07d}', 'candid': i, 'candidate': {'ra': ra[i], 'dec': dec[i], 'jd': jd[i]}}
+            for i in range(_n)]
+
+
+def make_documents(_n, _seed=42):
+    """
+        Mongified alerts with all the fields the configured indices are built on (but no cutouts)
+
+    :param _n: number of alerts
+    :param _seed:
+    :return:
+    """
+    rs = np.random.RandomState(_seed)
+    alerts = make_positions(_n, _seed)
+    for alert, rb, fwhm, field, magpsf in zip(alerts, rs.uniform(0, 1, _n).tolist(), rs.uniform(1, 5, _n).tolist(),
+                                              rs.randint(245, 880, _n).tolist(), rs.uniform(14, 21, _n).tolist()):
+        alert['candidate'].update({'rb': rb, 'fwhm': fwhm, 'field': field, 'magpsf': magpsf})
+    return Fetcher.alerts_mongify(alerts)
+
+
+def get_db(_config):
+    """
+        Connect to the database from config
+    :param _config:
+    :return:
+    """
+    client = pymongo.MongoClient(host=_config['database']['host'], port=_config['database']['port'],
+                                 username=_config['database']['user'], password=_config['database']['pwd'],
+                                 authSource=_config['database']['db'])
+    return client[_config['database']['db']]
+
+
+def bench_coordinates(_config=None, _sizes=(10000, 1000000)):
+    """
+        Per-alert alert_mongify vs vectorized alerts_mongify
+
+    :param _config: not used
+    :param _sizes: numbers of alerts to run the comparison for
+    :return: dict with timings
+    """
+    results = dict()
+
+    # first call, nothing is compiled or cached yet
+    tic = time.time()
+    Fetcher.alert_mongify(make_positions(1)[0])
+    results['first_call_s'] = time.time() - tic
+
+    for n in _sizes:
+        alerts = make_positions(n)
+
+        tic = time.time()
+        per_alert = [Fetcher.alert_mongify(alert) for alert in alerts]
+        t_per_alert = time.time() - tic
+
+        tic = time.time()
+        batch = Fetcher.alerts_mongify(alerts)
+        t_batch = time.time() - tic
+
+        assert per_alert == batch, 'batch output differs from per-alert output'
+
+        results[str(n)] = {'per_alert_s': t_per_alert, 'batch_s': t_batch,
+                           'per_alert_alerts_per_s': n / t_per_alert, 'batch_alerts_per_s': n / t_batch,
+                           'speedup': t_per_alert / t_batch}
+
+    return results
+
+
+def bench_indexes(_config, _n=200000, _batch_size=None):
+    """
+        Inserts/sec into a collection with the configured indices kept live vs built after loading.
+        Needs a running mongod, uses a scratch collection in the configured db
+
+    :param _config: fetcher config
+    :param _n: number of alerts to insert
+    :param _batch_size: insert_many batch size, config['misc']['batch_size'] by default
+    :return: dict with timings
+    """
+    if _batch_size is None:
+        _batch_size = int(_config['misc']['batch_size'])
+
+    db = get_db(_config)
+    collection = 'benchmark_indexes'
+    indexes = [[tuple(_k) for _k in _index['keys']] for _index in _config['database']['indexes']]
+    documents = make_documents(_n)
+
+    def load():
+        tic = time.time()
+        for i in range(0, _n, _batch_size):
+            # insert_many adds _id to documents it gets, so hand it copies
+            db[collection].insert_many([dict(doc) for doc in documents[i:i + _batch_size]], ordered=False)
+        return time.time() - tic
+
+    def build():
+        tic = time.time()
+        for index in indexes:
+            db[collection].create_index(index)
+        return time.time() - tic
+
+    results = {'n_alerts': _n, 'batch_size': _batch_size, 'n_indexes': len(indexes)}
+
+    db.drop_collection(collection)
+    t_build = build()
+    t_load = load()
+    results['live'] = {'build_s': t_build, 'load_s': t_load, 'total_s': t_build + t_load,
+                       'inserts_per_s': _n / t_load}
+
+    db.drop_collection(collection)
+    t_load = load()
+    t_build = build()
+    results['deferred'] = {'build_s': t_build, 'load_s': t_load, 'total_s': t_build + t_load,
+                           'inserts_per_s': _n / t_load}
+
+    db.drop_collection(collection)
+
+    return results
+
+
+def bench_crossmatch(_config, _n=200000, _n_positions=(1000, 100000), _radius=2.0):
+    """
+        Per-position $geoWithin/$centerSphere queries as in the notebook's cone_search vs batched CrossMatch.
+        Needs a running mongod, uses a scratch collection in the configured db
+
+    :param _config: fetcher config
+    :param _n: number of alerts in the collection
+    :param _n_positions: catalog sizes to cross-match, half of the positions are next to an alert
+    :param _radius: [arcsec]
+    :return: dict with timings
+    """
+    db = get_db(_config)
+    collection = 'benchmark_crossmatch'
+    documents = make_documents(_n)
+
+    db.drop_collection(collection)
+    for i in range(0, _n, 10000):
+        db[collection].insert_many(documents[i:i + 10000], ordered=False)
+    db[collection].create_index([('coordinates.radec_geojson', '2dsphere')])
+    db[collection].create_index([('coordinates.healpix', 1)])
+
+    cross_match = CrossMatch(db[collection])
+    projection = {'candid': 1}
+    results = {'n_alerts': _n, 'radius_arcsec': _radius}
+
+    ra = np.array([doc['candidate']['ra'] for doc in documents])
+    dec = np.array([doc['candidate']['dec'] for doc in documents])
+    rs = np.random.RandomState(7)
+
+    for n in _n_positions:
+        near = rs.randint(0, _n, n // 2)
+        q_ra = np.concatenate([ra[near] + rs.normal(0, _radius / 3600 / 2, n // 2) / np.cos(np.radians(dec[near])),
+                               rs.uniform(0.0, 360.0, n - n // 2)]) % 360.0
+        q_dec = np.concatenate([np.clip(dec[near] + rs.normal(0, _radius / 3600 / 2, n // 2), -90.0, 90.0),
+                                np.degrees(np.arcsin(rs.uniform(-1.0, 1.0, n - n // 2)))])
+
+        tic = time.time()
+        matches_sphere = [[doc['candid'] for doc in db[collection].find(
+            {'coordinates.radec_geojson': {'$geoWithin': {'$centerSphere': [[_ra - 180.0, _dec],
+                                                                              to_radians(_radius)]}}},
+            projection)] for _ra, _dec in zip(q_ra.tolist(), q_dec.tolist())]
+        t_sphere = time.time() - tic
+
+        tic = time.time()
+        matches_healpix = cross_match.cross_match(q_ra, q_dec, _radius, projection=projection)
+        t_healpix = time.time() - tic
+
+        # 2dsphere and exact distances may disagree right at the edge of a cone
+        n_differ = sum(set(a) != set(doc['candid'] for doc in b) for a, b in zip(matches_sphere, matches_healpix))
+        results[str(n)] = {'centerSphere_s': t_sphere, 'centerSphere_positions_per_s': n / t_sphere,
+                           'healpix_s': t_healpix, 'healpix_positions_per_s': n / t_healpix,
+                           'speedup': t_sphere / t_healpix,
+                           'n_matches': sum(len(m) for m in matches_healpix), 'n_positions_differ': n_differ}
+
+    db.drop_collection(collection)
+
+    return results
+
+
+def bench_query(_config, _n=200000, _n_objects=1000, _n_queries=20000, _cache_size=10000):
+    """
+        Latency of repeated object lookups (alerts by objectId) straight from db vs through QueryService.
+        Lookups follow a Zipf-like distribution over objects, as with a few hot objects everyone looks at.
+        Needs a running mongod, uses a scratch collection in the configured db
+
+    :param _config: fetcher config
+    :param _n: number of alerts
+    :param _n_objects: number of objects they belong to
+    :param _n_queries: number of lookups
+    :param _cache_size: QueryService cache size
+    :return: dict with latency percentiles
+    """
+    db = get_db(_config)
+    collection = 'benchmark_query'
+    documents = make_documents(_n)
+    for doc in documents:
+        doc['objectId'] = f'ZTF18{doc["candid"] % _n_objects:07d}'
+
+    db.drop_collection(collection)
+    for i in range(0, _n, 10000):
+        db[collection].insert_many(documents[i:i + 10000], ordered=False)
+    db[collection].create_index([('objectId', 1)])
+
+    config = dict(_config, database=dict(_config['database'], collection_alerts=collection))
+    service = QueryService(db, config, _cache_size=_cache_size, _ttl=None)
+
+    rs = np.random.RandomState(7)
+    object_ids = [f'ZTF18{i % _n_objects:07d}' for i in rs.zipf(1.5, _n_queries)]
+
+    def percentiles(_lookup):
+        latency = []
+        for object_id in object_ids:
+            tic = time.perf_counter()
+            _lookup(object_id)
+            latency.append(time.perf_counter() - tic)
+        return {f'p{_p}_us': float(np.percentile(latency, _p)) * 1e6 for _p in (50, 90, 99)}
+
+    results = {'n_alerts': _n, 'n_objects': _n_objects, 'n_queries': _n_queries,
+               'db': percentiles(lambda _o: list(db[collection].find({'objectId': _o}).sort([('candidate.jd', 1)]))),
+               # first pass fills the cache, misses included; then repeated lookups
+               'cached_cold': percentiles(service.get_alerts),
+               'cached_warm': percentiles(service.get_alerts),
+               'cache': service.cache.stats()}
+
+    db.drop_collection(collection)
+
+    return results
+
+
+def bench_batching(_config, _n_packets=2000, _alerts_per_packet=50, _stamp_size=20000):
+    """
+        Feed a synthetic night through the Batcher configured as in config and check that
+        what is buffered never exceeds the configured bounds: that's the ingest memory ceiling.
+        Packets are generated on the fly and batches are dropped once flushed, so Python heap peak
+        should stay at a few batches' worth no matter how long the night is
+
+    :param _config: fetcher config
+    :param _n_packets: number of avro packets in the night
+    :param _alerts_per_packet:
+    :param _stamp_size: [bytes] per cutout
+    :return: dict with batching metrics, timings, and memory peak
+    """
+    max_documents = int(_config['misc']['batch_size'])
+    max_bytes = int(_config['misc'].get('batch_max_bytes', 32 * 1024 * 1024))
+
+    peak = {'documents': 0, 'bytes': 0}
+
+    def flush(_documents, _sources, _n_bytes):
+        peak['documents'] = max(peak['documents'], len(_documents))
+
+    batcher = Batcher(flush, _max_documents=max_documents, _max_bytes=max_bytes,
+                      _max_age=_config['misc'].get('batch_max_age', None))
+
+    tracemalloc.start()
+    tic = time.time()
+    for i in range(_n_packets):
+        documents = make_documents(_alerts_per_packet, _seed=i)
+        for doc in documents:
+            for cutout in CUTOUTS:
+                doc[f'cutout{cutout}'] = {'fileName': f'{doc["candid"]}_{cutout}.fits.gz',
+                                          'stampData': os.urandom(_stamp_size)}
+        batcher.add(documents, [f'{i}.avro'] * len(documents))
+        peak['bytes'] = max(peak['bytes'], batcher.n_bytes)
+    batcher.close()
+    t = time.time() - tic
+    _, heap_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    metrics = batcher.metrics()
+    n_alerts = _n_packets * _alerts_per_packet
+
+    assert metrics['n_documents'] == n_alerts, 'lost documents'
+    assert metrics['max_batch_documents'] <= max_documents, 'batch over document count limit'
+    # a single document larger than max_bytes still goes through, on its own
+    assert (metrics['max_batch_bytes'] <= max_bytes) or (metrics['max_batch_documents'] == 1), \
+        'batch over byte size limit'
+
+    return {'n_alerts': n_alerts, 'batch_size': max_documents, 'batch_max_bytes': max_bytes,
+            'batching': metrics, 'peak_buffered_bytes': peak['bytes'],
+            'night_bytes': metrics['n_bytes'], 'heap_peak_bytes': heap_peak,
+            'time_s': t, 'alerts_per_s': n_alerts / t}
+
+
+def bench_decode(_config=None, _n_packets=10000, _prv_candidates=(0, 30), _cutout_size=12000):
+    """
+        Decode + mongify a synthetic night of single-alert packets: fastavro.reader as the baseline
+        vs AvroDecoder with cached writer schemas, keeping everything, dropping cutouts,
+        and keeping only what light curves need.
+        CPU time is per 100k alerts; Python heap peak, measured in a separate pass, is of a packet's worth
+        of decoding plus the documents kept, per alert
+
+    :param _config: not used
+    :param _n_packets: number of avro packets
+    :param _prv_candidates: (min, max) number of prv_candidates per alert
+    :param _cutout_size: [bytes] per cutout
+    :return: dict with per-variant timings and memory
+    """
+    generator = AlertGenerator(_prv_candidates=_prv_candidates, _cutout_size=_cutout_size)
+    packets = [data for _, data in generator.night(_n_packets, 1)]
+    n_alerts = generator.n_alerts
+
+    def reader(_data):
+        return Fetcher.alerts_mongify(list(fastavro.reader(io.BytesIO(_data))))
+
+    def decoder(_projection):
+        _decoder = AvroDecoder(_projection)
+        return lambda _data: Fetcher.alerts_mongify(_decoder.decode(_data), _copy=False)
+
+    lightcurve_fields = [f'{_c}.{_f}' for _c in ('candidate', 'prv_candidates') for _f in POINT_FIELDS]
+    variants = {'fastavro.reader': reader,
+                'AvroDecoder': decoder(None),
+                'AvroDecoder, no cutouts': decoder(Projection(_exclude=[f'cutout{_c}' for _c in CUTOUTS],
+                                                              _required=REQUIRED_FIELDS)),
+                'AvroDecoder, light curves only': decoder(Projection(_include=lightcurve_fields,
+                                                                     _required=REQUIRED_FIELDS))}
+
+    # warm up outside the timing: the first call pays for cold imports and caches
+    reader(packets[0])
+
+    results = dict()
+    for name, decode in variants.items():
+        tic = time.process_time()
+        for data in packets:
+            decode(data)
+        t = time.process_time() - tic
+
+        tracemalloc.start()
+        documents = [decode(data) for data in packets]
+        _, heap_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        bson_bytes = sum(len(bson.BSON.encode(_d)) for _documents in documents for _d in _documents)
+        del documents
+
+        results[name] = {'cpu_s_per_100k': t / n_alerts * 1e5, 'alerts_per_s': n_alerts / t,
+                         'heap_bytes_per_alert': heap_peak / n_alerts, 'bson_bytes_per_alert': bson_bytes / n_alerts}
+
+    baseline = results['fastavro.reader']['cpu_s_per_100k']
+    for name in results:
+        results[name]['speedup'] = baseline / results[name]['cpu_s_per_100k']
+
+    return {'n_alerts': n_alerts, 'prv_candidates': list(_prv_candidates), 'cutout_size': _cutout_size,
+            'avro_bytes_per_alert': sum(len(data) for data in packets) / n_alerts, 'variants': results}
+
+
+def bench_filter(_config, _n=100000, _query=None):
+    """
+        Ingest-time filter: throughput of the compiled query over batches of alerts
+        and what it saves in what goes to db
+
+    :param _config: fetcher config, its misc.filter is the query if _query is None
+    :param _n: number of alerts
+    :param _query: MongoDB-style query, see alert_filter.compile_query
+    :return:
+    """
+    query = _query or _config['misc'].get('filter', None) or {'candidate.rb': {'$gt': 0.5}}
+    alert_filter = AlertFilter(_query=query)
+
+    documents = make_documents(_n)
+    batch_size = int(_config['misc']['batch_size'])
+
+    tic = time.time()
+    kept = []
+    for i in range(0, _n, batch_size):
+        kept.extend(alert_filter(documents[i:i + batch_size]))
+    t = time.time() - tic
+
+    bytes_total = sum(len(bson.BSON.encode(_d)) for _d in documents)
+    bytes_kept = sum(len(bson.BSON.encode(_d)) for _d in kept)
+
+    return {'query': query, 'n_alerts': _n, 'n_kept': len(kept), 'selectivity': len(kept) / _n,
+            'time_s': t, 'alerts_per_s': _n / t, 'bson_bytes_total': bytes_total, 'bson_bytes_kept': bytes_kept}
+
+
+def bench_archive(_config=None, _n_packets=10000, _n_lookups=10000, _prv_candidates=(0, 30), _cutout_size=12000):
+    """
+        A night as a directory of avro files vs packed into an archive segment + index:
+        time to write, time to get a packet or a cutout by candid, files on disk
+
+    :param _config: not used
+    :param _n_packets: number of single-alert avro packets
+    :param _n_lookups: number of random lookups
+    :param _prv_candidates: (min, max) number of prv_candidates per alert
+    :param _cutout_size: [bytes] per cutout
+    :return:
+    """
+    generator = AlertGenerator(_prv_candidates=_prv_candidates, _cutout_size=_cutout_size)
+    packets = list(generator.night(_n_packets, 1))
+    path = tempfile.mkdtemp()
+    path_files = os.path.join(path, 'files')
+    os.makedirs(path_files)
+
+    tic = time.time()
+    for name, data in packets:
+        with open(os.path.join(path_files, name), 'wb') as f:
+            f.write(data)
+    t_files = time.time() - tic
+
+    # at ingest, index rows come from the decode that happens anyway
+    decoder = AvroDecoder()
+    rows = [index_rows(data, decoder.decode(data)) for _, data in packets]
+    tic = time.time()
+    writer = ArchiveWriter(os.path.join(path, 'night'))
+    for (name, data), _rows in zip(packets, rows):
+        writer.append(data, name, _rows)
+    writer.close(_complete=True)
+    t_archive = time.time() - tic
+
+    # public archive packets are named after the candid of their alert
+    candids = [int(packets[i][0].split('.')[0]) for i in np.random.RandomState(7).randint(0, _n_packets, _n_lookups)]
+
+    def files(_candid):
+        with open(os.path.join(path_files, f'{_candid}.avro'), 'rb') as f:
+            return decoder.decode(f.read())[0]['cutoutScience']['stampData']
+
+    archive = AlertArchive(os.path.join(path, 'night'))
+
+    def percentiles(_lookup):
+        latency = []
+        for candid in candids:
+            tic = time.perf_counter()
+            _lookup(candid)
+            latency.append(time.perf_counter() - tic)
+        return {f'p{_p}_us': float(np.percentile(latency, _p)) * 1e6 for _p in (50, 99)}
+
+    results = {'n_packets': _n_packets, 'n_lookups': _n_lookups,
+               'write_s': {'files': t_files, 'archive': t_archive},
+               'files_on_disk': {'files': len(os.listdir(path_files)), 'archive': 2},
+               'cutout_by_candid': {'files': percentiles(files),
+                                    'archive': percentiles(lambda _c: archive.cutout(_c, 'Science').release())},
+               'alert_by_candid': {'archive': percentiles(archive.get)}}
+
+    archive.close()
+    shutil.rmtree(path)
+
+    return results
+
+
+def bench_startup(_config=None, _runs=5, _top=10):
+    """
+        Time to start fetcher.py: import, --help, first alert mongified, each in a fresh interpreter.
+        Also which optional heavy modules get imported anyway and the slowest imports (python -X importtime)
+
+    :param _config: not used
+    :param _runs: number of fresh interpreters per measurement, median reported
+    :param _top: number of slowest imports to report
+    :return:
+    """
+    path = os.path.dirname(os.path.abspath(__file__))
+    heavy = ('requests', 'aiohttp', 'motor', 'confluent_kafka', 'pyarrow', 'progress')
+
+    def run(_args):
+        tic = time.perf_counter()
+        out = subprocess.run([sys.executable] + _args, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             check=True)
+        return time.perf_counter() - tic, out
+
+    def median(_args):
+        return float(np.median([run(_args)[0] for _ in range(_runs)]))
+
+    results = {'runs': _runs,
+               'python_s': median(['-c', 'pass']),
+               'import_s': median(['-c', 'import fetcher']),
+               'cli_help_s': median(['fetcher.py', '--help'])}
+
+    first_alert = ('import json, sys, time; tic = time.perf_counter(); import fetcher; '
+                   't_import = time.perf_counter() - tic; '
+                   'from benchmark import make_positions; alert = make_positions(1)[0]; '
+                   'tic = time.perf_counter(); fetcher.Fetcher.alert_mongify(alert); '
+                   't_first = time.perf_counter() - tic; '
+                   f'print(json.dumps([t_import, t_first, [_m for _m in {heavy!r} if _m in sys.modules]]))')
+    _, out = run(['-c', first_alert])
+    _, results['first_alert_s'], results['heavy_modules_loaded'] = json.loads(out.stdout.decode().splitlines()[-1])
+
+    # import time: <self us> | <cumulative us> | <module>
+    _, out = run(['-X', 'importtime', '-c', 'import fetcher'])
+    imports = []
+    for line in out.stderr.decode().splitlines():
+        fields = line.split('|')
+        if (len(fields) == 3) and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].strip()))
+    results['slowest_imports_ms'] = {_m: _t / 1e3 for _t, _m in sorted(imports, reverse=True)[:_top]}
+
+    return results
+
+
+def get_sink(_config, _sink):
+    """
+        Where bench_ingest inserts batches
+
+    :param _config: fetcher config
+    :param _sink: memory (BSON-encode and drop: client-side cost only), mongomock, or mongod (configured db)
+    :return: callable(documents), cleanup callable
+    """
+    if _sink == 'memory':
+        def insert(_documents):
+            for doc in _documents:
+                bson.BSON.encode(doc)
+        return insert, lambda: None
+
+    if _sink == 'mongomock':
+        # optional dependency, only needed for this sink
+        import mongomock
+        db = mongomock.MongoClient()['benchmark']
+    elif _sink == 'mongod':
+        db = get_db(_config)
+    else:
+        raise ValueError(f'Unknown sink: {_sink}')
+
+    collection = 'benchmark_ingest'
+    db.drop_collection(collection)
+
+    def insert(_documents):
+        db[collection].insert_many(_documents, ordered=False)
+
+    return insert, lambda: db.drop_collection(collection)
+
+
+def bench_writes(_config, _n=50000, _writers=4, _sink='memory'):
+    """
+        Inserts with the batch size fixed at config['misc']['batch_size'] vs tuned by WriteTuner,
+        from _writers threads taking batches off the same list of alerts
+
+    :param _config: fetcher config
+    :param _n: number of alerts
+    :param _writers: number of writer threads
+    :param _sink: see get_sink
+    :return:
+    """
+    documents = make_documents(_n)
+    misc = _config['misc']
+    results = {'n_alerts': _n, 'writers': _writers, 'sink': _sink}
+
+    for mode in ('fixed', 'tuned'):
+        insert, cleanup = get_sink(_config, _sink)
+        tuner = WriteTuner(_batch_size=int(misc['batch_size']), _min_batch_size=int(misc.get('batch_size_min', 50)),
+                           _max_batch_size=int(misc.get('batch_size_max', 2000)),
+                           _step=int(misc.get('batch_size_step', 50)),
+                           _target_seconds=float(misc.get('batch_target_seconds', 1.0)),
+                           _adaptive=(mode == 'tuned'))
+        tuner.set_max_in_flight(_writers)
+        lock = threading.Lock()
+        position = [0]
+
+        def write():
+            while True:
+                with lock:
+                    batch = documents[position[0]:position[0] + tuner.batch_size]
+                    position[0] += len(batch)
+                if len(batch) == 0:
+                    return
+                tuner.write(lambda: insert([dict(_d) for _d in batch]), len(batch))
+
+        tic = time.time()
+        threads = [threading.Thread(target=write) for _ in range(_writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        t = time.time() - tic
+        cleanup()
+
+        results[mode] = dict(tuner.stats(), time_s=t, alerts_per_s=_n / t)
+
+    return results
+
+
+def bench_ingest(_config, _n_packets=2000, _alerts_per_packet=1, _prv_candidates=(0, 30), _cutout_size=12000,
+                 _schema=None, _sink='memory'):
+    """
+        Time each ingest stage on a synthetic night: avro decode, mongify, batching, and insert.
+        Alerts/sec and bytes/alert are what to compare between releases
+
+    :param _config: fetcher config
+    :param _n_packets: number of avro packets in the night
+    :param _alerts_per_packet: 1 in the public archive
+    :param _prv_candidates: (min, max) number of prv_candidates per alert
+    :param _cutout_size: [bytes] per cutout
+    :param _schema: path to an avro packet to take the schema from, synthetic.ZTF_SCHEMA if None
+    :param _sink: see get_sink
+    :return: dict with per-stage timings
+    """
+    schema = None
+    if _schema is not None:
+        with open(_schema, 'rb') as f_avro:
+            schema = fastavro.reader(f_avro).writer_schema
+
+    generator = AlertGenerator(_schema=schema, _prv_candidates=_prv_candidates, _cutout_size=_cutout_size)
+    packets = [data for _, data in generator.night(_n_packets, _alerts_per_packet)]
+    n_alerts = generator.n_alerts
+
+    stages = dict()
+
+    def stage(_name, _t):
+        stages[_name] = {'time_s': _t, 'alerts_per_s': n_alerts / _t if _t > 0 else None}
+
+    # as in fetcher, see bench_decode for fastavro.reader
+    decoder = AvroDecoder()
+    tic = time.time()
+    records = [decoder.decode(data) for data in packets]
+    stage('decode', time.time() - tic)
+
+    # warm up outside the timing: the first call pays for cold imports and caches
+    Fetcher.alerts_mongify(records[0][:1])
+    tic = time.time()
+    documents = [Fetcher.alerts_mongify(_records, _copy=False) for _records in records]
+    stage('mongify', time.time() - tic)
+    del records
+
+    batches = []
+    batcher = Batcher(lambda _documents, _sources, _n_bytes: batches.append(_documents),
+                      _max_documents=int(_config['misc']['batch_size']),
+                      _max_bytes=int(_config['misc'].get('batch_max_bytes', 32 * 1024 * 1024)))
+    tic = time.time()
+    for i, _documents in enumerate(documents):
+        batcher.add(_documents, [i] * len(_documents))
+    batcher.close()
+    stage('batching', time.time() - tic)
+    del documents
+
+    insert, cleanup = get_sink(_config, _sink)
+    tic = time.time()
+    for batch in batches:
+        insert(batch)
+    stage('insert', time.time() - tic)
+    cleanup()
+
+    t_total = sum(_s['time_s'] for _s in stages.values())
+    metrics = batcher.metrics()
+
+    return {'n_packets': _n_packets, 'n_alerts': n_alerts, 'prv_candidates': list(_prv_candidates),
+            'cutout_size': _cutout_size, 'sink': _sink,
+            'stages': stages, 'total_s': t_total, 'alerts_per_s': n_alerts / t_total,
+            'avro_bytes_per_alert': sum(len(data) for data in packets) / n_alerts,
+            'bson_bytes_per_alert': metrics['mean_document_bytes'],
+            'batching': metrics}
+
+
+BENCHMARKS = {'archive': bench_archive,
+              'batching': bench_batching,
+              'coordinates': bench_coordinates,
+              'crossmatch': bench_crossmatch,
+              'decode': bench_decode,
+              'filter': bench_filter,
+              'indexes': bench_indexes,
+              'ingest': bench_ingest,
+              'query': bench_query,
+              'startup': bench_startup,
+              'writes': bench_writes}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetcher micro-benchmarks')
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS.keys()),
+                        help=f'benchmarks to run: {sorted(BENCHMARKS.keys())}')
+    parser.add_argument('--config', default='config.json', help='path to fetcher config file')
+    parser.add_argument('--output', help='also save results to this JSON file')
+    parser.add_argument('--sink', default='memory', choices=('memory', 'mongomock', 'mongod'),
+                        help='ingest, writes: where to insert alerts')
+    parser.add_argument('--packets', type=int, default=2000, help='ingest: number of avro packets')
+    parser.add_argument('--decode-packets', type=int, default=10000, help='decode: number of avro packets')
+    parser.add_argument('--prv-candidates', type=int, nargs=2, default=(0, 30), metavar=('MIN', 'MAX'),
+                        help='ingest, decode: number of prv_candidates per alert')
+    parser.add_argument('--cutout-size', type=int, default=12000, help='ingest, decode: bytes per cutout')
+    parser.add_argument('--schema', help='ingest: avro packet to take the alert schema from')
+
+    args = parser.parse_args()
+    config = Fetcher.get_config(args.config)
+
+    options = {'ingest': {'_n_packets': args.packets, '_prv_candidates': tuple(args.prv_candidates),
+                          '_cutout_size': args.cutout_size, '_schema': args.schema, '_sink': args.sink},
+               'writes': {'_sink': args.sink},
+               'decode': {'_n_packets': args.decode_packets, '_prv_candidates': tuple(args.prv_candidates),
+                          '_cutout_size': args.cutout_size}}
+
+    results = {'timestamp': datetime.datetime.utcnow().strftime('%Y%m%d_%H:%M:%S'),
+               'python': platform.python_version(),
+               'versions': {'fastavro': fastavro.__version__, 'numpy': np.__version__,
+                            'pymongo': pymongo.version}}
+    for name in args.benchmarks:
+        results[name] = BENCHMARKS[name](config, **options.get(name, dict()))
+
+    print(json.dumps(results, indent=2))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f_json:
+            json.dump(results, f_json, indent=2)
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import threading
+
+import pymongo
+
+
+CUTOUTS = ('Science', 'Template', 'Difference')
+
+
+class CutoutStore(object):
+    """
+        Content-addressed storage for cutout stampData: blobs are keyed by their sha256
+    """
+    def put_many(self, blobs):
+        """
+
+        :param blobs: {sha256 hex digest: bytes}
+        :return:
+        """
+        raise NotImplementedError
+
+    def get(self, key):
+        """
+
+        :param key: sha256 hex digest
+        :return: bytes
+        """
+        raise NotImplementedError
+
+
+class MongoCutoutStore(CutoutStore):
+    """
+        Blobs in a plain collection, {'_id': key, 'data': bytes}.
+        Gzipped stamps are way below the 16 MB document limit, so no need for GridFS chunking,
+        and a batch of stamps goes in with a single insert_many
+    """
+    def __init__(self, _collection):
+        """
+
+        :param _collection: pymongo collection
+        """
+        self.collection = _collection
+
+    def put_many(self, blobs):
+        if len(blobs) == 0:
+            return
+        try:
+            self.collection.insert_many([{'_id': key, 'data': data} for key, data in blobs.items()], ordered=False)
+        except pymongo.errors.BulkWriteError as bwe:
+            # same stamp already stored is fine
+            if any(_e['code'] != 11000 for _e in bwe.details.get('writeErrors', [])) or \
+                    (len(bwe.details.get('writeConcernErrors', [])) > 0):
+                raise
+
+    def get(self, key):
+        doc = self.collection.find_one({'_id': key})
+        if doc is None:
+            raise KeyError(key)
+        return doc['data']
+
+
+class FileCutoutStore(CutoutStore):
+    """
+        Blobs in a local directory tree sharded by key prefix: <path>/ab/cd/abcd...
+    """
+    def __init__(self, _path):
+        self.path = _path
+
+    def get_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:4], key)
+
+    def put_many(self, blobs):
+        for key, data in blobs.items():
+            path = self.get_path(key)
+            if os.path.exists(path):
+                continue
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write + rename so that a half-written blob is never visible under its key.
+            # temp file per thread: writer threads may be storing the same blob at the same time
+            path_tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(path_tmp, 'wb') as _f:
+                _f.write(data)
+            os.replace(path_tmp, path)
+
+    def get(self, key):
+        with open(self.get_path(key), 'rb') as _f:
+            return _f.read()
+
+
+def offload_cutouts(_documents, _store):
+    """
+        Move stampData of alert documents to store, leaving a reference (stampId) in their place
+
+    :param _documents: mongified alerts, modified in place
+    :param _store: CutoutStore
+    :return:
+    """
+    blobs = dict()
+    references = []
+    for doc in _documents:
+        for cutout in CUTOUTS:
+            _c = doc.get(f'cutout{cutout}')
+            if (_c is None) or (_c.get('stampData') is None):
+                continue
+            key = hashlib.sha256(_c['stampData']).hexdigest()
+            blobs[key] = _c['stampData']
+            references.append((doc, f'cutout{cutout}', key))
+
+    # documents are only touched once the stamps are safely stored, so a failed batch can be retried
+    _store.put_many(blobs)
+
+    for doc, cutout, key in references:
+        doc[cutout] = {k: v for k, v in doc[cutout].items() if k != 'stampData'}
+        doc[cutout]['stampId'] = key
+
+
+class Cutouts(object):
+    """
+        Lazy accessor for the cutouts of an alert document, wherever they live:
+        Cutouts(alert, store)['Science'] -> gzipped FITS bytes, fetched on first access
+    """
+    def __init__(self, _doc, _store=None):
+        """
+
+        :param _doc: alert document
+        :param _store: CutoutStore the stamps were offloaded to, not needed if they are inline
+        """
+        self.doc = _doc
+        self.store = _store
+        self.cache = dict()
+
+    def __getitem__(self, cutout):
+        """
+
+        :param cutout: Science, Template, or Difference
+        :return:
+        """
+        if cutout not in self.cache:
+            _c = self.doc[f'cutout{cutout}']
+            if _c.get('stampData') is not None:
+                self.cache[cutout] = _c['stampData']
+            else:
+                self.cache[cutout] = self.store.get(_c['stampId'])
+        return self.cache[cutout]
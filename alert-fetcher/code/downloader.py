@@ -0,0 +1,245 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
+from progress.bar import Bar
+from progress.spinner import Spinner
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+
+
+# worth trying again: the network or the server had a moment. raw response streams raise urllib3's own errors
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                    urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError)
+
+
+def transient(_e):
+    """
+        Should a failed request be retried? Not if the server refused it, e.g. 404 or 403
+
+    :param _e: exception
+    :return:
+    """
+    if isinstance(_e, requests.HTTPError):
+        status = _e.response.status_code if _e.response is not None else None
+        return (status is not None) and ((status >= 500) or (status == 429))
+    return isinstance(_e, TRANSIENT_ERRORS)
+
+
+class Downloader(object):
+    """
+        Fetch a file over HTTP in concurrent Range segments using a pooled session.
+
+        Data go to <file_name>.part, progress of every segment is kept in <file_name>.part.json,
+        so an interrupted download resumes where it stopped. Once all segments are in
+        and the size (and, if given, sha256) checks out, .part is atomically renamed to <file_name>:
+        if <file_name> exists, it is complete.
+        Falls back to a single stream if the server does not do ranges.
+    """
+    def __init__(self, _segments=4, _retries=5, _backoff=1.0, _timeout=60,
+                 _chunk_size=1024 * 1024, _min_segment_size=8 * 1024 * 1024, _metrics=None):
+        """
+
+        :param _segments: max number of concurrent segments
+        :param _retries: max number of attempts per segment
+        :param _backoff: [s] wait before the first retry, doubles with every next one
+        :param _timeout: [s] connect/read timeout
+        :param _chunk_size: [bytes]
+        :param _min_segment_size: [bytes] don't split files into segments smaller than that
+        :param _metrics: metrics.Metrics to count downloaded bytes and retries in
+        """
+        self.segments = max(int(_segments), 1)
+        self.retries = max(int(_retries), 1)
+        self.backoff = _backoff
+        self.timeout = _timeout
+        self.chunk_size = _chunk_size
+        self.min_segment_size = _min_segment_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.segments)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # guards segment state and progress bar
+        self.lock = threading.Lock()
+
+        self.downloaded = _metrics.counter('downloaded_bytes_total', 'tarball bytes downloaded') \
+            if _metrics is not None else None
+        self.retries_counter = _metrics.counter('download_retries_total', 'failed download attempts retried') \
+            if _metrics is not None else None
+
+    def retry(self, _func, *args):
+        """
+            Call _func until it succeeds, backing off exponentially between attempts.
+            Only transient errors are retried: connection trouble, timeouts, 5xx and 429
+        """
+        for attempt in range(self.retries):
+            try:
+                return _func(*args)
+            except Exception as _e:
+                if (attempt == self.retries - 1) or (not transient(_e)):
+                    raise
+                print(f'{_e}, retrying in {self.backoff * 2 ** attempt:.1f} s')
+                if self.retries_counter is not None:
+                    self.retries_counter.inc()
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def probe(self, url):
+        """
+
+        :param url:
+        :return: size in bytes (None if unknown), does the server accept Range requests
+        """
+        r = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        r.raise_for_status()
+        size = r.headers.get('content-length')
+        size = int(size) if size else None
+        ranges = r.headers.get('accept-ranges', '').lower() == 'bytes'
+        return size, ranges
+
+    @staticmethod
+    def save_state(_path_state, _state):
+        path_tmp = f'{_path_state}.tmp'
+        with open(path_tmp, 'w') as _f:
+            json.dump(_state, _f)
+        os.replace(path_tmp, _path_state)
+
+    def load_state(self, url, _path_part, _path_state, _size):
+        """
+            Pick up segment progress of an interrupted download, or plan a new one
+
+        :return: state dict: {'url', 'size', 'segments': [{'start', 'end', 'done'}, ...]}
+        """
+        if os.path.exists(_path_state) and os.path.exists(_path_part):
+            try:
+                with open(_path_state) as _f:
+                    state = json.load(_f)
+                if (state['url'] == url) and (state['size'] == _size) and (os.path.getsize(_path_part) == _size):
+                    return state
+            except Exception as _e:
+                print(f'Ignoring bad download state {_path_state}: {_e}')
+
+        n = max(min(self.segments, _size // self.min_segment_size), 1)
+        bounds = [_size * i // n for i in range(n + 1)]
+        state = {'url': url, 'size': _size,
+                 'segments': [{'start': bounds[i], 'end': bounds[i + 1] - 1, 'done': 0} for i in range(n)]}
+
+        # preallocate
+        with open(_path_part, 'wb') as _f:
+            _f.truncate(_size)
+        self.save_state(_path_state, state)
+
+        return state
+
+    def fetch_segment(self, url, _path_part, _path_state, _state, _segment, _progress=None):
+        """
+            Get the rest of a segment with a single Range request
+        """
+        start, end = _segment['start'], _segment['end']
+        length = end - start + 1
+        if _segment['done'] >= length:
+            return
+
+        headers = {'Range': f"bytes={start + _segment['done']}-{end}"}
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise IOError(f'Expected 206 Partial Content for {headers["Range"]}, got {r.status_code}')
+            with open(_path_part, 'r+b') as _f:
+                _f.seek(start + _segment['done'])
+                # raw bytes as they are on the server, no transparent gunzipping
+                for chunk in r.raw.stream(self.chunk_size, decode_content=False):
+                    chunk = chunk[:length - _segment['done']]
+                    _f.write(chunk)
+                    _f.flush()
+                    with self.lock:
+                        _segment['done'] += len(chunk)
+                        if _progress is not None:
+                            _progress.next(len(chunk))
+                        self.save_state(_path_state, _state)
+                    if self.downloaded is not None:
+                        self.downloaded.inc(len(chunk))
+                    if _segment['done'] >= length:
+                        break
+
+        if _segment['done'] < length:
+            # connection ended early
+            raise requests.ConnectionError(f"Short read: got {_segment['done']} of {length} bytes starting at {start}")
+
+    def fetch_stream(self, url, _path_part, _progress=None):
+        """
+            Get the whole thing in one go, for servers that do not support ranges
+        """
+        with self.session.get(url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            with open(_path_part, 'wb') as _f:
+                for chunk in r.raw.stream(self.chunk_size, decode_content=False):
+                    _f.write(chunk)
+                    if _progress is not None:
+                        _progress.next(len(chunk))
+                    if self.downloaded is not None:
+                        self.downloaded.inc(len(chunk))
+
+    @staticmethod
+    def sha256(_path, _chunk_size=1024 * 1024):
+        h = hashlib.sha256()
+        with open(_path, 'rb') as _f:
+            for chunk in iter(lambda: _f.read(_chunk_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def download(self, url, file_name, _label=None, _sha256=None):
+        """
+
+        :param url:
+        :param file_name: where to put it
+        :param _label: show progress bar with this label
+        :param _sha256: expected sha256 hex digest, if known
+        :return: file_name
+        """
+        path_part = f'{file_name}.part'
+        path_state = f'{file_name}.part.json'
+
+        size, ranges = self.retry(self.probe, url)
+
+        _progress = None
+        if _label is not None:
+            _progress = Bar(_label, max=size) if size else Spinner(_label)
+
+        if ranges and (size is not None) and (size > 0):
+            state = self.load_state(url, path_part, path_state, size)
+            if _progress is not None:
+                _progress.next(sum(_s['done'] for _s in state['segments']))
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(state['segments'])) as pool:
+                futures = [pool.submit(self.retry, self.fetch_segment, url, path_part, path_state,
+                                       state, segment, _progress)
+                           for segment in state['segments']]
+                # re-raise whatever went wrong after all retries
+                for future in futures:
+                    future.result()
+        else:
+            self.retry(self.fetch_stream, url, path_part, _progress)
+
+        if _progress is not None:
+            _progress.finish()
+
+        if (size is not None) and (os.path.getsize(path_part) != size):
+            raise IOError(f'{url}: expected {size} bytes, got {os.path.getsize(path_part)}')
+
+        if (_sha256 is not None) and (self.sha256(path_part) != _sha256.lower()):
+            # start over next time
+            os.remove(path_part)
+            if os.path.exists(path_state):
+                os.remove(path_state)
+            raise IOError(f'{url}: sha256 mismatch')
+
+        os.replace(path_part, file_name)
+        if os.path.exists(path_state):
+            os.remove(path_state)
+
+        return file_name
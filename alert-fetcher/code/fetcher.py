@@ -1,22 +1,64 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import pymongo
+import bson
 import os
 import glob
+import io
 import inspect
 import json
 import logging
 import datetime
-import fastavro
+import math
+import multiprocessing
 import time
 import shutil
+import sys
+import queue
+import threading
 import traceback
-import requests
-from progress.bar import Bar
-from progress.spinner import Spinner
-import tarfile
 import numpy as np
 import pytz
-from numba import jit
+
+# what only some runs need (downloads, asyncio, kafka, parquet: requests, aiohttp, confluent_kafka, pyarrow)
+# is imported where it is used, to keep startup fast
+from alert_archive import AlertArchive, ArchiveWriter, index_rows
+from alert_filter import AlertFilter
+from avro_decoder import AvroDecoder, Projection, read_schema
+from batcher import Batcher
+from crossmatch import ang2pix, ang2pix_scalar
+from cutouts import FileCutoutStore, MongoCutoutStore, offload_cutouts
+from lightcurves import LightCurves, POINT_FIELDS
+from manifest import Manifest
+from metrics import Metrics
+from write_tuner import WriteTuner
+
+
+# what mongify and the db indexes cannot do without, kept whatever the avro projection
+REQUIRED_FIELDS = ('objectId', 'candid', 'candidate.ra', 'candidate.dec', 'candidate.jd')
+
+# [bytes] on top of the BSON size bound of a decoded alert: mongify adds _id and coordinates (~260 bytes),
+# plugins may add a few more fields
+DOCUMENT_SLACK = 1024
+
+# {projection key: AvroDecoder}, one set per process
+decoders = dict()
+
+
+def get_decoder(_projection=None):
+    """
+        AvroDecoder for a projection, cached so that writer schemas are only parsed once per process
+
+    :param _projection: Projection or None to keep everything
+    :return:
+    """
+    key = None if _projection is None else _projection.key()
+    if key not in decoders:
+        decoders[key] = AvroDecoder(_projection)
+    return decoders[key]
 
 
 def utc_now():
@@ -32,7 +74,6 @@ def time_stamps():
            datetime.datetime.utcnow().strftime('%Y%m%d_%H:%M:%S')
 
 
-@jit
 def deg2hms(x):
     """Transform degrees to *hours:minutes:seconds* strings.
 
@@ -52,15 +93,16 @@ def deg2hms(x):
     # ac = Angle(x, unit='degree')
     # hms = str(ac.to_string(unit='hour', sep=':', pad=True))
     # print(str(hms))
-    _h = np.floor(x * 12.0 / 180.)
-    _m = np.floor((x * 12.0 / 180. - _h) * 60.0)
-    _s = ((x * 12.0 / 180. - _h) * 60.0 - _m) * 60.0
-    hms = '{:02.0f}:{:02.0f}:{:07.4f}'.format(_h, _m, _s)
+    # plain python: faster on scalars than numpy, and nothing to JIT-compile at startup
+    _x = x * 12.0 / 180.
+    _h = math.floor(_x)
+    _m = math.floor((_x - _h) * 60.0)
+    _s = ((_x - _h) * 60.0 - _m) * 60.0
+    hms = '%02.0f:%02.0f:%07.4f' % (_h, _m, _s)
     # print(hms)
     return hms
 
 
-@jit
 def deg2dms(x):
     """Transform degrees to *degrees:arcminutes:arcseconds* strings.
 
@@ -79,20 +121,113 @@ def deg2dms(x):
     # ac = Angle(x, unit='degree')
     # dms = str(ac.to_string(unit='degree', sep=':', pad=True))
     # print(dms)
-    _d = np.floor(abs(x)) * np.sign(x)
-    _m = np.floor(np.abs(x - _d) * 60.0)
-    _s = np.abs(np.abs(x - _d) * 60.0 - _m) * 60.0
-    dms = '{:02.0f}:{:02.0f}:{:06.3f}'.format(_d, _m, _s)
+    # float sign as np.sign: -0.0 for Dec c (-1, 0), formatted as '-0'
+    _d = float(math.floor(abs(x))) * float((x > 0.0) - (x < 0.0))
+    _m = math.floor(abs(x - _d) * 60.0)
+    _s = abs(abs(x - _d) * 60.0 - _m) * 60.0
+    dms = '%02.0f:%02.0f:%06.3f' % (_d, _m, _s)
     # print(dms)
     return dms
 
 
+def radec_str_batch(ra, dec):
+    """Vectorized deg2hms/deg2dms: transform arrays of RA/Dec in degrees
+    to *hours:minutes:seconds* / *degrees:arcminutes:arcseconds* strings.
+
+    Parameters
+    ----------
+    ra : array_like
+        RA values c [0, 360).
+    dec : array_like
+        Dec values c [-90, 90].
+
+    Returns
+    -------
+    out : list
+        [hms, dms] string pairs, one per input position, identical to
+        [deg2hms(ra), deg2dms(dec)].
+
+    """
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    assert np.all((ra >= 0.0) & (ra < 360.0)), 'Bad RA value in degrees'
+    assert np.all((dec >= -90.0) & (dec <= 90.0)), 'Bad Dec value in degrees'
+
+    # same operations as in deg2hms and deg2dms, so that the results are bit-identical
+    _x = ra * 12.0 / 180.
+    _h = np.floor(_x)
+    _m = np.floor((_x - _h) * 60.0)
+    _s = ((_x - _h) * 60.0 - _m) * 60.0
+
+    _d = np.floor(np.abs(dec)) * np.sign(dec)
+    _dm = np.floor(np.abs(dec - _d) * 60.0)
+    _ds = np.abs(np.abs(dec - _d) * 60.0 - _dm) * 60.0
+
+    # formatting is the only per-element step left
+    return [['%02.0f:%02.0f:%07.4f' % hms, '%02.0f:%02.0f:%06.3f' % dms]
+            for hms, dms in zip(zip(_h.tolist(), _m.tolist(), _s.tolist()),
+                                zip(_d.tolist(), _dm.tolist(), _ds.tolist()))]
+
+
+def coordinates_batch(ra, dec, epoch):
+    """
+        Make the 'coordinates' sub-documents for a batch of alerts in one vectorized pass.
+        Output is identical to what alert_mongify produces one alert at a time
+
+    :param ra: array_like, candidate.ra [deg]
+    :param dec: array_like, candidate.dec [deg]
+    :param epoch: list, candidate.jd
+    :return: list of dicts
+    """
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+
+    radec_str = radec_str_batch(ra, dec)
+    # for GeoJSON, must be lon:[-180, 180], lat:[-90, 90] (i.e. in deg)
+    lon_geojson = (ra - 180.0).tolist()
+    # radians:
+    ra_rad = (ra * np.pi / 180.0).tolist()
+    dec_rad = (dec * np.pi / 180.0).tolist()
+    # HEALPix pixel for cross-matching
+    healpix = ang2pix(ra, dec).tolist()
+    # back to python floats for bson
+    ra = ra.tolist()
+    dec = dec.tolist()
+
+    return [{'epoch': epoch[i],
+             'radec_str': radec_str[i],
+             'radec_geojson': {'type': 'Point', 'coordinates': [lon_geojson[i], dec[i]]},
+             'radec': [ra_rad[i], dec_rad[i]],
+             'healpix': healpix[i]}
+            for i in range(len(ra))]
+
+
+class ProgressReader(object):
+    """
+        Wrap a file-like object to advance a progress bar on every read
+    """
+    def __init__(self, _fileobj, _progress, _counter=None):
+        self.fileobj = _fileobj
+        self.progress = _progress
+        # metrics.Counter of bytes read
+        self.counter = _counter
+
+    def read(self, size=-1):
+        chunk = self.fileobj.read(size)
+        if chunk:
+            self.progress.next(len(chunk))
+            if self.counter is not None:
+                self.counter.inc(len(chunk))
+        return chunk
+
+
 class Fetcher(object):
 
-    def __init__(self, _config_file):
+    def __init__(self, _config_file, _db=None):
         """
 
         :param _config_file:
+        :param _db: {'client': ..., 'db': ...} to use instead of connecting to config['database']
         """
         ''' load config data '''
         self.config = self.get_config(_config_file)
@@ -100,6 +235,14 @@ class Fetcher(object):
         ''' set up logging at init '''
         self.logger, self.logger_utc_date = self.set_up_logging(_name='fetcher', _mode='a')
 
+        # stage timings and counters, also served on a local /metrics endpoint if configured
+        self.metrics = Metrics()
+        if self.config['misc'].get('metrics_port', None) is not None:
+            port = self.metrics.serve(int(self.config['misc']['metrics_port']),
+                                      self.config['misc'].get('metrics_host', '127.0.0.1'))
+            self.logger.info(f'Serving metrics at http://{self.config["misc"].get("metrics_host", "127.0.0.1")}:'
+                             f'{port}/metrics')
+
         # make dirs if necessary:
         for _pp in ('alerts', 'tmp'):
             _path = self.config['path']['path_{:s}'.format(_pp)]
@@ -107,12 +250,31 @@ class Fetcher(object):
                 os.makedirs(_path)
                 self.logger.debug('Created {:s}'.format(_path))
 
-        ''' init db if necessary '''
-        self.init_db()
+        ''' connect to db, init it if necessary: '''
+        self.db = _db
+        if self.db is None:
+            self.connect_to_db()
+
+        # fail early on bad cutout store config
+        self.get_cutout_store()
+
+        # only send alerts that are not in db yet?
+        self.skip_existing = self.config['misc'].get('skip_existing', False)
+
+        # which alert fields to decode and store
+        self.projection = self.get_projection()
+        self.decoder = get_decoder(self.projection)
 
-        ''' connect to db: '''
-        self.db = None
-        self.connect_to_db()
+        # which alerts to store, derived fields
+        self.alert_filter = self.get_alert_filter()
+
+        # called with every batch of alerts acknowledged by db, e.g. QueryService.invalidate
+        self.listeners = []
+
+        # insert_many batch size and inserts in flight, tuned from how db copes
+        self.write_tuner = self.get_write_tuner()
+        # db's default unless configured. FetcherKafka makes it strict, FetcherArchive.backfill relaxes it
+        self.write_concern = self.get_write_concern('archive')
 
     @staticmethod
     def get_config(_config_file):
@@ -208,30 +370,36 @@ class Fetcher(object):
 
     def init_db(self):
         """
-            Initialize db if new Mongo instance
-        :return:
+            Initialize db if new Mongo instance, see connect_to_db
+        :return: was the user created?
         """
         _client = pymongo.MongoClient(username=self.config['database']['admin'],
                                       password=self.config['database']['admin_pwd'],
                                       host=self.config['database']['host'],
                                       port=self.config['database']['port'])
-        # _id: db_name.user_name
-        user_ids = [_u['_id'] for _u in _client.admin.system.users.find({}, {'_id': 1})]
+        try:
+            # _id: db_name.user_name
+            user_ids = [_u['_id'] for _u in _client.admin.system.users.find({}, {'_id': 1})]
 
-        db_name = self.config['database']['db']
-        username = self.config['database']['user']
+            db_name = self.config['database']['db']
+            username = self.config['database']['user']
 
-        # print(f'{db_name}.{username}')
-        # print(user_ids)
+            # print(f'{db_name}.{username}')
+            # print(user_ids)
 
-        if f'{db_name}.{username}' not in user_ids:
-            _client[db_name].command('createUser', self.config['database']['user'],
-                                     pwd=self.config['database']['pwd'], roles=['readWrite'])
-            print('Successfully initialized db')
+            if f'{db_name}.{username}' not in user_ids:
+                _client[db_name].command('createUser', self.config['database']['user'],
+                                         pwd=self.config['database']['pwd'], roles=['readWrite'])
+                print('Successfully initialized db')
+                return True
+            return False
+        finally:
+            _client.close()
 
-    def connect_to_db(self):
+    def connect_to_db(self, _init=True):
         """
             Connect to Robo-AO's MongoDB-powered database
+        :param _init: if authentication fails, init db (create the user) and try again?
         :return:
         """
         _config = self.config
@@ -239,7 +407,12 @@ class Fetcher(object):
             if self.logger is not None:
                 self.logger.debug('Connecting to the database at {:s}:{:d}'.
                                   format(_config['database']['host'], _config['database']['port']))
-            _client = pymongo.MongoClient(host=_config['database']['host'], port=_config['database']['port'])
+            # one pool shared by whatever uses the fetcher's connection, e.g. query_service.QueryService.
+            # credentials go with the connection handshake, no separate authenticate round trip
+            _client = pymongo.MongoClient(host=_config['database']['host'], port=_config['database']['port'],
+                                          username=_config['database']['user'], password=_config['database']['pwd'],
+                                          authSource=_config['database']['db'],
+                                          maxPoolSize=_config['database'].get('max_pool_size', 100))
             # grab main database:
             _db = _client[_config['database']['db']]
 
@@ -251,17 +424,27 @@ class Fetcher(object):
             # raise error
             raise ConnectionRefusedError
         try:
-            # authenticate
-            _db.authenticate(_config['database']['user'], _config['database']['pwd'])
+            # connect and authenticate: a single round trip
+            _client.admin.command('ping')
             if self.logger is not None:
                 self.logger.debug('Successfully authenticated with the database at {:s}:{:d}'.
                                   format(_config['database']['host'], _config['database']['port']))
-        except Exception as _e:
+        except pymongo.errors.OperationFailure as _e:
+            _client.close()
+            # new Mongo instance? the admin connection is only made then, not on every start
+            if _init and self.init_db():
+                return self.connect_to_db(_init=False)
             if self.logger is not None:
                 self.logger.error(_e)
                 self.logger.error('Authentication failed for the database at {:s}:{:d}'.
                                   format(_config['database']['host'], _config['database']['port']))
             raise ConnectionRefusedError
+        except Exception as _e:
+            if self.logger is not None:
+                self.logger.error(_e)
+                self.logger.error('Failed to connect to the database at {:s}:{:d}'.
+                                  format(_config['database']['host'], _config['database']['port']))
+            raise ConnectionRefusedError
 
         if self.logger is not None:
             self.logger.debug('Successfully connected to the database at {:s}:{:d}'.
@@ -335,26 +518,278 @@ class Fetcher(object):
             traceback.print_exc()
             print(_e)
 
-    def insert_multiple_db_entries(self, _collection=None, _db_entries=None):
+    def get_write_tuner(self):
+        """
+            WriteTuner as configured: batch size starts at config['misc']['batch_size']
+        :return:
+        """
+        misc = self.config['misc']
+        return WriteTuner(_batch_size=int(misc['batch_size']),
+                          _min_batch_size=int(misc.get('batch_size_min', 50)),
+                          _max_batch_size=int(misc.get('batch_size_max', 2000)),
+                          _step=int(misc.get('batch_size_step', 50)),
+                          _target_seconds=float(misc.get('batch_target_seconds', 1.0)),
+                          _retries=int(misc.get('write_retries', 5)),
+                          _retry_delay=float(misc.get('write_retry_delay', 0.5)),
+                          _adaptive=misc.get('adaptive_writes', True),
+                          # the logger is replaced daily, see check_logging
+                          _log=lambda _msg: self.logger.info(_msg), _metrics=self.metrics)
+
+    def get_write_concern(self, _mode='live'):
+        """
+
+        :param _mode: archive, live or backfill
+        :return: pymongo.WriteConcern for alert inserts from config['misc']['write_concern_<_mode>'],
+                 None for db's default
+        """
+        write_concern = self.config['misc'].get(f'write_concern_{_mode}', None)
+        return pymongo.WriteConcern(**write_concern) if write_concern is not None else None
+
+    def insert_multiple_db_entries(self, _collection=None, _db_entries=None, _n_bytes=None):
         """
             Insert a document _doc to collection _collection in DB.
-            It is monitored for timeout in case DB connection hangs for some reason
+            It is monitored for timeout in case DB connection hangs for some reason.
+            Goes through self.write_tuner: waits for an in-flight slot, retries on transient errors
         :param _db:
         :param _collection:
         :param _db_entries:
-        :return:
+        :param _n_bytes: BSON size of the batch if known, for write tuning
+        :return: True if db acknowledged the whole batch (duplicates count as acknowledged)
         """
         assert _collection is not None, 'Must specify collection'
         assert _db_entries is not None, 'Must specify documents'
+        if len(_db_entries) == 0:
+            # e.g. everything was already in db
+            return True
+        self.metrics.histogram('batch_documents', 'documents per insert_many',
+                               _buckets=(1, 10, 50, 100, 200, 500, 1000, 5000, 10000)).observe(len(_db_entries))
+        collection = self.db['db'][_collection]
+        if self.write_concern is not None:
+            collection = collection.with_options(write_concern=self.write_concern)
+        tic = time.time()
         try:
             # ordered=False ensures that every insert operation will be attempted
             # so that if, e.g., a document already exists, it will be simply skipped
-            self.db['db'][_collection].insert_many(_db_entries, ordered=False)
+            self.write_tuner.write(lambda: collection.insert_many(_db_entries, ordered=False),
+                                   len(_db_entries), _n_bytes)
         except pymongo.errors.BulkWriteError as bwe:
-            print(*time_stamps(), bwe.details)
+            return self.bulk_write_error_acknowledged(bwe)
         except Exception as _e:
             traceback.print_exc()
             print(_e)
+            self.metrics.counter('insert_errors_total', 'batches not acknowledged by db').inc()
+            return False
+        finally:
+            self.metrics.histogram('insert_seconds', 'insert_many latency per batch').observe(time.time() - tic)
+
+        self.metrics.counter('inserted_total', 'documents inserted into db').inc(len(_db_entries))
+
+        return True
+
+    def bulk_write_error_acknowledged(self, bwe):
+        """
+            Count what made it into db from a failed insert_many(ordered=False)
+
+        :param bwe: pymongo.errors.BulkWriteError
+        :return: True if db has the whole batch anyway
+        """
+        write_errors = bwe.details.get('writeErrors', [])
+        n_duplicates = sum(1 for _e in write_errors if _e['code'] == 11000)
+        self.metrics.counter('inserted_total', 'documents inserted into db').inc(bwe.details.get('nInserted', 0))
+        self.metrics.counter('duplicates_total', 'documents skipped as already in db').inc(n_duplicates)
+        # the batch is still in db if the only errors are duplicate keys (code 11000)
+        acknowledged = (len(bwe.details.get('writeConcernErrors', [])) == 0) and (n_duplicates == len(write_errors))
+
+        # details hold every rejected document: just summarize
+        _msg = f"insert_many: {bwe.details.get('nInserted', 0)} inserted, {n_duplicates} already in db"
+        if not acknowledged:
+            self.metrics.counter('insert_errors_total', 'batches not acknowledged by db').inc()
+            errors = [_e for _e in write_errors if _e['code'] != 11000]
+            if len(errors) > 0:
+                _msg += f", {len(errors)} failed, e.g. {errors[0]['code']}: {errors[0].get('errmsg')}"
+            for _e in bwe.details.get('writeConcernErrors', []):
+                _msg += f", write concern error {_e.get('code')}: {_e.get('errmsg')}"
+            self.logger.error(_msg)
+        else:
+            self.logger.info(_msg)
+        print(*time_stamps(), _msg)
+
+        return acknowledged
+
+    def existing_collections(self):
+        """
+
+        :return: names of collections where an alert counts as already in db
+        """
+        return [self.config['database']['collection_alerts']]
+
+    def drop_existing(self, _documents, _chunk_size=1000):
+        """
+            Leave out documents whose _id's are already in db, if self.skip_existing is set.
+            The check is a covered query on _id, so only the _id's of a batch go over the wire, not the alerts
+
+        :param _documents:
+        :param _chunk_size: max number of _id's per $in query
+        :return: documents not in db yet
+        """
+        if (not self.skip_existing) or (len(_documents) == 0):
+            return _documents
+
+        ids = [doc['_id'] for doc in _documents]
+        existing = set()
+        try:
+            with self.metrics.histogram('existing_seconds', 'time to look up which alerts of a batch are in db').time():
+                for _collection in self.existing_collections():
+                    for i in range(0, len(ids), _chunk_size):
+                        existing.update(_d['_id'] for _d in self.db['db'][_collection].find(
+                            {'_id': {'$in': ids[i:i + _chunk_size]}}, {'_id': 1}))
+        except Exception as _e:
+            # not fatal: insert_many skips duplicates anyway
+            traceback.print_exc()
+            print(_e)
+            self.logger.error(f'Failed to look up existing alerts, inserting all: {_e}')
+            return _documents
+
+        if len(existing) == 0:
+            return _documents
+
+        self.metrics.counter('duplicates_total', 'documents skipped as already in db').inc(len(existing))
+
+        return [doc for doc in _documents if doc['_id'] not in existing]
+
+    def get_cutout_store(self):
+        """
+            Where to put cutouts, according to config['misc']['cutouts']:
+            inline (keep them in alert documents), mongo (cutouts collection), or file (local directory tree)
+        :return: CutoutStore or None if inline
+        """
+        mode = self.config['misc'].get('cutouts', 'inline')
+        if mode == 'mongo':
+            return MongoCutoutStore(self.db['db'][self.config['database']['collection_cutouts']])
+        elif mode == 'file':
+            return FileCutoutStore(self.config['path']['path_cutouts'])
+        elif mode == 'inline':
+            return None
+        else:
+            raise ValueError('Config file error: cutouts must be \'inline\', \'mongo\', or \'file\'')
+
+    def store_cutouts(self, _documents):
+        """
+            Offload cutouts of documents to the cutout store, if there is one
+        :param _documents: modified in place
+        :return: True if cutouts are taken care of
+        """
+        store = self.get_cutout_store()
+        if store is None:
+            return True
+        try:
+            offload_cutouts(_documents, store)
+        except Exception as _e:
+            traceback.print_exc()
+            print(_e)
+            self.logger.error(f'Failed to store cutouts: {_e}')
+            return False
+
+        return True
+
+    def get_projection(self):
+        """
+            Alert fields to keep, from config['misc']['avro_include'] and config['misc']['avro_exclude'],
+            as dotted paths, e.g. "candidate.magpsf" or "cutoutTemplate".
+            REQUIRED_FIELDS and, if light curves are maintained, their fields are always kept
+        :return: Projection or None to keep everything
+        """
+        include = self.config['misc'].get('avro_include', None)
+        exclude = self.config['misc'].get('avro_exclude', None) or []
+        if (include is None) and (len(exclude) == 0):
+            return None
+
+        required = list(REQUIRED_FIELDS)
+        if self.config['misc'].get('objects', True):
+            required += [f'{_c}.{_f}' for _c in ('candidate', 'prv_candidates') for _f in POINT_FIELDS]
+
+        return Projection(_include=include, _exclude=exclude, _required=required)
+
+    def get_alert_filter(self):
+        """
+            Ingest-time filter and enrichment plugins from config['misc']['filter'] and config['misc']['plugins']
+        :return: AlertFilter or None if all alerts are stored as they are
+        """
+        query = self.config['misc'].get('filter', None)
+        plugins = self.config['misc'].get('plugins', None) or []
+        if (not query) and (len(plugins) == 0):
+            return None
+        return AlertFilter(_query=query, _plugins=plugins)
+
+    def filter_alerts(self, _documents, _sizes=None):
+        """
+            Apply ingest-time filter and plugins to mongified alerts, count the rejected ones
+        :param _documents:
+        :param _sizes: list of BSON sizes of _documents, updated in place to go with the documents returned
+        :return: documents to store
+        """
+        if self.alert_filter is None:
+            return _documents
+        with self.metrics.histogram('filter_seconds', 'filter and plugins time per packet or polled batch').time():
+            documents = self.alert_filter(_documents)
+        self.metrics.counter('alerts_rejected_total', 'alerts not stored: rejected by filter or plugins').inc(
+            len(_documents) - len(documents))
+        if _sizes is not None:
+            # None for documents a plugin replaced: Batcher measures those itself
+            sizes = {id(doc): size for doc, size in zip(_documents, _sizes)}
+            _sizes[:] = [sizes.get(id(doc)) for doc in documents]
+        return documents
+
+    def add_listener(self, _callback):
+        """
+            Have _callback(documents) called with every batch of alerts once db has it,
+            and _callback(None) when any number of alerts may have changed, e.g. after a bulk load merge
+        :param _callback:
+        :return:
+        """
+        self.listeners.append(_callback)
+
+    def notify_listeners(self, _documents):
+        """
+            Pass an acknowledged batch on to the listeners; their failures don't stop ingestion
+        :param _documents:
+        :return:
+        """
+        for listener in self.listeners:
+            try:
+                listener(_documents)
+            except Exception as _e:
+                traceback.print_exc()
+                self.logger.error(f'Listener failed: {_e}')
+
+    def get_lightcurves(self):
+        """
+            Per-object light curves, if config['misc']['objects'] is set
+        :return: LightCurves or None
+        """
+        if not self.config['misc'].get('objects', True):
+            return None
+        return LightCurves(self.db['db'][self.config['database']['collection_objects']])
+
+    def update_lightcurves(self, _documents):
+        """
+            Merge alerts into the light curves of their objects, if maintained
+        :param _documents:
+        :return: True if light curves are taken care of
+        """
+        lightcurves = self.get_lightcurves()
+        if lightcurves is None:
+            return True
+        try:
+            with self.metrics.histogram('objects_seconds', 'light curve update time per batch').time():
+                lightcurves.update(_documents)
+        except Exception as _e:
+            traceback.print_exc()
+            print(_e)
+            self.logger.error(f'Failed to update light curves: {_e}')
+            return False
+
+        return True
 
     @staticmethod
     def alert_mongify(alert):
@@ -382,9 +817,56 @@ class Fetcher(object):
                                                'coordinates': _radec_geojson}
         # radians:
         doc['coordinates']['radec'] = [_ra * np.pi / 180.0, _dec * np.pi / 180.0]
+        # HEALPix pixel for cross-matching, see crossmatch.CrossMatch
+        doc['coordinates']['healpix'] = ang2pix_scalar(_ra, _dec)
 
         return doc
 
+    @staticmethod
+    def alerts_mongify(alerts, _copy=True):
+        """
+            Batch version of alert_mongify: coordinates are computed for all alerts at once
+        :param alerts: list of alert records
+        :param _copy: set to False to mongify freshly decoded records in place instead of copies
+        :return: list of documents
+        """
+        docs = [dict(alert) for alert in alerts] if _copy else list(alerts)
+        if len(docs) == 0:
+            return docs
+
+        coordinates = coordinates_batch(ra=[doc['candidate']['ra'] for doc in docs],
+                                        dec=[doc['candidate']['dec'] for doc in docs],
+                                        epoch=[doc['candidate']['jd'] for doc in docs])
+
+        for doc, _coordinates in zip(docs, coordinates):
+            # candid+objectId should be a unique combination:
+            doc['_id'] = f"{doc['candid']}_{doc['objectId']}"
+            doc['coordinates'] = _coordinates
+
+        return docs
+
+    def save_metrics(self, _name, _extra=None):
+        """
+            Write metrics collected so far to <path_logs>/metrics_<_name>_<UTC time>.json.
+            Counters and histograms accumulate over the lifetime of the fetcher
+
+        :param _name: e.g. obs date
+        :param _extra: dict with anything else to put in, e.g. run parameters
+        :return: path to the summary
+        """
+        summary = {'name': _name, 'utc': datetime.datetime.utcnow().strftime('%Y%m%d_%H:%M:%S'),
+                   'metrics': self.metrics.summary()}
+        if _extra is not None:
+            summary.update(_extra)
+
+        path = os.path.join(self.config['path']['path_logs'],
+                            f'metrics_{_name}_{datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f")}.json')
+        with open(path, 'w') as f_json:
+            json.dump(summary, f_json, indent=2)
+        self.logger.info(f'Metrics summary saved to {path}')
+
+        return path
+
     def fetch(self, **kwargs):
         """
 
@@ -392,46 +874,898 @@ class Fetcher(object):
         raise NotImplementedError
 
 
+def decode_avro(_data, _projection=None, _index=False):
+    """
+        Read and mongify all alerts in an avro packet. Runs in the worker processes of IngestPipeline
+
+    :param _data: path to avro file or its raw contents
+    :param _projection: Projection, fields to keep
+    :param _index: also return the packet's alert_archive.index_rows?
+    :return: list of documents ready to be inserted into db, bounds on their BSON sizes,
+             decode time [s], mongify time [s], index rows or None
+    """
+    tic = time.time()
+    if not isinstance(_data, bytes):
+        with open(_data, 'rb') as f_avro:
+            _data = f_avro.read()
+    sizes = []
+    if not _index:
+        records = get_decoder(_projection).records(io.BytesIO(_data), _sizes=sizes)
+        rows = None
+    else:
+        unpruned = []
+        records = get_decoder(_projection).records(io.BytesIO(_data), _unpruned=unpruned, _sizes=sizes)
+        # before mongify touches them
+        rows = index_rows(_data, unpruned)
+    toc = time.time()
+    documents = Fetcher.alerts_mongify(records, _copy=False)
+
+    return documents, sizes, toc - tic, time.time() - toc, rows
+
+
+def process_pool(_workers):
+    """
+        Pool of decoder processes. They are started from a fork server (spawned where there is none), not forked:
+        by the time a pipeline is up, the fetcher holds a MongoClient with its monitor threads,
+        and a forked child would inherit their locks in whatever state they were in.
+        Python < 3.7 cannot pick the start method of a pool, it gets the platform's default there
+
+    :param _workers: number of processes
+    :return: concurrent.futures.ProcessPoolExecutor
+    """
+    if sys.version_info < (3, 7):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=_workers)
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return concurrent.futures.ProcessPoolExecutor(max_workers=_workers,
+                                                  mp_context=multiprocessing.get_context(method))
+
+
+class IngestPipeline(object):
+    """
+        Decode and mongify avro packets in a pool of worker processes,
+        insert the resulting documents into db from writer thread(s).
+
+        Decoded packets are collected in submission order and put into a bounded queue in batches,
+        so batches are written in the same order as the packets were submitted
+        (strictly so with a single writer) and the producer blocks when the writers fall behind.
+    """
+    def __init__(self, _fetcher, _workers=4, _writers=1, _queue_size=8):
+        """
+
+        :param _fetcher: Fetcher instance that owns the db connection
+        :param _workers: number of decoder processes
+        :param _writers: number of writer threads
+        :param _queue_size: max number of decoded batches waiting to be written
+        """
+        self.fetcher = _fetcher
+
+        self.pool = process_pool(_workers)
+        # keep a bounded number of packets in flight so that we don't read the whole night into memory
+        self.max_pending = 2 * _workers
+        self.pending = collections.deque()
+
+        self.queue = queue.Queue(maxsize=_queue_size)
+        self.writers = [threading.Thread(target=self.write, name=f'writer-{i}', daemon=True)
+                        for i in range(_writers)]
+        for writer in self.writers:
+            writer.start()
+
+        # full batches go to the writers, blocking if they are behind
+        self.batcher = _fetcher.make_batcher(
+            lambda _documents, _sources, _n_bytes: self.queue.put((_documents, _sources, _n_bytes)))
+        # partial batches go out on time even while no packets come in
+        self.batcher.start_timer()
+        # writers take turns as the tuner allows
+        _fetcher.write_tuner.set_max_in_flight(_writers)
+
+        self.queue_depth = _fetcher.metrics.gauge('queue_depth', 'batches waiting to be written')
+        self.pending_depth = _fetcher.metrics.gauge('pending_decodes', 'avro packets submitted for decoding')
+
+    def submit(self, _data, _member=None):
+        """
+            Queue an avro packet for decoding
+
+        :param _data: path to avro file or its raw contents
+        :param _member: name of the avro packet
+        :return:
+        """
+        self.pending.append((self.pool.submit(decode_avro, _data, self.fetcher.projection,
+                                              self.fetcher.archive is not None), _member, _data))
+        self.pending_depth.set(len(self.pending))
+
+        while len(self.pending) >= self.max_pending:
+            self.collect(*self.pending.popleft())
+
+    def collect(self, _future, _member=None, _data=None):
+        """
+            Add decoded documents to the current batch, hand the batch over to the writers once full
+
+        :param _future:
+        :param _member: name of the avro packet
+        :param _data: the avro packet, path or raw contents
+        :return:
+        """
+        try:
+            documents, sizes, t_decode, t_mongify, rows = _future.result()
+        except Exception as _e:
+            print(_e)
+            traceback.print_exc()
+            self.fetcher.n_failed += 1
+            self.fetcher.metrics.counter('packets_failed_total', 'avro packets that failed to ingest').inc()
+            return
+
+        self.fetcher.metrics.histogram('decode_seconds',
+                                       'avro decode time per packet or polled batch').observe(t_decode)
+        self.fetcher.metrics.histogram('mongify_seconds', 'mongify time per packet or polled batch').observe(t_mongify)
+        self.fetcher.metrics.counter('alerts_total', 'alerts decoded').inc(len(documents))
+        if rows is not None:
+            self.fetcher.archive_packet(_data, _member, rows)
+        documents = self.fetcher.filter_alerts(documents, sizes)
+
+        if self.fetcher.manifest is not None:
+            self.fetcher.manifest.expect(_member, len(documents))
+
+        self.batcher.add(documents, [_member] * len(documents), sizes)
+        self.fetcher.n_alerts += len(documents)
+        self.queue_depth.set(self.queue.qsize())
+
+    def write(self):
+        """
+            Writer thread: insert batches into db until told to stop
+        :return:
+        """
+        while True:
+            batch = self.queue.get()
+            self.queue_depth.set(self.queue.qsize())
+            try:
+                if batch is None:
+                    return
+                self.fetcher.insert_batch(*batch)
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """
+            Wait for all submitted packets to be decoded and written, then shut down workers and writers
+        :return:
+        """
+        while len(self.pending) > 0:
+            self.collect(*self.pending.popleft())
+        self.pending_depth.set(0)
+
+        self.batcher.close()
+
+        for _ in self.writers:
+            self.queue.put(None)
+        for writer in self.writers:
+            writer.join()
+
+        self.pool.shutdown()
+
+
 class FetcherKafka(Fetcher):
     """
         Fetch ZTF alerts from Kafka
     """
-    def __init__(self, _config_file):
+    def __init__(self, _config_file, _transport=None, _db=None):
         """
 
         :param _config_file:
+        :param _transport: kafka_transport.Transport to consume from. Connect to config['kafka'] if None
+        :param _db: see Fetcher
         """
 
         ''' initialize super class '''
-        super(FetcherKafka, self).__init__(_config_file=_config_file)
+        super(FetcherKafka, self).__init__(_config_file=_config_file, _db=_db)
 
-    def fetch(self, **kwargs):
-        pass
+        self.transport = _transport
+        # live alerts cannot be fetched again once committed past: wait for db to make them durable
+        self.write_concern = self.get_write_concern('live')
+
+        # number of messages to poll at once = number of records to insert to db: self.write_tuner.batch_size
+        self.poll_timeout = float(self.config['kafka'].get('poll_timeout', 1.0))
+        # max number of polled batches waiting to be written before the consumer pauses
+        self.queue_size = int(self.config['kafka'].get('queue_size', 4))
+        # attempts at writing a batch before it goes to the dead-letter collection and the consumer moves on
+        self.write_attempts = max(int(self.config['kafka'].get('write_attempts', 5)), 1)
+
+        # set to have the writer stop after the batch in hand
+        self.stop = threading.Event()
+
+        # offsets of batches acknowledged by db, to be committed by the consumer
+        self.acked = queue.Queue()
+        self.n_alerts = 0
+
+    def make_transport(self):
+        """
+            Connect to the Kafka cluster from config
+        :return:
+        """
+        conf = {'bootstrap.servers': self.config['kafka']['bootstrap.servers'],
+                'group.id': self.config['kafka']['group'],
+                'default.topic.config': self.config['kafka']['default.topic.config'],
+                # we commit ourselves once db has the alerts
+                'enable.auto.commit': False}
+        from kafka_transport import ConfluentKafkaTransport
+        return ConfluentKafkaTransport(conf)
+
+    def write_batch(self, _documents):
+        """
+            Store a batch, up to self.write_attempts times
+
+        :param _documents:
+        :return: True if db acknowledged it
+        """
+        for attempt in range(self.write_attempts):
+            if self.stop.is_set():
+                return False
+            if attempt > 0:
+                self.logger.error(f'Failed to insert batch, retry {attempt}/{self.write_attempts - 1}')
+                time.sleep(self.poll_timeout)
+                self.check_db_connection()
+            # light curves before alerts: an alert in db always has its light curve, see drop_existing
+            if self.store_cutouts(_documents) and \
+                    self.update_lightcurves(_documents) and \
+                    self.insert_multiple_db_entries(_collection=self.config['database']['collection_alerts'],
+                                                    _db_entries=_documents):
+                return True
+        return False
+
+    def dead_letter(self, _documents):
+        """
+            Set aside a batch that could not be written, for the consumer to commit past it.
+            Goes to config['database']['collection_dead_letter'] or, if db does not take it either,
+            to a BSON file in config['path']['path_tmp']
+
+        :param _documents:
+        :return:
+        """
+        self.metrics.counter('dead_letter_total', 'alerts set aside after failing to be written').inc(
+            len(_documents))
+        collection = self.config['database'].get('collection_dead_letter', 'dead_letter')
+        try:
+            self.db['db'][collection].insert_many(_documents, ordered=False)
+            self.logger.error(f'Moved batch of {len(_documents)} alerts to {collection}')
+            return
+        except pymongo.errors.BulkWriteError:
+            # duplicates: set aside before
+            return
+        except Exception as _e:
+            print(_e)
+            self.logger.error(f'Failed to move batch to {collection}: {_e}')
+
+        path = os.path.join(self.config['path']['path_tmp'],
+                            f'dead_letter-{int(time.time() * 1000)}-{_documents[0]["_id"]}.bson')
+        with open(path, 'wb') as f:
+            for doc in _documents:
+                f.write(bson.BSON.encode(doc))
+        self.logger.error(f'Saved batch of {len(_documents)} alerts to {path}')
+
+    def dead_letter_message(self, _message, _error):
+        """
+            Set aside a raw Kafka message that could not be decoded, see dead_letter
+
+        :param _message: kafka_transport.Message
+        :param _error: exception decoding it raised
+        :return:
+        """
+        self.dead_letter([{'_id': f'{_message.topic}-{_message.partition}-{_message.offset}',
+                           'topic': _message.topic, 'partition': _message.partition, 'offset': _message.offset,
+                           'value': bson.Binary(_message.value), 'error': f'{type(_error).__name__}: {_error}'}])
+
+    def write(self, _queue):
+        """
+            Writer thread: insert polled batches into db, setting aside those db would not take,
+            and pass their offsets on to be committed
+
+        :param _queue: queue of (documents, offsets) tuples, None to stop
+        :return:
+        """
+        while not self.stop.is_set():
+            try:
+                item = _queue.get(timeout=self.poll_timeout)
+            except queue.Empty:
+                continue
+            self.metrics.gauge('queue_depth', 'batches waiting to be written').set(_queue.qsize())
+            if item is None:
+                return
+            documents, offsets = item
+
+            new = self.drop_existing(documents)
+            if len(new) > 0:
+                print(f'inserting batch')
+                self.logger.info(f'inserting batch')
+                if self.write_batch(new):
+                    self.notify_listeners(new)
+                elif self.stop.is_set():
+                    # offsets stay uncommitted, the batch is consumed again next time
+                    return
+                else:
+                    self.dead_letter(new)
+
+            self.n_alerts += len(documents)
+            self.acked.put(offsets)
+
+    def commit_acked(self, _transport):
+        """
+            Commit offsets of all batches acknowledged by db so far
+        :param _transport:
+        :return:
+        """
+        offsets = dict()
+        while not self.acked.empty():
+            offsets.update(self.acked.get())
+        if len(offsets) > 0:
+            _transport.commit(offsets)
+
+    def fetch(self, _obs_date=None, _topics=None, _idle_timeout=None):
+        """
+            Consume alerts until interrupted (or until no new messages arrive for _idle_timeout seconds)
+
+        :param _obs_date: used to make topic name from config['kafka']['topic'] if _topics not set
+        :param _topics: list of topics to subscribe to
+        :param _idle_timeout: [s] stop if no messages arrive for this long
+        :return:
+        """
+        if _topics is None:
+            assert _obs_date is not None, 'must specify obs date or topics'
+            _topics = [self.config['kafka']['topic'].format(date=_obs_date)]
+
+        transport = self.transport if self.transport is not None else self.make_transport()
+        transport.subscribe(_topics)
+
+        batches = queue.Queue(maxsize=self.queue_size)
+        self.stop.clear()
+        writer = threading.Thread(target=self.write, args=(batches,), name='writer', daemon=True)
+        writer.start()
+
+        queue_depth = self.metrics.gauge('queue_depth', 'batches waiting to be written')
+        paused_partitions = self.metrics.gauge('paused_partitions', 'partitions paused for backpressure')
+
+        paused = []
+        t_last_message = time.time()
+
+        try:
+            while True:
+                self.check_logging()
+                self.commit_acked(transport)
+
+                # backpressure: stop fetching from brokers while the writer is behind
+                if (len(paused) == 0) and batches.full():
+                    paused = transport.assignment()
+                    transport.pause(paused)
+                    self.logger.info(f'Writer is behind, paused {len(paused)} partitions')
+                    paused_partitions.set(len(paused))
+                elif (len(paused) > 0) and (batches.qsize() <= self.queue_size // 2):
+                    transport.resume(paused)
+                    self.logger.info(f'Resumed {len(paused)} partitions')
+                    paused = []
+                    paused_partitions.set(0)
+
+                # keep polling while paused: that is how consumer stays in the group
+                messages = transport.poll(self.write_tuner.batch_size, self.poll_timeout)
+
+                if len(messages) == 0:
+                    if (len(paused) == 0) and (_idle_timeout is not None) and \
+                            (time.time() - t_last_message > _idle_timeout) and batches.empty():
+                        break
+                    continue
+                t_last_message = time.time()
+
+                tic = time.time()
+                records = []
+                offsets = dict()
+                for message in messages:
+                    try:
+                        records.extend(self.decoder.records(io.BytesIO(message.value)))
+                    except Exception as _e:
+                        self.logger.exception(f'Failed to decode message {message.offset} '
+                                              f'from {message.topic}:{message.partition}')
+                        self.metrics.counter('packets_failed_total', 'avro packets that failed to ingest').inc()
+                        # set aside before its offset can be committed
+                        self.dead_letter_message(message, _e)
+                    # commit what comes after
+                    offsets[(message.topic, message.partition)] = message.offset + 1
+                toc = time.time()
+                self.metrics.histogram('decode_seconds', 'avro decode time per packet or polled batch').observe(
+                    toc - tic)
+
+                try:
+                    documents = self.alerts_mongify(records)
+                except Exception:
+                    # e.g. bad coordinates in one of the alerts: fall back to one at a time
+                    self.logger.exception('Failed to mongify polled batch, retrying one alert at a time')
+                    documents = []
+                    for record in records:
+                        try:
+                            documents.append(self.alert_mongify(record))
+                        except Exception as _e:
+                            self.logger.error(f'Failed to mongify {record.get("candid")}: {_e}')
+                self.metrics.histogram('mongify_seconds', 'mongify time per packet or polled batch').observe(
+                    time.time() - toc)
+                self.metrics.counter('alerts_total', 'alerts decoded').inc(len(documents))
+                documents = self.filter_alerts(documents)
+
+                batches.put((documents, offsets))
+                queue_depth.set(batches.qsize())
+
+        except KeyboardInterrupt:
+            # user ctrl-c'ed
+            self.logger.error('User exited the fetcher.')
+
+        finally:
+            # finish writing what's been polled, commit, and leave the group.
+            # if the writer is that far behind, stop it after the batch in hand instead:
+            # what is left in the queue is not committed and gets consumed again next time
+            try:
+                batches.put_nowait(None)
+            except queue.Full:
+                self.stop.set()
+            writer.join()
+            self.commit_acked(transport)
+            transport.close()
+            self.logger.info(f'Ingested {self.n_alerts} alerts from {_topics}')
+            self.save_metrics('kafka', {'topics': _topics, 'n_alerts': self.n_alerts,
+                                        'writes': self.write_tuner.stats()})
 
 
 class FetcherArchive(Fetcher):
     """
         Fetch ZTF alerts from the archive
     """
-    def __init__(self, _config_file):
+    def __init__(self, _config_file, _db=None):
         """
 
         :param _config_file:
+        :param _db: see Fetcher
         """
 
         ''' initialize super class '''
-        super(FetcherArchive, self).__init__(_config_file=_config_file)
+        super(FetcherArchive, self).__init__(_config_file=_config_file, _db=_db)
 
         ''' db stuff '''
-        # number of records to insert to db
-        self.batch_size = int(self.config['misc']['batch_size'])
-        self.documents = []
+        # number of records to insert to db: self.write_tuner.batch_size
+        # accumulates documents across avro packets, set up in start_ingest
+        self.batcher = None
+        self.n_alerts = 0
+        # number of avro packets that failed to ingest
+        self.n_failed = 0
+
+        # per-night record of what is already in db
+        self.manifest = None
+
+        # decode in a pool of worker processes, write from separate thread(s)?
+        self.workers = int(self.config['misc'].get('workers', 1))
+        self.writers = int(self.config['misc'].get('writers', 1))
+        self.queue_size = int(self.config['misc'].get('queue_size', 8))
+        self.pipeline = None
+
+        # collection to insert alerts into: alerts collection or, when bulk-loading, a staging one
+        self.collection = self.config['database']['collection_alerts']
+        # number of indices to build concurrently
+        self.index_builders = max(int(self.config['misc'].get('index_builders', 1)), 1)
+
+        # columnar copy of candidates/prv_candidates, if asked for
+        self.exporter = None
+
+        # night packed into a segment file with an index, if asked for: alert_archive.ArchiveWriter
+        self.archive = None
+
+        # tarballs are downloaded in concurrent segments, with resume and retries, see get_downloader
+        self.downloader = None
+        # stats of the last Batcher
+        self.batching = None
+
+        # timing
+        self.t_start = None
+        self.t_first_insert = None
+
+    def get_downloader(self):
+        """
+            Set up the downloader on first use: replaying archived nights does not need requests
+        :return: Downloader
+        """
+        if self.downloader is None:
+            from downloader import Downloader
+            self.downloader = Downloader(_segments=self.config['misc'].get('download_segments', 4),
+                                         _retries=self.config['misc'].get('download_retries', 5),
+                                         _metrics=self.metrics)
+        return self.downloader
+
+    def ingest_avro(self, f_avro, _member=None):
+        """
+            Read alerts from an avro file, mongify them and add them to the current batch
+        :param f_avro: file-like object opened in binary mode
+        :param _member: name of the avro packet, to keep track of it in manifest
+        :return: number of alerts to be stored
+        """
+        sizes = []
+        with self.metrics.histogram('decode_seconds', 'avro decode time per packet or polled batch').time():
+            if self.archive is None:
+                records = self.decoder.records(f_avro, _sizes=sizes)
+            else:
+                data = f_avro.read()
+                unpruned = []
+                records = self.decoder.records(io.BytesIO(data), _unpruned=unpruned, _sizes=sizes)
+                self.archive_packet(data, _member, index_rows(data, unpruned))
+        with self.metrics.histogram('mongify_seconds', 'mongify time per packet or polled batch').time():
+            documents = self.alerts_mongify(records, _copy=False)
+        self.metrics.counter('alerts_total', 'alerts decoded').inc(len(documents))
+        documents = self.filter_alerts(documents, sizes)
+        n_alerts = len(documents)
+
+        if self.manifest is not None:
+            self.manifest.expect(_member, n_alerts)
+
+        # inserts full batches as it goes
+        self.batcher.add(documents, [_member] * n_alerts, sizes)
+        self.n_alerts += n_alerts
+
+        return n_alerts
+
+    def archive_packet(self, _data, _member, _rows):
+        """
+            Put an avro packet into the night's archive
+
+        :param _data: path to avro file or its raw contents
+        :param _member: name of the avro packet
+        :param _rows: see alert_archive.index_rows
+        :return:
+        """
+        if not isinstance(_data, bytes):
+            with open(_data, 'rb') as f_avro:
+                _data = f_avro.read()
+        self.archive.append(_data, _member, _rows)
+
+    def get_archive_path(self, _obs_date):
+        """
+
+        :param _obs_date:
+        :return: path of the night's archive, without extension
+        """
+        return os.path.join(self.config['path']['path_alerts'], f'{_obs_date}')
+
+    def ingest_archive(self, _path, _skip=()):
+        """
+            Replay a night from its archive
+
+        :param _path: archive path, see get_archive_path
+        :param _skip: names of avro packets to skip, e.g. those already in db
+        :return:
+        """
+        archive = AlertArchive(_path)
+        self.start_ingest()
+        for member, packet in archive.packets():
+            # slices of the archive's memory map must be let go of before it is closed
+            with packet:
+                if member in _skip:
+                    continue
+                data = bytes(packet)
+            try:
+                self.ingest(data, member)
+            except Exception as _e:
+                print(_e)
+                traceback.print_exc()
+                self.n_failed += 1
+                continue
+        self.finish_ingest()
+        archive.close()
+
+    def make_batcher(self, _flush):
+        """
+            Batcher bounded as configured
+
+        :param _flush: callable(documents, sources, BSON size) that takes a full batch
+        :return:
+        """
+        return Batcher(_flush, _max_documents=lambda: self.write_tuner.batch_size,
+                       _max_bytes=int(self.config['misc'].get('batch_max_bytes', 32 * 1024 * 1024)),
+                       _max_age=self.config['misc'].get('batch_max_age', None), _slack=DOCUMENT_SLACK)
+
+    def start_ingest(self):
+        """
+            Spin up decoder processes and writer threads if configured to
+        :return:
+        """
+        if self.workers > 1:
+            self.pipeline = IngestPipeline(self, _workers=self.workers, _writers=self.writers,
+                                           _queue_size=self.queue_size)
+        else:
+            self.write_tuner.set_max_in_flight(1)
+            self.batcher = self.make_batcher(self.insert_batch)
+            # partial batches go out on time even while no packets come in, e.g. the download stalls
+            self.batcher.start_timer()
+
+    def ingest(self, _data, _member=None):
+        """
+            Ingest an avro packet: in the worker pool if there is one, in-process otherwise
+
+        :param _data: path to avro file or its raw contents
+        :param _member: name of the avro packet, file name by default
+        :return:
+        """
+        if _member is None:
+            _member = os.path.basename(_data)
+
+        if (self.exporter is not None) and (self.exporter.schemas is None):
+            # type the exported tables from the first packet's schema
+            try:
+                self.exporter.set_schema(read_schema(_data))
+            except (ValueError, EOFError, KeyError, IndexError):
+                # not a valid avro file, left to ingest to report
+                pass
+
+        if self.pipeline is not None:
+            self.pipeline.submit(_data, _member)
+        elif isinstance(_data, bytes):
+            self.ingest_avro(io.BytesIO(_data), _member)
+        else:
+            with open(_data, 'rb') as f_avro:
+                self.ingest_avro(f_avro, _member)
+
+    def finish_ingest(self):
+        """
+            Insert whatever is left and wait for all pending writes to complete
+        :return:
+        """
+        if self.pipeline is not None:
+            batcher = self.pipeline.batcher
+            self.pipeline.close()
+            self.pipeline = None
+        else:
+            # stuff left in the last batch?
+            batcher = self.batcher
+            self.batcher.close()
+            self.batcher = None
+
+        self.batching = batcher.metrics()
+        self.logger.info(f'Batching: {json.dumps(self.batching)}')
+        self.logger.info(f'Writes: {json.dumps(self.write_tuner.stats())}')
+
+    def insert_batch(self, _documents, _sources=None, _n_bytes=None):
+        """
+            Insert a batch of documents into the alerts collection,
+            record avro packets that are now completely in db in manifest
+        :param _documents:
+        :param _sources: avro packet each document came from
+        :param _n_bytes: BSON size of the batch, if known
+        :return:
+        """
+        documents = self.drop_existing(_documents)
+        _msg = f'inserting batch of {len(documents)}'
+        if len(documents) < len(_documents):
+            _msg += f' ({len(_documents) - len(documents)} already in db)'
+        print(_msg)
+        self.logger.info(_msg)
+        # light curves before alerts: an alert in db always has its light curve, see drop_existing
+        acknowledged = self.store_cutouts(documents) and \
+            self.update_lightcurves(documents) and \
+            self.insert_multiple_db_entries(_collection=self.collection, _db_entries=documents,
+                                            _n_bytes=_n_bytes if len(documents) == len(_documents) else None)
+
+        self.record_batch(_documents, _sources, acknowledged)
+
+    def existing_collections(self):
+        """
+            When bulk-loading, an alert may already be in staging (interrupted run) or in alerts
+        :return:
+        """
+        return list(dict.fromkeys([self.collection, self.config['database']['collection_alerts']]))
+
+    def record_batch(self, _documents, _sources, _acknowledged):
+        """
+            Bookkeeping after a batch has been written: manifest, parquet export, listeners, time to first insert
+        :param _documents:
+        :param _sources: avro packet each document came from
+        :param _acknowledged: does db have the whole batch?
+        :return:
+        """
+        if _acknowledged and (self.manifest is not None) and (_sources is not None):
+            self.manifest.ack(collections.Counter(_sources))
+
+        if _acknowledged and (self.exporter is not None):
+            self.exporter.add(_documents)
+
+        if _acknowledged:
+            self.notify_listeners(_documents)
+
+        if self.t_first_insert is None:
+            self.t_first_insert = time.time()
+            self.logger.info(f'Time to first insert: {self.t_first_insert - self.t_start:.2f} s')
+
+    @contextlib.contextmanager
+    def open_stream(self, url):
+        """
+            GET url as a stream
+
+        :param url:
+        :return: context manager yielding (raw file-like object, content length or None)
+        """
+        import requests
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            yield r.raw, r.headers.get('content-length')
+
+    def ingest_stream(self, url, _obs_date, _path_date=None, _skip=()):
+        """
+            Read alert tarball members while it is being downloaded
+            and feed them straight into db without extracting the whole thing to disk first
+
+        :param url: tarball url
+        :param _obs_date: obs date, used to label the progress bar
+        :param _path_date: if set, save extracted avro packets there
+        :param _skip: names of avro packets to skip, e.g. those already in db
+        :return:
+        """
+        if (_path_date is not None) and (not os.path.exists(_path_date)):
+            os.makedirs(_path_date)
+
+        from progress.bar import Bar
+        from progress.spinner import Spinner
+        import tarfile
+
+        self.start_ingest()
+
+        with self.open_stream(url) as (raw, size):
+            if size:
+                p = Bar(_obs_date, max=int(size))
+            else:
+                p = Spinner(_obs_date)
+
+            downloaded = self.metrics.counter('downloaded_bytes_total', 'tarball bytes downloaded')
+            # reading a member = downloading and gunzipping it
+            read_seconds = self.metrics.histogram('stream_read_seconds', 'time to read a tarball member off the wire')
+
+            # 'r|gz' is the non-seekable streaming mode: members come in the order they were packed
+            with tarfile.open(fileobj=ProgressReader(raw, p, downloaded), mode='r|gz') as tf:
+                for member in tf:
+                    if (not member.isfile()) or (not member.name.endswith('.avro')):
+                        continue
+                    if os.path.basename(member.name) in _skip:
+                        continue
+                    try:
+                        # must be consumed before moving on to the next member
+                        with read_seconds.time():
+                            data = tf.extractfile(member).read()
+
+                        if _path_date is not None:
+                            with open(os.path.join(_path_date, os.path.basename(member.name)), 'wb') as _f:
+                                _f.write(data)
+
+                        self.ingest(data, os.path.basename(member.name))
+                    except Exception as _e:
+                        print(_e)
+                        traceback.print_exc()
+                        self.n_failed += 1
+                        self.metrics.counter('packets_failed_total', 'avro packets that failed to ingest').inc()
+                        continue
+
+            p.finish()
+
+        self.finish_ingest()
+
+        self.logger.info(f'Streamed {self.n_alerts} alerts for {_obs_date} in {time.time() - self.t_start:.2f} s')
+
+    def create_indices(self, _collection=None):
+        """
+            Create indices listed in config['database']['indexes'],
+            up to config['misc']['index_builders'] of them concurrently
+        :param _collection: collection name, alerts collection by default
+        :return: {index name: build time [s]}
+        """
+        if _collection is None:
+            _collection = self.config['database']['collection_alerts']
+
+        def build(_index):
+            # everything other than keys goes to create_index as is, e.g. name or background
+            options = {k: v for k, v in _index.items() if k != 'keys'}
+            tic = time.time()
+            name = self.db['db'][_collection].create_index([tuple(_k) for _k in _index['keys']], **options)
+            return name, time.time() - tic
+
+        indexes = self.config['database']['indexes']
+        print(f'Creating {len(indexes)} indices on {_collection}')
+        tic = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.index_builders) as pool:
+            timings = dict(pool.map(build, indexes))
+
+        for name, t in timings.items():
+            self.logger.info(f'Index {name} on {_collection}: {t:.2f} s')
+            self.metrics.histogram('index_seconds', 'index build time').observe(t)
+        self.logger.info(f'Created {len(timings)} indices on {_collection} in {time.time() - tic:.2f} s')
+
+        return timings
+
+    def get_staging(self, _obs_date):
+        """
+
+        :param _obs_date:
+        :return: name of the staging collection to bulk-load the night into
+        """
+        return f"{self.config['database']['collection_alerts']}_staging_{_obs_date}"
+
+    def merge_staging(self, _staging):
+        """
+            Move bulk-loaded alerts into the alerts collection:
+            if the latter is empty, index the staging collection and rename it into place,
+            otherwise merge staging into it server-side and drop staging
+
+        :param _staging: name of the staging collection
+        :return:
+        """
+        _db = self.db['db']
+        target = self.config['database']['collection_alerts']
+
+        if _staging not in _db.list_collection_names():
+            return
+
+        if (target not in _db.list_collection_names()) or (_db[target].estimated_document_count() == 0):
+            print(f'Renaming {_staging} to {target}')
+            self.create_indices(_staging)
+            _db[_staging].rename(target, dropTarget=True)
+        else:
+            print(f'Merging {_staging} into {target}')
+            tic = time.time()
+            # already existing alerts are kept as is, just like with insert_many(ordered=False)
+            _db[_staging].aggregate([{'$merge': {'into': target, 'on': '_id',
+                                                 'whenMatched': 'keepExisting', 'whenNotMatched': 'insert'}}])
+            self.logger.info(f'Merged {_staging} into {target} in {time.time() - tic:.2f} s')
+            self.metrics.histogram('merge_seconds', 'staging merge time').observe(time.time() - tic)
+            _db[_staging].drop()
+            self.create_indices()
+
+    def get_manifest(self, _obs_date):
+        """
+
+        :param _obs_date:
+        :return: Manifest for the night
+        """
+        return Manifest(self.db['db'][self.config['database']['collection_manifest']], _obs_date)
+
+    def get_url(self, _obs_date):
+        """
+
+        :param _obs_date:
+        :return: archive url of the night's tarball
+        """
+        return os.path.join(self.config['misc']['ztf_public_archive'], f'ztf_public_{_obs_date}.tar.gz')
 
-    def fetch(self, _obs_date=None, _demo=False):
+    def get_file_name(self, _obs_date):
         """
 
+        :param _obs_date:
+        :return: where the night's tarball goes
+        """
+        return os.path.join(self.config['path']['path_alerts'], f'{_obs_date}.tar.gz')
+
+    def verify(self, _obs_date):
+        """
+            Compare manifest counts for the night with what is in the alerts collection
+        :param _obs_date:
+        :return:
+        """
+        return self.get_manifest(_obs_date).verify(self.db['db'][self.config['database']['collection_alerts']])
+
+    def fetch(self, _obs_date=None, _demo=False, _stream=None, _keep=None, _reingest=False, _bulk_load=None,
+              _parquet=None, _skip_existing=None, _archive=None):
+        """
+            Fetch and ingest alerts from a night. Resumes from where the previous run stopped,
+            skipping avro packets already recorded in the manifest
+
         :param _obs_date:
         :param _demo:
+        :param _stream: stream tarball members into db while downloading? defaults to config['misc']['stream']
+        :param _keep: also write avro packets to disk when streaming? defaults to config['misc']['keep_alerts'],
+                      off unless set: not writing them is what keeps disk usage down
+        :param _reingest: ignore manifest and ingest everything again?
+        :param _bulk_load: load into an unindexed staging collection, then index and merge it into alerts?
+                           defaults to config['misc']['bulk_load']
+        :param _parquet: also write candidates/prv_candidates to a parquet store at config['path']['path_parquet']?
+                         defaults to config['misc']['parquet']
+        :param _skip_existing: look up which alerts are in db already and only send the new ones?
+                               defaults to config['misc']['skip_existing']
+        :param _archive: pack the night into a segment file with an index (see alert_archive) next to path_alerts,
+                         or replay it from there if it's complete? defaults to config['misc']['archive']
         :return:
         """
         assert _obs_date is not None, 'must specify obs date'
@@ -448,93 +1782,166 @@ class FetcherArchive(Fetcher):
             if connected:
                 # fetch
                 if not _demo:
-                    url = os.path.join(self.config['misc']['ztf_public_archive'], f'ztf_public_{_obs_date}.tar.gz')
+                    url = self.get_url(_obs_date)
                 else:
                     # fetch demo from skipper
                     _obs_date = self.config['misc']['demo']['date']
                     url = self.config['misc']['demo']['url']
 
-                file_name = os.path.join(self.config['path']['path_alerts'], f'{_obs_date}.tar.gz')
+                file_name = self.get_file_name(_obs_date)
+
+                path_date = os.path.join(self.config['path']['path_alerts'], f'{_obs_date}')
+
+                # stream tar members straight into db while downloading?
+                stream = self.config['misc'].get('stream', False) if _stream is None else _stream
+                # keep extracted avro packets on disk? (only matters in streaming mode)
+                keep = self.config['misc'].get('keep_alerts', False) if _keep is None else _keep
+                # load into an unindexed staging collection first?
+                bulk_load = self.config['misc'].get('bulk_load', False) if _bulk_load is None else _bulk_load
+                # export to parquet next to loading into db?
+                parquet = self.config['misc'].get('parquet', False) if _parquet is None else _parquet
+                # filter out alerts already in db before sending them?
+                self.skip_existing = self.config['misc'].get('skip_existing', False) if _skip_existing is None \
+                    else _skip_existing
+                # segment file + index instead of a file per alert?
+                archive = self.config['misc'].get('archive', False) if _archive is None else _archive
+                archive_path = self.get_archive_path(_obs_date)
+
+                self.t_start = time.time()
+                self.t_first_insert = None
+                self.n_alerts = 0
+                self.n_failed = 0
+                self.batching = None
+
+                self.manifest = self.get_manifest(_obs_date)
+                if _reingest:
+                    self.manifest.reset()
+                elif self.manifest.is_complete():
+                    print(f'{_obs_date} already ingested')
+                    self.logger.info(f'{_obs_date} already ingested')
+                    return
+
+                if bulk_load:
+                    # a staging collection left behind by an interrupted run is picked up where it was left
+                    self.collection = self.get_staging(_obs_date)
+                else:
+                    self.collection = self.config['database']['collection_alerts']
+
+                if parquet:
+                    from parquet_export import ParquetExporter
+                    self.exporter = ParquetExporter(self.config['path']['path_parquet'], _obs_date,
+                                                    _rows=int(self.config['misc'].get('parquet_rows', 100000)))
 
-                if not os.path.exists(file_name):
-                    print(f'Fetching {url}')
+                # avro packets already in db
+                committed = self.manifest.committed()
+                if len(committed) > 0:
+                    print(f'Resuming {_obs_date}: {len(committed)} avro packets already in db')
+                    self.logger.info(f'Resuming {_obs_date}: {len(committed)} avro packets already in db')
 
-                    r = requests.get(url, stream=True)
+                if archive and AlertArchive.is_complete(archive_path):
+                    # the whole night is on disk already
+                    print(f'Replaying {_obs_date} from {archive_path}')
+                    self.logger.info(f'Replaying {_obs_date} from {archive_path}')
+                    self.ingest_archive(archive_path, _skip=committed)
+
+                else:
+                    if archive:
+                        self.archive = ArchiveWriter(archive_path)
+
+                    if stream:
+                        print(f'Streaming {url}')
+                        self.logger.info(f'Streaming {url}')
+                        self.ingest_stream(url=url, _obs_date=_obs_date, _path_date=path_date if keep else None,
+                                           _skip=committed)
 
-                    size = r.headers['content-length']
-                    if size:
-                        p = Bar(_obs_date, max=int(size))
                     else:
-                        p = Spinner(_obs_date)
-
-                    with open(file_name, 'wb') as _f:
-                        for chunk in r.iter_content(chunk_size=1024 * 50):
-                            if chunk:  # filter out keep-alive new chunks
-                                p.next(len(chunk))
-                                _f.write(chunk)
-
-                    p.finish()
-
-                    # unzip:
-                    print(f'Unzipping {file_name}')
-                    with tarfile.open(file_name) as tf:
-                        path_date = os.path.join(self.config['path']['path_alerts'], f'{_obs_date}')
-                        if not os.path.exists(path_date):
-                            os.makedirs(path_date)
-                        tf.extractall(path=path_date)
-
-                    # ingest into db:
-                    print(f'Ingesting {_obs_date} into db')
-                    alerts_date = glob.glob(os.path.join(self.config['path']['path_alerts'],
-                                                         f'{_obs_date}', '*.avro'))
-                    for fa in alerts_date:
-                        try:
-                            with open(fa, 'rb') as f_avro:
-                                reader = fastavro.reader(f_avro)
-                                for record in reader:
-                                    alert = self.alert_mongify(record)
-                                    # print('ingesting {:s} into db'.format(alert['_id']))
-                                    # self.insert_db_entry(_collection=self.config['database']['collection_alerts'],
-                                    #                      _db_entry=alert)
-                                    self.documents.append(alert)
-
-                            # insert batch, then flush
-                            if len(self.documents) == self.batch_size:
-                                print(f'inserting batch')
-                                self.logger.info(f'inserting batch')
-                                self.insert_multiple_db_entries(_collection=
-                                                                self.config['database']['collection_alerts'],
-                                                                _db_entries=self.documents)
-                                # flush:
-                                self.documents = []
-                        except Exception as _e:
-                            print(_e)
-                            traceback.print_exc()
-                            continue
-
-                    # stuff left in the last batch?
-                    if len(self.documents) > 0:
-                        print(f'inserting last batch')
-                        self.logger.info(f'inserting last batch')
-                        self.insert_multiple_db_entries(_collection=self.config['database']['collection_alerts'],
-                                                        _db_entries=self.documents)
-                        self.documents = []
-
-                    # creating alert id index:
-                    print('Creating 1d indices')
-                    self.db['db'][self.config['database']['collection_alerts']].create_index([('objectId', 1)])
-                    self.db['db'][self.config['database']['collection_alerts']].create_index([('candid', 1)])
-                    self.db['db'][self.config['database']['collection_alerts']].create_index([('candidate.rb', 1)])
-                    self.db['db'][self.config['database']['collection_alerts']].create_index([('candidate.fwhm', 1)])
-                    self.db['db'][self.config['database']['collection_alerts']].create_index([('candidate.field', 1)])
-                    self.db['db'][self.config['database']['collection_alerts']].create_index([('candidate.magpsf', 1)])
-                    self.db['db'][self.config['database']['collection_alerts']].create_index([('candidate.jd', 1)])
-
-                    # create 2d index:
-                    print('Creating 2d index')
-                    self.db['db'][self.config['database']['collection_alerts']].create_index([('coordinates.radec_geojson',
-                                                                                               '2dsphere')])
-                    print('All done')
+                        import tarfile
+
+                        # the downloader only puts the tarball in place once it is complete
+                        if not os.path.exists(file_name):
+                            print(f'Fetching {url}')
+                            with self.metrics.histogram('download_seconds', 'tarball download time').time():
+                                self.get_downloader().download(url, file_name, _label=_obs_date)
+
+                        if self.archive is not None:
+                            # packets go from the tarball into the archive, no file per alert
+                            print(f'Ingesting {_obs_date} into db')
+                            self.start_ingest()
+                            with tarfile.open(file_name) as tf:
+                                for member in tf:
+                                    name = os.path.basename(member.name)
+                                    if (not member.isfile()) or (not name.endswith('.avro')) or (name in committed):
+                                        continue
+                                    try:
+                                        self.ingest(tf.extractfile(member).read(), name)
+                                    except Exception as _e:
+                                        print(_e)
+                                        traceback.print_exc()
+                                        self.n_failed += 1
+                                        continue
+                            self.finish_ingest()
+
+                        else:
+                            # unzip what is not in db yet:
+                            print(f'Unzipping {file_name}')
+                            with self.metrics.histogram('decompress_seconds', 'tarball extraction time').time(), \
+                                    tarfile.open(file_name) as tf:
+                                if not os.path.exists(path_date):
+                                    os.makedirs(path_date)
+                                tf.extractall(path=path_date,
+                                              members=[_m for _m in tf.getmembers()
+                                                       if os.path.basename(_m.name) not in committed])
+
+                            # ingest into db:
+                            print(f'Ingesting {_obs_date} into db')
+                            alerts_date = [_fa for _fa in glob.glob(os.path.join(path_date, '*.avro'))
+                                           if os.path.basename(_fa) not in committed]
+                            self.start_ingest()
+                            for fa in alerts_date:
+                                try:
+                                    self.ingest(fa)
+                                except Exception as _e:
+                                    print(_e)
+                                    traceback.print_exc()
+                                    self.n_failed += 1
+                                    continue
+
+                            self.finish_ingest()
+
+                    if self.archive is not None:
+                        # complete if it has all packets of the night, those ingested by earlier runs included
+                        self.archive.close(_complete=(self.n_failed == 0) and
+                                           all(self.archive.has(_m) for _m in committed))
+                        print(f'Archived {_obs_date} to {archive_path}')
+                        self.archive = None
+
+                if self.exporter is not None:
+                    self.exporter.close()
+                    self.exporter = None
+
+                if bulk_load:
+                    self.merge_staging(self.collection)
+                    self.collection = self.config['database']['collection_alerts']
+                    self.notify_listeners(None)
+                else:
+                    self.create_indices()
+
+                if (self.n_failed == 0) and (len(self.manifest.pending) == 0):
+                    self.manifest.complete()
+                else:
+                    print(f'{_obs_date}: {self.n_failed} avro packets failed to ingest, '
+                          f'{len(self.manifest.pending)} not acknowledged by db. Re-run to retry')
+                    self.logger.warning(f'{_obs_date}: {self.n_failed} avro packets failed to ingest, '
+                                        f'{len(self.manifest.pending)} not acknowledged by db')
+
+                self.metrics.histogram('night_seconds', 'time to fetch and ingest a night').observe(
+                    time.time() - self.t_start)
+                self.save_metrics(_obs_date, {'n_alerts': self.n_alerts, 'n_failed': self.n_failed,
+                                              'stream': stream, 'bulk_load': bulk_load, 'workers': self.workers,
+                                              'batching': self.batching, 'writes': self.write_tuner.stats()})
+
+                print('All done')
+                return True
 
         except KeyboardInterrupt:
             # user ctrl-c'ed
@@ -542,6 +1949,10 @@ class FetcherArchive(Fetcher):
             # try disconnecting from the database (if connected)
             try:
                 self.logger.info('Shutting down.')
+                if self.archive is not None:
+                    # what made it into the archive is picked up by the next run
+                    self.archive.close()
+                    self.archive = None
                 self.logger.debug('Cleaning tmp directory.')
                 shutil.rmtree(self.config['path']['path_tmp'])
                 os.makedirs(self.config['path']['path_tmp'])
@@ -568,6 +1979,185 @@ class FetcherArchive(Fetcher):
                 self.logger.info('Bye!')
                 return False
 
+    def backfill(self, _start, _end, _reingest=False, _bulk_load=None, _parquet=None, _skip_existing=None,
+                 _archive=None):
+        """
+            Fetch and ingest all nights from _start to _end, inclusive.
+            Nights already in db are skipped, tarballs of the next config['misc']['backfill_lookahead'] nights
+            are downloaded in the background while the current one is being ingested.
+            The db connection is shared between all nights,
+            alerts are written with config['misc']['write_concern_backfill']
+
+        :param _start: YYYYMMDD
+        :param _end: YYYYMMDD
+        :param _reingest:
+        :param _bulk_load:
+        :param _parquet:
+        :param _skip_existing:
+        :param _archive:
+        :return: list of per-night summaries
+        """
+        start = datetime.datetime.strptime(_start, '%Y%m%d')
+        end = datetime.datetime.strptime(_end, '%Y%m%d')
+        assert start <= end, 'start date must not be after end date'
+        obs_dates = [(start + datetime.timedelta(days=i)).strftime('%Y%m%d') for i in range((end - start).days + 1)]
+
+        if not _reingest:
+            skip = [_d for _d in obs_dates if self.get_manifest(_d).is_complete()]
+            if len(skip) > 0:
+                print(f'Skipping {len(skip)} nights already in db')
+                self.logger.info(f'Skipping nights already in db: {skip}')
+            obs_dates = [_d for _d in obs_dates if _d not in skip]
+
+        def download(_obs_date):
+            tic = time.time()
+            file_name = self.get_file_name(_obs_date)
+            if not os.path.exists(file_name):
+                self.get_downloader().download(self.get_url(_obs_date), file_name)
+                self.metrics.histogram('download_seconds', 'tarball download time').observe(time.time() - tic)
+            return time.time() - tic
+
+        lookahead = max(int(self.config['misc'].get('backfill_lookahead', 2)), 1)
+        summary = []
+
+        # backfilled nights can be fetched again: favour throughput over durability of every write
+        write_concern, self.write_concern = self.write_concern, self.get_write_concern('backfill')
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=lookahead) as pool:
+                downloads = collections.deque()
+                for i, obs_date in enumerate(obs_dates):
+                    # keep the next few nights downloading while this one is being ingested
+                    while (len(downloads) < lookahead + 1) and (i + len(downloads) < len(obs_dates)):
+                        _d = obs_dates[i + len(downloads)]
+                        downloads.append(pool.submit(download, _d))
+
+                    night = {'obs_date': obs_date, 'n_alerts': 0}
+                    try:
+                        night['download_s'] = downloads.popleft().result()
+                    except Exception as _e:
+                        print(f'Failed to download {obs_date}: {_e}')
+                        self.logger.error(f'Failed to download {obs_date}: {_e}')
+                        night['status'] = 'download failed'
+                        summary.append(night)
+                        continue
+
+                    tic = time.time()
+                    result = self.fetch(obs_date, _stream=False, _reingest=_reingest, _bulk_load=_bulk_load,
+                                        _parquet=_parquet, _skip_existing=_skip_existing, _archive=_archive)
+                    night['ingest_s'] = time.time() - tic
+                    night['n_alerts'] = self.n_alerts
+                    night['alerts_per_s'] = self.n_alerts / night['ingest_s'] if night['ingest_s'] > 0 else 0.0
+                    night['status'] = 'ok' if (result and self.n_failed == 0) else 'incomplete'
+                    summary.append(night)
+
+                    if result is False:
+                        # interrupted
+                        for future in downloads:
+                            future.cancel()
+                        break
+        finally:
+            self.write_concern = write_concern
+
+        print('Backfill summary:')
+        for night in summary:
+            line = f"{night['obs_date']}: {night['status']}, {night['n_alerts']} alerts"
+            if 'ingest_s' in night:
+                line += f", download {night['download_s']:.1f} s, ingest {night['ingest_s']:.1f} s, " \
+                        f"{night['alerts_per_s']:.1f} alerts/s"
+            print(line)
+            self.logger.info(line)
+
+        return summary
+
+
+class FetcherArchiveAsync(FetcherArchive):
+    """
+        Fetch ZTF alerts from the archive with asyncio I/O: several insert_many batches in flight at once
+        (config['misc']['inserts_in_flight']), tarballs streamed over async HTTP, avro decoded in an executor.
+        Everything else, from the manifest to bulk loading, is FetcherArchive's
+    """
+    def __init__(self, _config_file, _collection=None, _db=None, _manifests=None, _lightcurves=None,
+                 _existing=None):
+        """
+            The bookkeeping around inserts can be passed in as well, e.g. to run everything in memory for testing
+
+        :param _config_file:
+        :param _collection: async collection to insert into instead of db,
+                            e.g. async_ingest.InMemoryAsyncCollection for testing
+        :param _db: see Fetcher
+        :param _manifests: callable(obs_date) -> manifest.Manifest to use instead of the one in db
+        :param _lightcurves: lightcurves.LightCurves to update instead of the one in db
+        :param _existing: callable(documents) -> those not in db yet, for skip_existing, instead of looking in db
+        """
+
+        ''' initialize super class '''
+        super(FetcherArchiveAsync, self).__init__(_config_file=_config_file, _db=_db)
+
+        self.inserts_in_flight = int(self.config['misc'].get('inserts_in_flight', 4))
+        self.async_collection = _collection
+        self.manifests = _manifests
+        self.lightcurves = _lightcurves
+        self.existing = _existing
+
+    def get_manifest(self, _obs_date):
+        if self.manifests is not None:
+            return self.manifests(_obs_date)
+        return super(FetcherArchiveAsync, self).get_manifest(_obs_date)
+
+    def get_lightcurves(self):
+        if (self.lightcurves is not None) and self.config['misc'].get('objects', True):
+            return self.lightcurves
+        return super(FetcherArchiveAsync, self).get_lightcurves()
+
+    def drop_existing(self, _documents, _chunk_size=1000):
+        if (self.existing is not None) and self.skip_existing:
+            return self.existing(_documents)
+        return super(FetcherArchiveAsync, self).drop_existing(_documents, _chunk_size)
+
+    def connect_async(self):
+        """
+            asyncio client for the pipeline, called on its event loop
+        :return: client (None if not ours to close), collection to insert into
+        """
+        if self.async_collection is not None:
+            return None, self.async_collection
+
+        from async_ingest import async_mongo_client
+
+        _config = self.config
+        client = async_mongo_client(host=_config['database']['host'], port=_config['database']['port'],
+                                    username=_config['database']['user'], password=_config['database']['pwd'],
+                                    authSource=_config['database']['db'])
+        collection = client[_config['database']['db']][self.collection]
+        if self.write_concern is not None:
+            collection = collection.with_options(write_concern=self.write_concern)
+        return client, collection
+
+    def start_ingest(self):
+        """
+            Spin up the async pipeline, always: it is what does the inserts
+        :return:
+        """
+        from async_ingest import AsyncIngestPipeline
+
+        decode = functools.partial(decode_avro, _projection=self.projection, _index=self.archive is not None)
+        self.write_tuner.set_max_in_flight(self.inserts_in_flight)
+        self.pipeline = AsyncIngestPipeline(self, self.connect_async, decode, _workers=self.workers,
+                                            _inserts=self.inserts_in_flight)
+
+    @contextlib.contextmanager
+    def open_stream(self, url):
+        """
+            GET url as a stream on the pipeline's event loop
+        :param url:
+        :return: context manager yielding (file-like object, content length or None)
+        """
+        reader, size = self.pipeline.stream(url)
+        try:
+            yield reader, size
+        finally:
+            reader.close()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=
@@ -575,11 +2165,43 @@ if __name__ == '__main__':
     parser.add_argument('config_file', help='path to config file')
     parser.add_argument('obsdate', help='observing date string: YYYYMMDD')
     parser.add_argument('--demo', action='store_true', help='fetch demo alerts?')
+    parser.add_argument('--kafka', action='store_true', help='consume alerts from Kafka instead of the archive')
+    parser.add_argument('--stream', action='store_true', default=None,
+                        help='ingest tarball members while downloading instead of extracting to disk first?')
+    parser.add_argument('--keep', action='store_true', default=None,
+                        help='also keep extracted avro packets on disk when streaming')
+    parser.add_argument('--reingest', action='store_true', help='ignore manifest and ingest the night again')
+    parser.add_argument('--bulk-load', dest='bulk_load', action='store_true', default=None,
+                        help='load into an unindexed staging collection, then index and merge it into alerts')
+    parser.add_argument('--parquet', action='store_true', default=None,
+                        help='also write candidates and prv_candidates to a parquet store')
+    parser.add_argument('--verify', action='store_true',
+                        help='compare manifest with the number of alerts in db for the night and exit')
+    parser.add_argument('--until', help='backfill all nights from obsdate to this date (YYYYMMDD), inclusive')
+    parser.add_argument('--skip-existing', dest='skip_existing', action='store_true', default=None,
+                        help='look up which alerts are already in db and only send the new ones')
+    parser.add_argument('--async-io', dest='async_io', action='store_true',
+                        help='ingest with asyncio: several inserts in flight, async download when streaming')
+    parser.add_argument('--archive', action='store_true', default=None,
+                        help='pack the night into one segment file with an index, or replay it from there')
 
     args = parser.parse_args()
     obs_date = args.obsdate
     config_file = args.config_file
     demo = args.demo
 
-    f = FetcherArchive(config_file)
-    f.fetch(obs_date, demo)
+    if args.kafka:
+        f = FetcherKafka(config_file)
+        f.fetch(obs_date)
+    elif args.verify:
+        f = FetcherArchive(config_file)
+        print(json.dumps(f.verify(obs_date), indent=2))
+    elif args.until is not None:
+        f = FetcherArchiveAsync(config_file) if args.async_io else FetcherArchive(config_file)
+        f.backfill(obs_date, args.until, _reingest=args.reingest, _bulk_load=args.bulk_load, _parquet=args.parquet,
+                   _skip_existing=args.skip_existing, _archive=args.archive)
+    else:
+        f = FetcherArchiveAsync(config_file) if args.async_io else FetcherArchive(config_file)
+        f.fetch(obs_date, demo, _stream=args.stream, _keep=args.keep, _reingest=args.reingest,
+                _bulk_load=args.bulk_load, _parquet=args.parquet, _skip_existing=args.skip_existing,
+                _archive=args.archive)
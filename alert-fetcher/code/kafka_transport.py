@@ -0,0 +1,169 @@
+import collections
+import threading
+import time
+
+
+# what FetcherKafka gets from the broker. offset is that of the message itself
+Message = collections.namedtuple('Message', ['topic', 'partition', 'offset', 'value'])
+
+
+class Transport(object):
+    """
+        Minimal interface FetcherKafka needs from a Kafka client.
+        Partitions are referred to as (topic, partition) tuples
+    """
+    def subscribe(self, topics):
+        """
+
+        :param topics: list of topic names
+        :return:
+        """
+        raise NotImplementedError
+
+    def poll(self, max_messages, timeout):
+        """
+            Get up to max_messages messages, waiting at most timeout seconds
+
+        :param max_messages:
+        :param timeout: [s]
+        :return: list of Message's
+        """
+        raise NotImplementedError
+
+    def assignment(self):
+        """
+
+        :return: list of (topic, partition) currently assigned to this consumer
+        """
+        raise NotImplementedError
+
+    def pause(self, partitions):
+        raise NotImplementedError
+
+    def resume(self, partitions):
+        raise NotImplementedError
+
+    def commit(self, offsets):
+        """
+            Synchronously commit offsets
+
+        :param offsets: {(topic, partition): offset of the next message to consume}
+        :return:
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ConfluentKafkaTransport(Transport):
+    """
+        Transport backed by confluent_kafka.Consumer
+    """
+    def __init__(self, _conf):
+        """
+
+        :param _conf: confluent_kafka.Consumer config
+        """
+        # only needed for live ingestion
+        import confluent_kafka
+        self.kafka = confluent_kafka
+        self.consumer = confluent_kafka.Consumer(_conf)
+
+    def subscribe(self, topics):
+        self.consumer.subscribe(topics)
+
+    def poll(self, max_messages, timeout):
+        messages = []
+        for msg in self.consumer.consume(num_messages=max_messages, timeout=timeout):
+            if msg.error():
+                # reached the end of partition, not an error
+                if msg.error().code() == self.kafka.KafkaError._PARTITION_EOF:
+                    continue
+                raise self.kafka.KafkaException(msg.error())
+            messages.append(Message(msg.topic(), msg.partition(), msg.offset(), msg.value()))
+        return messages
+
+    def assignment(self):
+        return [(tp.topic, tp.partition) for tp in self.consumer.assignment()]
+
+    def pause(self, partitions):
+        self.consumer.pause([self.kafka.TopicPartition(t, p) for t, p in partitions])
+
+    def resume(self, partitions):
+        self.consumer.resume([self.kafka.TopicPartition(t, p) for t, p in partitions])
+
+    def commit(self, offsets):
+        self.consumer.commit(offsets=[self.kafka.TopicPartition(t, p, o) for (t, p), o in offsets.items()],
+                             asynchronous=False)
+
+    def close(self):
+        self.consumer.close()
+
+
+class InMemoryTransport(Transport):
+    """
+        In-process fake broker + consumer, for testing FetcherKafka without Kafka.
+        A consumer (re)subscribing starts from the committed offsets, just like a consumer group would
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {topic: [[partition 0 values], [partition 1 values], ...]}
+        self.topics = dict()
+        self.subscribed = []
+        self.positions = dict()
+        self.committed = dict()
+        self.paused = set()
+
+    def produce(self, topic, value, partition=0):
+        with self.lock:
+            partitions = self.topics.setdefault(topic, [])
+            while len(partitions) <= partition:
+                partitions.append([])
+            partitions[partition].append(value)
+
+    def subscribe(self, topics):
+        with self.lock:
+            self.subscribed = list(topics)
+            self.positions = dict()
+
+    def assignment(self):
+        with self.lock:
+            return [(t, p) for t in self.subscribed for p in range(len(self.topics.get(t, [])))]
+
+    def poll(self, max_messages, timeout):
+        messages = []
+        for tp in self.assignment():
+            if tp in self.paused:
+                continue
+            with self.lock:
+                values = self.topics[tp[0]][tp[1]]
+                position = self.positions.get(tp, self.committed.get(tp, 0))
+                n = max(min(len(values) - position, max_messages - len(messages)), 0)
+                for offset in range(position, position + n):
+                    messages.append(Message(tp[0], tp[1], offset, values[offset]))
+                self.positions[tp] = position + n
+
+        if len(messages) == 0:
+            time.sleep(timeout)
+
+        return messages
+
+    def pause(self, partitions):
+        self.paused.update(partitions)
+
+    def resume(self, partitions):
+        self.paused.difference_update(partitions)
+
+    def commit(self, offsets):
+        with self.lock:
+            self.committed.update(offsets)
+
+    def lag(self):
+        """
+
+        :return: number of produced messages not yet committed
+        """
+        with self.lock:
+            return sum(len(values) - self.committed.get((t, p), 0)
+                       for t in self.topics for p, values in enumerate(self.topics[t]))
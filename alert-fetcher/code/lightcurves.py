@@ -0,0 +1,90 @@
+import pymongo
+
+
+# what goes into a light curve point, in this order: $addToSet compares points as whole (ordered) documents.
+# candid and rb on top of the photometry let per-alert queries (e.g. rb cuts) run on objects too
+POINT_FIELDS = ('jd', 'fid', 'candid', 'magpsf', 'sigmapsf', 'diffmaglim', 'rb')
+
+
+def make_point(_candidate):
+    """
+        Light curve point of a candidate or prv_candidate: detection or, with no magpsf, upper limit
+
+    :param _candidate:
+    :return: dict
+    """
+    return {field: _candidate.get(field) for field in POINT_FIELDS}
+
+
+class LightCurves(object):
+    """
+        Per-object light curves maintained incrementally at ingest, one small document per objectId:
+
+            {'_id': objectId, 'candids': [candids of its alerts], 'first_jd', 'last_jd',
+             'lightcurve': [{'jd', 'fid', 'candid', 'magpsf', 'sigmapsf', 'diffmaglim', 'rb'}, ...]}
+
+        Points come from the candidate and prv_candidates of every alert, a detection seen both as a candidate
+        and later as a prv_candidate of a newer alert is stored once. get() returns lightcurve sorted by jd.
+        Updates are idempotent, so re-ingesting alerts is harmless.
+
+        lightcurve is not capped: $slice only goes with $push, which cannot drop the points every alert repeats
+        from its prv_candidates, and an object gets a few points per night, far from the 16 MB document limit
+    """
+    def __init__(self, _collection):
+        """
+
+        :param _collection: pymongo collection
+        """
+        self.collection = _collection
+
+    @staticmethod
+    def aggregate(_documents):
+        """
+            Collect points and candids per object from a batch of alerts
+
+        :param _documents: mongified alerts
+        :return: {objectId: {'points': {key: point}, 'candids': [], 'jd': []}}
+        """
+        objects = dict()
+        for doc in _documents:
+            obj = objects.setdefault(doc['objectId'], {'points': dict(), 'candids': [], 'jd': []})
+            obj['candids'].append(doc['candid'])
+            for candidate in [doc['candidate']] + (doc.get('prv_candidates') or []):
+                point = make_point(candidate)
+                # the same detection from several alerts of the batch only needs to be sent once
+                obj['points'].setdefault(tuple(point.values()), point)
+                if point['magpsf'] is not None:
+                    obj['jd'].append(point['jd'])
+        return objects
+
+    def update(self, _documents):
+        """
+            Merge a batch of alerts into the light curves of their objects, one update per object
+
+        :param _documents: mongified alerts
+        :return:
+        """
+        requests = []
+        for object_id, obj in self.aggregate(_documents).items():
+            update = {'$addToSet': {'lightcurve': {'$each': list(obj['points'].values())},
+                                    'candids': {'$each': obj['candids']}}}
+            if len(obj['jd']) > 0:
+                update['$min'] = {'first_jd': min(obj['jd'])}
+                update['$max'] = {'last_jd': max(obj['jd'])}
+            requests.append(pymongo.UpdateOne({'_id': object_id}, update, upsert=True))
+
+        if len(requests) > 0:
+            # objects do not depend on each other
+            self.collection.bulk_write(requests, ordered=False)
+
+    def get(self, _object_id):
+        """
+
+        :param _object_id:
+        :return: light curve of the object, sorted by jd, or None if it's not in db
+        """
+        doc = self.collection.find_one({'_id': _object_id}, {'lightcurve': 1})
+        if doc is None:
+            return None
+        # $addToSet appends
+        return sorted(doc['lightcurve'], key=lambda _p: _p['jd'])
@@ -0,0 +1,148 @@
+import datetime
+import threading
+
+import pymongo
+import pytz
+
+
+def obs_date_to_jd(_obs_date):
+    """
+        JD at the start of UT date
+
+    :param _obs_date: YYYYMMDD
+    :return:
+    """
+    t = datetime.datetime.strptime(_obs_date, '%Y%m%d').replace(tzinfo=pytz.utc)
+    return t.timestamp() / 86400.0 + 2440587.5
+
+
+class Manifest(object):
+    """
+        Per-night record of which avro packets (tarball members) have been durably inserted into db.
+
+        A member is recorded once all of its alerts have been acknowledged by db,
+        so on restart everything that is not in the manifest needs to be (re)ingested.
+        Documents: {'_id': '<obs_date>/<member>', 'obs_date', 'member', 'n_alerts', 'inserted'}
+        plus one {'_id': '<obs_date>', 'obs_date', 'complete', ...} per night.
+    """
+    def __init__(self, _collection, _obs_date):
+        """
+
+        :param _collection: pymongo collection to keep the manifest in
+        :param _obs_date:
+        """
+        self.collection = _collection
+        self.obs_date = _obs_date
+
+        # ack's come from the writer threads
+        self.lock = threading.Lock()
+        # {member: number of its alerts not yet acknowledged by db}
+        self.pending = dict()
+        # {member: number of its alerts}
+        self.sizes = dict()
+
+    def committed(self):
+        """
+
+        :return: set of members already in db
+        """
+        return set(_m['member'] for _m in self.collection.find({'obs_date': self.obs_date, 'member': {'$exists': True}},
+                                                               {'_id': 0, 'member': 1}))
+
+    def is_complete(self):
+        return self.collection.find_one({'_id': self.obs_date, 'complete': True}) is not None
+
+    def expect(self, _member, _n_alerts):
+        """
+            All alerts of _member have been read and are on their way to db
+
+        :param _member:
+        :param _n_alerts:
+        :return:
+        """
+        with self.lock:
+            self.pending[_member] = self.pending.get(_member, 0) + _n_alerts
+            self.sizes[_member] = self.sizes.get(_member, 0) + _n_alerts
+        if _n_alerts == 0:
+            self.ack({_member: 0})
+
+    def ack(self, _counts):
+        """
+            Record members whose alerts have all been acknowledged by db
+
+        :param _counts: {member: number of its alerts in the acknowledged batch}
+        :return:
+        """
+        done = dict()
+        with self.lock:
+            for member, count in _counts.items():
+                self.pending[member] -= count
+                if self.pending[member] == 0:
+                    del self.pending[member]
+                    done[member] = self.sizes.pop(member)
+
+        if len(done) > 0:
+            self.record(done)
+
+    def record(self, _members):
+        """
+            Write members that are completely in db to the manifest
+
+        :param _members: {member: number of its alerts}
+        :return:
+        """
+        now = datetime.datetime.now(pytz.utc)
+        self.collection.bulk_write([pymongo.UpdateOne({'_id': f'{self.obs_date}/{member}'},
+                                                      {'$set': {'obs_date': self.obs_date, 'member': member,
+                                                                'n_alerts': n_alerts, 'inserted': now}},
+                                                      upsert=True)
+                                    for member, n_alerts in _members.items()], ordered=False)
+
+    def complete(self):
+        """
+            Mark night as fully ingested
+        :return:
+        """
+        totals = self.totals()
+        self.collection.update_one({'_id': self.obs_date},
+                                   {'$set': {'obs_date': self.obs_date, 'complete': True,
+                                             'n_members': totals['n_members'], 'n_alerts': totals['n_alerts'],
+                                             'completed': datetime.datetime.now(pytz.utc)}},
+                                   upsert=True)
+
+    def totals(self):
+        """
+
+        :return: number of members and alerts recorded for the night
+        """
+        result = list(self.collection.aggregate([{'$match': {'obs_date': self.obs_date, 'member': {'$exists': True}}},
+                                                 {'$group': {'_id': None, 'n_members': {'$sum': 1},
+                                                             'n_alerts': {'$sum': '$n_alerts'}}}]))
+        if len(result) == 0:
+            return {'n_members': 0, 'n_alerts': 0}
+        return {'n_members': result[0]['n_members'], 'n_alerts': result[0]['n_alerts']}
+
+    def reset(self):
+        """
+            Forget everything about the night, e.g. to re-ingest it from scratch
+        :return:
+        """
+        self.collection.delete_many({'obs_date': self.obs_date})
+        with self.lock:
+            self.pending = dict()
+            self.sizes = dict()
+
+    def verify(self, _alerts):
+        """
+            Compare the number of alerts in manifest with what is in the alerts collection for the night
+
+        :param _alerts: pymongo alerts collection
+        :return: dict
+        """
+        jd_start = obs_date_to_jd(self.obs_date)
+        n_db = _alerts.count_documents({'candidate.jd': {'$gte': jd_start, '$lt': jd_start + 1}})
+        totals = self.totals()
+
+        return {'obs_date': self.obs_date, 'complete': self.is_complete(),
+                'n_members': totals['n_members'], 'n_alerts_manifest': totals['n_alerts'],
+                'n_alerts_db': n_db, 'ok': totals['n_alerts'] == n_db}
@@ -0,0 +1,220 @@
+import bisect
+import http.server
+import threading
+import time
+
+
+# [s] from a single avro packet to a full night
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Counter(object):
+    def __init__(self, _name, _help):
+        self.name = _name
+        self.help = _help
+        self.kind = 'counter'
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, _n=1):
+        with self.lock:
+            self.value += _n
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+    def summary(self):
+        return self.value
+
+
+class Gauge(object):
+    def __init__(self, _name, _help):
+        self.name = _name
+        self.help = _help
+        self.kind = 'gauge'
+        self.value = 0
+        # highest value seen
+        self.max = 0
+
+    def set(self, _value):
+        self.value = _value
+        self.max = max(self.max, _value)
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+    def summary(self):
+        return {'value': self.value, 'max': self.max}
+
+
+class Histogram(object):
+    """
+        Cumulative-bucket histogram as Prometheus does it, plus min/max for the JSON summary
+    """
+    def __init__(self, _name, _help, _buckets=DEFAULT_BUCKETS):
+        self.name = _name
+        self.help = _help
+        self.kind = 'histogram'
+        self.buckets = tuple(sorted(_buckets))
+        self.lock = threading.Lock()
+        # the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, _value):
+        i = bisect.bisect_left(self.buckets, _value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += _value
+            if (self.min is None) or (_value < self.min):
+                self.min = _value
+            if (self.max is None) or (_value > self.max):
+                self.max = _value
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        samples = []
+        cumulative = 0
+        for bucket, n in zip(self.buckets, counts):
+            cumulative += n
+            samples.append((f'{self.name}_bucket{{le="{bucket}"}}', cumulative))
+        samples.append((f'{self.name}_bucket{{le="+Inf"}}', count))
+        samples.append((f'{self.name}_sum', total))
+        samples.append((f'{self.name}_count', count))
+        return samples
+
+    def quantile(self, _q):
+        """
+            Upper bound of the bucket the _q-th quantile falls into
+        """
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if count == 0:
+            return None
+        cumulative = 0
+        for bucket, n in zip(self.buckets, counts):
+            cumulative += n
+            if cumulative >= _q * count:
+                return bucket
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count > 0 else None,
+                'min': self.min, 'max': self.max, 'p50': self.quantile(0.5), 'p95': self.quantile(0.95)}
+
+
+class Timer(object):
+    """
+        with histogram.time(): ...
+    """
+    def __init__(self, _histogram):
+        self.histogram = _histogram
+        self.tic = None
+
+    def __enter__(self):
+        self.tic = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.time() - self.tic)
+
+
+class Metrics(object):
+    """
+        Registry of counters, gauges, and histograms of a fetcher.
+
+        Updating a metric is a lock and an addition (plus a bisect for histograms),
+        so instrumentation is meant to stay on: per batch and per avro packet, never per alert.
+        Rendered in the Prometheus text format on an optional local /metrics endpoint,
+        and as a JSON-able summary at the end of a run
+    """
+    def __init__(self, _prefix='fetcher'):
+        self.prefix = _prefix
+        self.lock = threading.Lock()
+        self.metrics = dict()
+        self.server = None
+
+    def get(self, _cls, _name, _help, **kwargs):
+        name = f'{self.prefix}_{_name}'
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = _cls(name, _help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, _name, _help=''):
+        return self.get(Counter, _name, _help)
+
+    def gauge(self, _name, _help=''):
+        return self.get(Gauge, _name, _help)
+
+    def histogram(self, _name, _help='', _buckets=DEFAULT_BUCKETS):
+        return self.get(Histogram, _name, _help, _buckets=_buckets)
+
+    def render(self):
+        """
+            Prometheus text exposition format
+        :return: str
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, value in metric.samples():
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+
+        :return: {metric name without prefix: value or dict}
+        """
+        with self.lock:
+            metrics = list(self.metrics.items())
+        return {name[len(self.prefix) + 1:]: metric.summary() for name, metric in metrics}
+
+    def serve(self, _port, _host='127.0.0.1'):
+        """
+            Expose /metrics over HTTP from a daemon thread
+
+        :param _port: 0 to pick a free one
+        :param _host: local only by default
+        :return: port
+        """
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((_host, _port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+
+        return self.server.server_port
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+
+
+# avro primitive -> pyarrow type name
+ARROW_TYPES = {'null': 'null', 'boolean': 'bool_', 'int': 'int32', 'long': 'int64', 'float': 'float32',
+               'double': 'float64', 'bytes': 'binary', 'string': 'string'}
+
+
+def arrow_type(_pa, _type, _named, _namespace=''):
+    """
+        pyarrow type for an avro type. Unions become their first non-null branch, values are nullable anyway
+
+    :param _pa: pyarrow module
+    :param _type: avro type: name, list (union) or dict
+    :param _named: {full name: pyarrow type} of named types defined so far, updated
+    :param _namespace: enclosing namespace
+    :return:
+    """
+    if isinstance(_type, list):
+        branches = [t for t in _type if t != 'null']
+        return arrow_type(_pa, branches[0], _named, _namespace) if len(branches) > 0 else _pa.null()
+    if isinstance(_type, str):
+        if _type in ARROW_TYPES:
+            return getattr(_pa, ARROW_TYPES[_type])()
+        if _type in _named:
+            return _named[_type]
+        return _named[f'{_namespace}.{_type}']
+
+    kind = _type['type']
+    if kind == 'array':
+        return _pa.list_(arrow_type(_pa, _type['items'], _named, _namespace))
+    if kind == 'map':
+        return _pa.map_(_pa.string(), arrow_type(_pa, _type['values'], _named, _namespace))
+    if kind not in ('record', 'enum', 'fixed'):
+        # annotated primitive, e.g. {"type": "long", "logicalType": ...}
+        return arrow_type(_pa, kind, _named, _namespace)
+
+    namespace = _type.get('namespace', _namespace)
+    name = _type['name'] if ('.' in _type['name']) or (not namespace) else f'{namespace}.{_type["name"]}'
+    if kind == 'record':
+        result = _pa.struct([(field['name'], arrow_type(_pa, field['type'], _named, namespace))
+                             for field in _type['fields']])
+    elif kind == 'enum':
+        result = _pa.string()
+    else:
+        result = _pa.binary(_type['size'])
+    _named[name] = result
+    return result
+
+
+class ParquetExporter(object):
+    """
+        Write ingested alerts into a columnar store for analytics:
+        flat candidates and prv_candidates tables, no cutouts, hive-partitioned by obs_date
+        and, for candidates, field (prv_candidates carry their own field, which may differ from the alert's):
+
+            <path>/candidates/obs_date=<obs_date>/field=<field>/part-*.parquet
+            <path>/prv_candidates/obs_date=<obs_date>/part-*.parquet
+
+        Read back with e.g. pandas.read_parquet('<path>/candidates', filters=[('field', '=', 600)])
+    """
+    def __init__(self, _path, _obs_date, _rows=100000, _schema=None):
+        """
+
+        :param _path: root of the store
+        :param _obs_date:
+        :param _rows: number of buffered candidates to write out at once
+        :param _schema: avro schema of the alerts (dict or json), see set_schema
+        """
+        # optional dependency, only needed if exporting
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+
+        self.path = _path
+        self.obs_date = _obs_date
+        self.rows = _rows
+
+        # add() is called from the writer threads
+        self.lock = threading.Lock()
+        # {field: [rows]}
+        self.candidates = dict()
+        self.prv_candidates = []
+        self.n_buffered = 0
+        self.n_parts = 0
+
+        # {table: pyarrow.Schema}
+        self.schemas = None
+        if _schema is not None:
+            self.set_schema(_schema)
+
+    def set_schema(self, _schema):
+        """
+            Type both tables from the avro writer schema of the alerts.
+            Every part file then gets the same schema: inferring it per part would type a column that happens
+            to be all null in one part as null, which datasets cannot unify with its type in the other parts
+
+        :param _schema: avro schema of the alerts (dict or json)
+        :return:
+        """
+        if isinstance(_schema, (str, bytes)):
+            _schema = json.loads(_schema)
+        named = dict()
+        alert = arrow_type(self.pa, _schema, named)
+
+        candidate = alert.field('candidate').type
+        fields = [self.pa.field('objectId', self.pa.string())]
+        # field goes into partition path
+        fields += [candidate.field(i) for i in range(candidate.num_fields) if candidate.field(i).name != 'field']
+        schemas = {'candidates': self.pa.schema(fields)}
+
+        fields = [self.pa.field('objectId', self.pa.string()), self.pa.field('alert_candid', self.pa.int64())]
+        prv_candidates = alert.field('prv_candidates').type
+        if self.pa.types.is_list(prv_candidates):
+            prv_candidate = prv_candidates.value_type
+            fields += [prv_candidate.field(i) for i in range(prv_candidate.num_fields)]
+        schemas['prv_candidates'] = self.pa.schema(fields)
+
+        with self.lock:
+            self.schemas = schemas
+
+    def add(self, _documents):
+        """
+            Buffer candidate and prv_candidates of ingested alerts, write them out once enough are collected
+
+        :param _documents: mongified alerts
+        :return:
+        """
+        with self.lock:
+            for doc in _documents:
+                candidate = {'objectId': doc['objectId']}
+                candidate.update(doc['candidate'])
+                # goes into partition path
+                field = candidate.pop('field', None)
+                self.candidates.setdefault(field, []).append(candidate)
+
+                for prv_candidate in (doc.get('prv_candidates') or []):
+                    prv = {'objectId': doc['objectId'], 'alert_candid': doc['candid']}
+                    prv.update(prv_candidate)
+                    self.prv_candidates.append(prv)
+
+            self.n_buffered += len(_documents)
+            if self.n_buffered >= self.rows:
+                self.write()
+
+    def write_table(self, _table, _rows, _field=None):
+        """
+            Write rows as a new part file of table's partition
+
+        :param _table: candidates or prv_candidates
+        :param _rows: list of dicts with the same keys, only those in the table schema are written if it is known
+        :param _field: field partition, if any
+        :return:
+        """
+        path = os.path.join(self.path, _table, f'obs_date={self.obs_date}')
+        if _field is not None:
+            path = os.path.join(path, f'field={_field}')
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        schema = self.schemas[_table] if self.schemas is not None else None
+        names = schema.names if schema is not None else _rows[0].keys()
+        columns = dict()
+        for key in names:
+            columns[key] = [row.get(key) for row in _rows]
+
+        self.pq.write_table(self.pa.Table.from_pydict(columns, schema=schema),
+                            os.path.join(path, f'part-{int(time.time())}-{os.getpid()}-{self.n_parts:05d}.parquet'))
+
+    def write(self):
+        """
+            Write out everything buffered. Call with self.lock held
+        :return:
+        """
+        for field, rows in self.candidates.items():
+            self.write_table('candidates', rows, _field=field)
+        if len(self.prv_candidates) > 0:
+            self.write_table('prv_candidates', self.prv_candidates)
+
+        self.candidates = dict()
+        self.prv_candidates = []
+        self.n_buffered = 0
+        self.n_parts += 1
+
+    def close(self):
+        with self.lock:
+            if self.n_buffered > 0:
+                self.write()
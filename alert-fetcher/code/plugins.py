@@ -0,0 +1,31 @@
+"""
+    Example ingest-time enrichment plugins, see alert_filter.AlertFilter.
+    Enable in config.json as e.g. "plugins": ["plugins:galactic"]
+"""
+import numpy as np
+
+from crossmatch import radec2xyz
+
+
+# ICRS -> Galactic rotation
+GALACTIC = np.array([[-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+                     [+0.4941094278755837, -0.4448296299600112, +0.7469822444972189],
+                     [-0.8676661490190047, -0.1980763734312015, +0.4559837761750669]])
+
+
+def galactic(_documents):
+    """
+        Galactic coordinates of alerts as coordinates.l and coordinates.b [deg]
+
+    :param _documents: mongified alerts
+    :return: the same documents
+    """
+    ra = np.radians([doc['candidate']['ra'] for doc in _documents])
+    dec = np.radians([doc['candidate']['dec'] for doc in _documents])
+    xyz = radec2xyz(ra, dec) @ GALACTIC.T
+    l = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360.0
+    b = np.degrees(np.arcsin(np.clip(xyz[:, 2], -1.0, 1.0)))
+    for doc, _l, _b in zip(_documents, l.tolist(), b.tolist()):
+        doc['coordinates']['l'] = _l
+        doc['coordinates']['b'] = _b
+    return _documents
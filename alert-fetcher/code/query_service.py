@@ -0,0 +1,239 @@
+import collections
+import json
+import threading
+import time
+
+import numpy as np
+
+from crossmatch import CrossMatch, ang2pix, ang2pix_scalar, neighbours, query_order, to_radians
+from lightcurves import LightCurves
+
+
+class ResultCache(object):
+    """
+        LRU cache of query results with a time to live, thread-safe.
+        Entries are tagged with what they depend on, ('object', objectId) or ('pixel', order, pixel),
+        so that new alerts drop exactly the entries they could change
+    """
+    def __init__(self, _max_size=10000, _ttl=60.0):
+        """
+
+        :param _max_size: max number of entries
+        :param _ttl: [s] max age of an entry, None to only expire entries on invalidation
+        """
+        self.max_size = _max_size
+        self.ttl = _ttl
+        self.lock = threading.Lock()
+        # {key: (expires, value, tags)}, least recently used first
+        self.entries = collections.OrderedDict()
+        # {tag: set of keys}
+        self.tags = dict()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # bumped on every invalidation: a result queried before it may already be stale
+        self.generation = 0
+
+    def get(self, _key):
+        """
+
+        :param _key:
+        :return: is it there?, cached value
+        """
+        with self.lock:
+            entry = self.entries.get(_key)
+            if (entry is not None) and ((entry[0] is None) or (entry[0] > time.time())):
+                self.entries.move_to_end(_key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                self._drop(_key)
+            self.misses += 1
+            return False, None
+
+    def put(self, _key, _value, _tags=(), _generation=None):
+        """
+
+        :param _key:
+        :param _value:
+        :param _tags: what the value depends on
+        :param _generation: self.generation when the value was queried, not cached if there were invalidations since
+        :return:
+        """
+        with self.lock:
+            if (_generation is not None) and (_generation != self.generation):
+                return
+            if _key in self.entries:
+                self._drop(_key)
+            expires = time.time() + self.ttl if self.ttl is not None else None
+            self.entries[_key] = (expires, _value, tuple(_tags))
+            for tag in _tags:
+                self.tags.setdefault(tag, set()).add(_key)
+            while len(self.entries) > self.max_size:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, _key):
+        _, _, tags = self.entries.pop(_key)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(_key)
+                if len(keys) == 0:
+                    del self.tags[tag]
+
+    def invalidate(self, _tags):
+        """
+            Drop all entries tagged with any of _tags
+        :param _tags:
+        :return: number of entries dropped
+        """
+        with self.lock:
+            keys = set()
+            for tag in _tags:
+                keys |= self.tags.get(tag, set())
+            for key in keys:
+                self._drop(key)
+            self.invalidations += len(keys)
+            self.generation += 1
+            return len(keys)
+
+    def orders(self):
+        """
+
+        :return: HEALPix orders pixel tags are at
+        """
+        with self.lock:
+            return set(_t[1] for _t in self.tags if _t[0] == 'pixel')
+
+    def clear(self):
+        with self.lock:
+            n = len(self.entries)
+            self.entries.clear()
+            self.tags.clear()
+            self.invalidations += n
+            self.generation += 1
+            return n
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations}
+
+
+class QueryService(object):
+    """
+        Cone searches, alerts by objectId, and light curves over one pooled db connection, with results cached.
+
+        Cached entries are dropped when alerts for their objectId or in their patch of sky are ingested
+        through a fetcher the service listens to (see from_fetcher), or after the ttl,
+        which is what bounds staleness when alerts come in through another process.
+        Results are shared between callers: treat them as read-only
+    """
+    def __init__(self, _db, _config, _cache_size=10000, _ttl=60.0):
+        """
+
+        :param _db: pymongo database, e.g. Fetcher.db['db']
+        :param _config: fetcher config
+        :param _cache_size: max number of cached results
+        :param _ttl: [s] max age of cached results, None for no limit
+        """
+        self.db = _db
+        self.alerts = _db[_config['database']['collection_alerts']]
+        self.cross_match = CrossMatch(self.alerts)
+        self.lightcurves = LightCurves(_db[_config['database']['collection_objects']])
+        self.cache = ResultCache(_max_size=_cache_size, _ttl=_ttl)
+
+    @classmethod
+    def from_fetcher(cls, _fetcher, **kwargs):
+        """
+            Query service on a fetcher's db connection, its cache invalidated by what the fetcher ingests
+
+        :param _fetcher: Fetcher instance
+        :param kwargs: see __init__
+        :return:
+        """
+        service = cls(_fetcher.db['db'], _fetcher.config, **kwargs)
+        _fetcher.add_listener(service.invalidate)
+        return service
+
+    @staticmethod
+    def make_key(*args):
+        # queries and projections are dicts
+        return json.dumps(args, sort_keys=True, default=str)
+
+    def get_alerts(self, object_id, projection=None):
+        """
+            All alerts of an object, as find({'objectId': object_id})
+
+        :param object_id:
+        :param projection:
+        :return: list of alerts sorted by candidate.jd
+        """
+        key = self.make_key('alerts', object_id, projection)
+        hit, alerts = self.cache.get(key)
+        if not hit:
+            generation = self.cache.generation
+            alerts = list(self.alerts.find({'objectId': object_id}, projection).sort([('candidate.jd', 1)]))
+            self.cache.put(key, alerts, [('object', object_id)], generation)
+        return alerts
+
+    def get_lightcurve(self, object_id):
+        """
+
+        :param object_id:
+        :return: light curve points sorted by jd, None if the object is not in db
+        """
+        key = self.make_key('lightcurve', object_id)
+        hit, lightcurve = self.cache.get(key)
+        if not hit:
+            generation = self.cache.generation
+            lightcurve = self.lightcurves.get(object_id)
+            self.cache.put(key, lightcurve, [('object', object_id)], generation)
+        return lightcurve
+
+    def cone_search(self, ra, dec, radius, unit='arcsec', query=None, projection=None):
+        """
+            Alerts within radius of a position, see CrossMatch.cone_search
+
+        :param ra: [deg]
+        :param dec: [deg]
+        :param radius:
+        :param unit: of radius: deg, rad, arcsec, or arcmin
+        :param query: additional filter on alerts
+        :param projection: fields to return
+        :return: list of alerts
+        """
+        key = self.make_key('cone', float(ra), float(dec), float(radius), unit, query, projection)
+        hit, alerts = self.cache.get(key)
+        if not hit:
+            generation = self.cache.generation
+            alerts = self.cross_match.cone_search(ra, dec, radius, unit=unit, query=query, projection=projection)
+            # the pixels cross_match looks in: an alert ingested anywhere else can't be in the cone
+            order = query_order(to_radians(float(radius), unit), self.cross_match.order)
+            center = ang2pix(ra, dec, order)
+            pixels = [int(center)] + [int(_p) for _p in neighbours(center, order)[0] if _p >= 0]
+            self.cache.put(key, alerts, [('pixel', order, _p) for _p in pixels], generation)
+        return alerts
+
+    def invalidate(self, _documents):
+        """
+            Drop cached results new alerts could change
+        :param _documents: ingested alerts, None to drop everything
+        :return: number of cached results dropped
+        """
+        if _documents is None:
+            return self.cache.clear()
+        if len(_documents) == 0:
+            return 0
+        tags = set(('object', doc['objectId']) for doc in _documents)
+
+        orders = self.cache.orders()
+        if len(orders) > 0:
+            healpix = np.array([doc['coordinates']['healpix'] if 'healpix' in doc.get('coordinates', {})
+                                else ang2pix_scalar(doc['candidate']['ra'], doc['candidate']['dec'])
+                                for doc in _documents], dtype=np.int64)
+            for order in orders:
+                pixels = np.unique(healpix >> 2 * (self.cross_match.order - order))
+                tags.update(('pixel', order, int(_p)) for _p in pixels)
+
+        return self.cache.invalidate(tags)
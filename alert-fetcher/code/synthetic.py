@@ -0,0 +1,305 @@
+import io
+import os
+import tarfile
+
+import fastavro
+import numpy as np
+
+
+def nullable(_type):
+    return ['null', _type]
+
+
+# photometry/astrometry fields common to candidate and prv_candidate
+_DETECTION_FIELDS = [
+    ('jd', 'double'), ('fid', 'int'), ('pid', 'long'), ('diffmaglim', nullable('float')),
+    ('pdiffimfilename', nullable('string')), ('programpi', nullable('string')), ('programid', 'int'),
+    ('candid', 'long'), ('isdiffpos', 'string'), ('tblid', nullable('long')), ('nid', nullable('int')),
+    ('rcid', nullable('int')), ('field', nullable('int')), ('xpos', nullable('float')), ('ypos', nullable('float')),
+    ('ra', 'double'), ('dec', 'double'), ('magpsf', 'float'), ('sigmapsf', 'float'), ('chipsf', nullable('float')),
+    ('magap', nullable('float')), ('sigmagap', nullable('float')), ('distnr', nullable('float')),
+    ('magnr', nullable('float')), ('sigmagnr', nullable('float')), ('chinr', nullable('float')),
+    ('sharpnr', nullable('float')), ('sky', nullable('float')), ('magdiff', nullable('float')),
+    ('fwhm', nullable('float')), ('classtar', nullable('float')), ('mindtoedge', nullable('float')),
+    ('magfromlim', nullable('float')), ('seeratio', nullable('float')), ('aimage', nullable('float')),
+    ('bimage', nullable('float')), ('aimagerat', nullable('float')), ('bimagerat', nullable('float')),
+    ('elong', nullable('float')), ('nneg', nullable('int')), ('nbad', nullable('int')), ('rb', nullable('float')),
+    ('ssdistnr', nullable('float')), ('ssmagnr', nullable('float')), ('ssnamenr', nullable('string')),
+    ('sumrat', nullable('float')), ('magapbig', nullable('float')), ('sigmagapbig', nullable('float')),
+    ('ranr', 'double'), ('decnr', 'double'),
+]
+
+# what only the triggering candidate has
+_CANDIDATE_FIELDS = [
+    ('sgmag1', nullable('float')), ('srmag1', nullable('float')), ('simag1', nullable('float')),
+    ('szmag1', nullable('float')), ('sgscore1', nullable('float')), ('distpsnr1', nullable('float')),
+    ('ndethist', 'int'), ('ncovhist', 'int'), ('jdstarthist', nullable('double')), ('jdendhist', nullable('double')),
+    ('scorr', nullable('double')), ('tooflag', nullable('int')), ('objectidps1', nullable('long')),
+    ('objectidps2', nullable('long')), ('sgmag2', nullable('float')), ('srmag2', nullable('float')),
+    ('simag2', nullable('float')), ('szmag2', nullable('float')), ('sgscore2', nullable('float')),
+    ('distpsnr2', nullable('float')), ('objectidps3', nullable('long')), ('sgmag3', nullable('float')),
+    ('srmag3', nullable('float')), ('simag3', nullable('float')), ('szmag3', nullable('float')),
+    ('sgscore3', nullable('float')), ('distpsnr3', nullable('float')), ('nmtchps', 'int'), ('rfid', 'long'),
+    ('jdstartref', 'double'), ('jdendref', 'double'), ('nframesref', 'int'),
+]
+
+# in prv_candidates, upper limits come without a detection
+_PRV_REQUIRED = ('jd', 'fid', 'pid', 'programid')
+
+
+def _fields(_fields_types, _required=None):
+    fields = []
+    for name, _type in _fields_types:
+        if (_required is not None) and (name not in _required) and (not isinstance(_type, list)):
+            _type = nullable(_type)
+        field = {'name': name, 'type': _type}
+        if isinstance(_type, list):
+            field['default'] = None
+        fields.append(field)
+    return fields
+
+
+# ZTF alert packet schema, v3.0: what fastavro.reader(...).schema gives for a 2018 public alert
+ZTF_SCHEMA = {
+    'type': 'record', 'name': 'alert', 'namespace': 'ztf',
+    'doc': 'avro alert schema for ZTF (www.ztf.caltech.edu)',
+    'version': '3.0',
+    'fields': [
+        {'name': 'schemavsn', 'type': 'string'},
+        {'name': 'publisher', 'type': 'string'},
+        {'name': 'objectId', 'type': 'string'},
+        {'name': 'candid', 'type': 'long'},
+        {'name': 'candidate',
+         'type': {'type': 'record', 'name': 'candidate', 'namespace': 'ztf.alert',
+                  'fields': _fields(_DETECTION_FIELDS + _CANDIDATE_FIELDS)}},
+        {'name': 'prv_candidates', 'default': None,
+         'type': ['null', {'type': 'array',
+                           'items': {'type': 'record', 'name': 'prv_candidate', 'namespace': 'ztf.alert',
+                                     'fields': _fields(_DETECTION_FIELDS, _PRV_REQUIRED)}}]},
+        {'name': 'cutoutScience', 'default': None,
+         'type': ['null', {'type': 'record', 'name': 'cutout', 'namespace': 'ztf.alert',
+                           'fields': [{'name': 'fileName', 'type': 'string'},
+                                      {'name': 'stampData', 'type': 'bytes'}]}]},
+        {'name': 'cutoutTemplate', 'type': ['null', 'ztf.alert.cutout'], 'default': None},
+        {'name': 'cutoutDifference', 'type': ['null', 'ztf.alert.cutout'], 'default': None},
+    ]
+}
+
+
+class AlertGenerator(object):
+    """
+        Make schema-valid synthetic ZTF alert packets.
+
+        Fields the fetcher and typical queries care about (positions, times, photometry, ids, rb, field)
+        get realistic values, everything else gets a random value of its declared type,
+        so any ZTF schema version works, e.g. one read from a real packet with fastavro.reader(f).schema
+    """
+    def __init__(self, _schema=None, _prv_candidates=(0, 30), _upper_limits=0.4, _cutout_size=12000,
+                 _n_objects=None, _seed=42):
+        """
+
+        :param _schema: alert packet schema, ZTF_SCHEMA by default
+        :param _prv_candidates: (min, max) number of prv_candidates per alert, uniformly distributed
+        :param _upper_limits: fraction of prv_candidates that are non-detections
+        :param _cutout_size: [bytes] stampData size of each of the three cutouts, 0 for no cutouts
+        :param _n_objects: number of distinct objectId's to draw from, every alert is a new object if None
+        :param _seed:
+        """
+        self.schema = _schema if _schema is not None else ZTF_SCHEMA
+        self.parsed_schema = fastavro.parse_schema(self.schema)
+        self.prv_candidates = _prv_candidates
+        self.upper_limits = _upper_limits
+        self.cutout_size = _cutout_size
+        self.n_objects = _n_objects
+        self.rs = np.random.RandomState(_seed)
+
+        # named types, to resolve references like 'ztf.alert.cutout'
+        self.named = dict()
+        self.register(self.schema)
+
+        self.n_alerts = 0
+
+    def register(self, _schema, _namespace=''):
+        if isinstance(_schema, list):
+            for _s in _schema:
+                self.register(_s, _namespace)
+        elif isinstance(_schema, dict):
+            namespace = _schema.get('namespace', _namespace)
+            if _schema.get('type') in ('record', 'enum', 'fixed'):
+                name = _schema['name'] if '.' in _schema['name'] else \
+                    '.'.join(_n for _n in (namespace, _schema['name']) if _n)
+                self.named[name] = _schema
+                self.named[name.split('.')[-1]] = _schema
+            for field in _schema.get('fields', []):
+                self.register(field['type'], namespace)
+            for key in ('items', 'values'):
+                if key in _schema:
+                    self.register(_schema[key], namespace)
+
+    def value(self, _type, _name=None, _context=None, _upper_limit=False):
+        """
+            Random value of an avro type, realistic for known ZTF fields
+
+        :param _type: avro type
+        :param _name: field name
+        :param _context: values to use for known fields
+        :param _upper_limit: generating a non-detection?
+        :return:
+        """
+        rs = self.rs
+
+        if (_context is not None) and (_name in _context):
+            return _context[_name]
+
+        if isinstance(_type, list):
+            # unions: non-detections have their optional fields empty
+            if ('null' in _type) and _upper_limit:
+                return None
+            non_null = [_t for _t in _type if _t != 'null']
+            return self.value(non_null[0], _name, _context, _upper_limit) if non_null else None
+
+        if isinstance(_type, str) and (_type in self.named):
+            _type = self.named[_type]
+
+        if isinstance(_type, dict):
+            kind = _type['type']
+            if kind == 'record':
+                if _type['name'].endswith('cutout'):
+                    return self.cutout(_name, _context)
+                return {field['name']: self.value(field['type'], field['name'], _context, _upper_limit)
+                        for field in _type['fields']}
+            elif kind == 'array':
+                return [self.value(_type['items'], _name, _context) for _ in range(int(rs.randint(0, 5)))]
+            elif kind == 'map':
+                return {f'k{i}': self.value(_type['values'], _name, _context) for i in range(int(rs.randint(0, 5)))}
+            elif kind == 'enum':
+                return _type['symbols'][int(rs.randint(len(_type['symbols'])))]
+            elif kind == 'fixed':
+                return os.urandom(_type['size'])
+            else:
+                # e.g. {'type': 'long', 'logicalType': ...}
+                return self.value(kind, _name, _context, _upper_limit)
+
+        if _type == 'null':
+            return None
+        elif _type == 'boolean':
+            return bool(rs.randint(2))
+        elif _type in ('int', 'long'):
+            return int(rs.randint(0, 1000))
+        elif _type in ('float', 'double'):
+            return float(rs.uniform(-1, 1))
+        elif _type == 'string':
+            return f'{_name}_{int(rs.randint(1000))}'
+        elif _type == 'bytes':
+            return os.urandom(16)
+        else:
+            raise ValueError(f'Unknown avro type: {_type}')
+
+    def cutout(self, _name, _context):
+        """
+            Random bytes standing in for a gzipped FITS stamp: those do not compress any further either
+        """
+        if self.cutout_size == 0:
+            return None
+        kind = {'cutoutScience': 'scimref', 'cutoutTemplate': 'ref', 'cutoutDifference': 'diff'}.get(_name, 'sci')
+        return {'fileName': f"candid{_context['candid']}_pid{_context['pid']}_targ_{kind}.fits.gz",
+                'stampData': os.urandom(self.cutout_size)}
+
+    def detection(self, _jd, _ra, _dec, _candid, _upper_limit=False):
+        """
+            Realistic values for a (prv_)candidate
+        """
+        rs = self.rs
+        fid = int(rs.randint(1, 3))
+        maglim = float(rs.uniform(19.0, 21.0))
+        context = {'jd': _jd, 'fid': fid, 'pid': int(_candid // 1000), 'programid': 1, 'diffmaglim': maglim}
+        if _upper_limit:
+            return context
+
+        magpsf = float(rs.uniform(14.0, maglim))
+        context.update({
+            'candid': _candid, 'isdiffpos': 't' if rs.uniform() < 0.8 else 'f',
+            'ra': float(_ra + rs.normal(0.0, 1e-5)), 'dec': float(_dec + rs.normal(0.0, 1e-5)),
+            'ranr': float(_ra), 'decnr': float(_dec),
+            'magpsf': magpsf, 'sigmapsf': float(rs.uniform(0.01, 0.3)),
+            'rb': float(rs.uniform()), 'fwhm': float(rs.uniform(1.0, 5.0)),
+            'field': int(rs.randint(245, 880)), 'rcid': int(rs.randint(0, 64)),
+            'xpos': float(rs.uniform(0, 3072)), 'ypos': float(rs.uniform(0, 3080)),
+            'ssnamenr': 'null', 'ssdistnr': -999.0, 'ssmagnr': -999.0,
+        })
+        return context
+
+    def alert(self):
+        """
+            Next synthetic alert
+        :return: dict that validates against self.schema
+        """
+        rs = self.rs
+        i = self.n_alerts
+        self.n_alerts += 1
+
+        n_object = i if self.n_objects is None else int(rs.randint(self.n_objects))
+        ors = np.random.RandomState(n_object)
+        # objects stay put from one alert to another
+        ra = float(ors.uniform(0.0, 360.0))
+        dec = float(np.degrees(np.arcsin(ors.uniform(-1.0, 1.0))))
+
+        jd = float(2458312.5 + rs.uniform(0.1, 0.5))
+        candid = 558359715915010000 + i
+
+        candidate = self.detection(jd, ra, dec, candid)
+
+        n_prv = int(rs.randint(self.prv_candidates[0], self.prv_candidates[1] + 1))
+        prv_candidates = []
+        for k, prv_jd in enumerate(sorted(jd - rs.uniform(0.5, 120.0, n_prv))):
+            upper_limit = bool(rs.uniform() < self.upper_limits)
+            prv_context = self.detection(prv_jd, ra, dec, candid - 10 ** 9 * (k + 1), _upper_limit=upper_limit)
+            prv_candidates.append(self.value(self.named['prv_candidate'], _context=prv_context,
+                                             _upper_limit=upper_limit))
+
+        candidate.update({'ndethist': n_prv + 1, 'ncovhist': n_prv + 1,
+                          'jdstarthist': prv_candidates[0]['jd'] if n_prv > 0 else jd, 'jdendhist': jd})
+
+        context = dict(candidate)
+        context.update({'schemavsn': self.schema.get('version', '3.0'), 'publisher': 'ZTF (www.ztf.caltech.edu)',
+                        'objectId': f'ZTF18{n_object:07d}', 'candid': candid,
+                        'prv_candidates': prv_candidates if n_prv > 0 else None})
+        alert = {field['name']: self.value(field['type'], field['name'], context)
+                 for field in self.schema['fields'] if field['name'] != 'candidate'}
+        alert['candidate'] = self.value(self.named['candidate'], _context=candidate)
+
+        return alert
+
+    def packet(self, _n_alerts=1):
+        """
+            Avro packet with _n_alerts alerts
+
+        :return: bytes
+        """
+        b = io.BytesIO()
+        fastavro.writer(b, self.parsed_schema, [self.alert() for _ in range(_n_alerts)])
+        return b.getvalue()
+
+    def night(self, _n_packets, _alerts_per_packet=1):
+        """
+            Packets of a synthetic night
+
+        :return: generator of (member name, packet bytes)
+        """
+        for _ in range(_n_packets):
+            data = self.packet(_alerts_per_packet)
+            yield f'{558359715915010000 + self.n_alerts - 1}.avro', data
+
+    def tarball(self, _path, _n_packets, _alerts_per_packet=1):
+        """
+            Write a synthetic night the way the archive serves it
+
+        :param _path: path to .tar.gz
+        :return: _path
+        """
+        with tarfile.open(_path, 'w:gz') as tar:
+            for name, data in self.night(_n_packets, _alerts_per_packet):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return _path
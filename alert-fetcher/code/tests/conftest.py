@@ -0,0 +1,53 @@
+import copy
+import json
+import os
+import sys
+
+import pytest
+
+# modules in code/ are imported by name, as fetcher.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_config(tmp_path):
+    """
+        config.json with paths under tmp_path and sections updated from keyword arguments,
+        e.g. make_config(misc={'objects': False})
+    :return: factory returning the path to the config file
+    """
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json')) as f:
+        base = json.load(f)
+
+    def make(**_sections):
+        config = copy.deepcopy(base)
+        for key in ('path_app', 'path_logs', 'path_alerts', 'path_tmp', 'path_parquet', 'path_cutouts'):
+            config['path'][key] = str(tmp_path / key) + '/'
+            os.makedirs(config['path'][key], exist_ok=True)
+        for section, values in _sections.items():
+            config[section].update(values)
+        path = str(tmp_path / 'config.json')
+        with open(path, 'w') as f:
+            json.dump(config, f)
+        return path
+
+    return make
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """
+        mongomock client. Its bulk_write does not take the UpdateOne's of recent pymongo: those are applied one by one
+    """
+    mongomock = pytest.importorskip('mongomock')
+    import pymongo
+
+    def bulk_write(self, _requests, ordered=True, **_kwargs):
+        for request in _requests:
+            if isinstance(request, pymongo.UpdateOne):
+                self.update_one(request._filter, request._doc, upsert=request._upsert)
+            else:
+                self.insert_one(request._doc)
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', bulk_write)
+    return mongomock.MongoClient()
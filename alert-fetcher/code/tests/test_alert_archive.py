@@ -0,0 +1,133 @@
+import os
+
+import pytest
+
+from alert_archive import AlertArchive, ArchiveWriter, get_paths
+from avro_decoder import AvroDecoder
+from synthetic import AlertGenerator
+
+
+@pytest.fixture
+def night():
+    """
+        Avro packets of a night: {member: packet}, one of them without alerts
+    """
+    generator = AlertGenerator(_prv_candidates=(0, 2), _n_objects=5)
+    packets = {f'{i}.avro': generator.packet(_n_alerts=1 + i % 3) for i in range(8)}
+    packets['empty.avro'] = generator.packet(_n_alerts=0)
+    return packets
+
+
+def alerts(_packets):
+    """
+
+    :return: {candid: decoded alert}
+    """
+    decoder = AvroDecoder()
+    return {_a['candid']: _a for _p in _packets.values() for _a in decoder.decode(_p)}
+
+
+def check(_path, _packets, _complete=True):
+    archive = AlertArchive(_path)
+    try:
+        expected = alerts(_packets)
+        assert archive.complete == _complete
+        assert len(archive) == len(expected)
+        for candid, alert in expected.items():
+            assert archive.get(candid) == alert
+            for cutout in ('Science', 'Template', 'Difference'):
+                assert bytes(archive.cutout(candid, cutout)) == alert[f'cutout{cutout}']['stampData']
+            assert candid in archive.find(alert['objectId'])
+        # packets with alerts, each once
+        assert {_m: bytes(_p) for _m, _p in archive.packets()} == \
+            {_m: _p for _m, _p in _packets.items() if _m != 'empty.avro'}
+    finally:
+        archive.close()
+
+
+def test_write_and_read(tmp_path, night):
+    path = str(tmp_path / '20180713')
+    writer = ArchiveWriter(path)
+    for member, packet in night.items():
+        assert writer.append(packet, member)
+    assert not writer.append(night['0.avro'], '0.avro')
+    writer.close(_complete=True)
+    check(path, night)
+
+
+def crash(_writer, _cut=0):
+    """
+        Stop writing without writing out the index, losing the last _cut bytes of the segment
+    """
+    _writer.segment.flush()
+    _writer.segment.close()
+    if _cut > 0:
+        with open(_writer.path_segment, 'r+b') as f:
+            f.truncate(os.path.getsize(_writer.path_segment) - _cut)
+
+
+def test_recover_truncated_segment(tmp_path, night):
+    path = str(tmp_path / '20180713')
+    members = list(night)
+    # packet without alerts in the middle, one cut short at the end
+    members.remove('empty.avro')
+    members.insert(3, 'empty.avro')
+
+    writer = ArchiveWriter(path)
+    for member in members:
+        writer.append(night[member], member)
+    crash(writer, _cut=100)
+
+    writer = ArchiveWriter(path)
+    assert all(writer.has(_m) for _m in members[:-1])
+    assert not writer.has(members[-1])
+    # no frame is left cut short
+    assert writer.size == os.path.getsize(get_paths(path)[0])
+    for member in members:
+        assert writer.append(night[member], member) == (member == members[-1])
+    writer.close(_complete=True)
+    check(path, night)
+
+
+def test_recover_after_index_was_written(tmp_path, night):
+    path = str(tmp_path / '20180713')
+    members = ['empty.avro'] + [_m for _m in night if _m != 'empty.avro']
+
+    writer = ArchiveWriter(path)
+    for member in members[:4]:
+        writer.append(night[member], member)
+    writer.close()
+
+    writer = ArchiveWriter(path)
+    for member in members[4:]:
+        writer.append(night[member], member)
+    # the index only has the first packets
+    crash(writer)
+
+    writer = ArchiveWriter(path)
+    size = writer.size
+    # packets without alerts have no index rows, they are not appended again either
+    assert not any(writer.append(night[_m], _m) for _m in members)
+    assert writer.size == size
+    writer.close(_complete=True)
+    check(path, night)
+
+
+def test_last_copy_of_an_alert_wins(tmp_path, night):
+    path = str(tmp_path / '20180713')
+    writer = ArchiveWriter(path)
+    for member, packet in night.items():
+        writer.append(packet, member)
+    # the same alerts again, under another name
+    writer.append(night['2.avro'], 'again.avro')
+    crash(writer)
+
+    # rows rebuilt from the segment
+    ArchiveWriter(path).close()
+    archive = AlertArchive(path)
+    try:
+        assert len(archive) == len(alerts(night))
+        candids = [_a['candid'] for _a in AvroDecoder().decode(night['2.avro'])]
+        assert {archive.locate(_c)['member'] for _c in candids} == {b'again.avro'}
+    finally:
+        archive.close()
@@ -0,0 +1,113 @@
+import threading
+
+import manifest
+from async_ingest import InMemoryAsyncCollection
+from fetcher import FetcherArchiveAsync
+from lightcurves import LightCurves
+from synthetic import AlertGenerator
+
+
+OBS_DATE = '20180713'
+
+
+class Manifest(manifest.Manifest):
+    """
+        manifest.Manifest kept in memory
+    """
+    def __init__(self, _obs_date):
+        super(Manifest, self).__init__(None, _obs_date)
+        self.members = dict()
+        self.done = False
+
+    def committed(self):
+        return set(self.members)
+
+    def is_complete(self):
+        return self.done
+
+    def record(self, _members):
+        self.members.update(_members)
+
+    def complete(self):
+        self.done = True
+
+    def reset(self):
+        with self.lock:
+            self.pending = dict()
+            self.sizes = dict()
+        self.members = dict()
+        self.done = False
+
+
+class Client(object):
+    def server_info(self):
+        return {}
+
+
+class Objects(object):
+    """
+        lightcurves.LightCurves kept in memory
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {objectId: set of candids}
+        self.candids = dict()
+
+    def update(self, _documents):
+        with self.lock:
+            for object_id, obj in LightCurves.aggregate(_documents).items():
+                self.candids.setdefault(object_id, set()).update(obj['candids'])
+
+
+def make_fetcher(_make_config, _collection, _manifests, _objects, _skip_existing=False):
+    config = _make_config(misc={'workers': 1, 'batch_size': 20, 'batch_size_min': 10, 'adaptive_writes': False,
+                                'inserts_in_flight': 3, 'objects': True, 'skip_existing': _skip_existing,
+                                'stream': False, 'archive': False, 'parquet': False},
+                          database={'indexes': []})
+
+    def existing(_documents):
+        return [_doc for _doc in _documents if _doc['_id'] not in _collection.documents]
+
+    return FetcherArchiveAsync(config, _collection=_collection, _db={'client': Client(), 'db': dict()},
+                               _manifests=lambda _obs_date: _manifests.setdefault(_obs_date, Manifest(_obs_date)),
+                               _lightcurves=_objects, _existing=existing)
+
+
+def test_ingest(make_config):
+    collection = InMemoryAsyncCollection(_latency=0.05)
+    manifests, objects = dict(), Objects()
+    fetcher = make_fetcher(make_config, collection, manifests, objects)
+    generator = AlertGenerator(_prv_candidates=(0, 3), _n_objects=30)
+    generator.tarball(fetcher.get_file_name(OBS_DATE), 120)
+
+    fetcher.fetch(OBS_DATE)
+
+    assert len(collection.documents) == 120
+    assert collection.max_in_flight > 1
+    assert manifests[OBS_DATE].is_complete()
+    assert len(manifests[OBS_DATE].members) == 120 and manifests[OBS_DATE].pending == {}
+    assert sum(len(_c) for _c in objects.candids.values()) == 120
+    assert fetcher.batching['n_documents'] == 120
+
+
+def test_reingest_skips_existing(make_config):
+    collection = InMemoryAsyncCollection()
+    manifests, objects = dict(), Objects()
+    fetcher = make_fetcher(make_config, collection, manifests, objects, _skip_existing=True)
+    AlertGenerator(_prv_candidates=(0, 3)).tarball(fetcher.get_file_name(OBS_DATE), 50)
+    fetcher.fetch(OBS_DATE)
+
+    inserts = []
+    insert_many = collection.insert_many
+
+    async def counted(_documents, ordered=True):
+        inserts.append(len(_documents))
+        await insert_many(_documents, ordered=ordered)
+
+    collection.insert_many = counted
+    fetcher.fetch(OBS_DATE, _reingest=True)
+
+    # everything was in db already: nothing sent, all of it acknowledged
+    assert sum(inserts) == 0
+    assert len(collection.documents) == 50
+    assert manifests[OBS_DATE].is_complete() and len(manifests[OBS_DATE].members) == 50
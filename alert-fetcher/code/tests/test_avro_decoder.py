@@ -0,0 +1,48 @@
+import io
+
+import bson
+
+from avro_decoder import AvroDecoder, Projection, bson_overhead
+from fetcher import Fetcher
+from synthetic import AlertGenerator, ZTF_SCHEMA
+
+
+def test_size_bounds():
+    generator = AlertGenerator(_prv_candidates=(0, 30))
+    decoder = AvroDecoder()
+    for _ in range(50):
+        sizes = []
+        records = decoder.records(io.BytesIO(generator.packet(3)), _sizes=sizes)
+        assert len(sizes) == len(records) == 3
+        for record, bound in zip(records, sizes):
+            exact = len(bson.BSON.encode(record))
+            assert exact <= bound <= 1.1 * exact
+
+
+def test_size_bounds_with_projection():
+    generator = AlertGenerator(_prv_candidates=(0, 5))
+    decoder = AvroDecoder(Projection(_exclude=['cutoutScience', 'cutoutTemplate', 'prv_candidates']))
+    sizes = []
+    documents = Fetcher.alerts_mongify(decoder.records(io.BytesIO(generator.packet(5)), _sizes=sizes))
+    # pruned fields only loosen the bound
+    for doc, bound in zip(documents, sizes):
+        assert len(bson.BSON.encode(doc)) <= bound
+
+
+def test_overhead_is_compiled_once():
+    overhead = bson_overhead(ZTF_SCHEMA)
+    # only prv_candidates vary in size
+    assert callable(overhead)
+    assert bson_overhead({'type': 'record', 'name': 'r', 'fields': [{'name': 'a', 'type': 'float'}]}) == 5 + 3 + 4
+    assert bson_overhead({'type': 'map', 'values': {'type': 'map', 'values': 'int'}}) is not None
+
+
+def test_projection():
+    packet = AlertGenerator(_prv_candidates=(1, 5)).packet(3)
+    full = AvroDecoder().decode(packet)
+    projected = AvroDecoder(Projection(_include=['objectId', 'candid', 'candidate.magpsf', 'prv_candidates.jd'],
+                                       _exclude=['cutoutScience'])).decode(packet)
+    for record, kept in zip(full, projected):
+        assert sorted(kept) == ['candid', 'candidate', 'objectId', 'prv_candidates']
+        assert kept['candidate'] == {'magpsf': record['candidate']['magpsf']}
+        assert kept['prv_candidates'] == [{'jd': _p['jd']} for _p in record['prv_candidates']]
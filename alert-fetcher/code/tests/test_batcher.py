@@ -0,0 +1,181 @@
+import time
+
+import bson
+import pytest
+
+from batcher import Batcher
+
+
+def documents(_n, _size=100, _start=0):
+    return [{'_id': _start + i, 'data': b'x' * _size} for i in range(_n)]
+
+
+def size(_doc):
+    return len(bson.BSON.encode(_doc))
+
+
+class Sink(object):
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, _documents, _sources, _n_bytes):
+        self.batches.append((_documents, _sources, _n_bytes))
+
+
+def test_count():
+    sink = Sink()
+    batcher = Batcher(sink, _max_documents=3)
+    batcher.add(documents(7), list('abcdefg'))
+    assert [len(_d) for _d, _, _ in sink.batches] == [3, 3]
+    assert sink.batches[1][1] == list('def')
+    batcher.close()
+    assert [len(_d) for _d, _, _ in sink.batches] == [3, 3, 1]
+    assert batcher.metrics()['flushes'] == {'count': 2, 'bytes': 0, 'age': 0, 'final': 1}
+    assert [_doc['_id'] for _d, _, _ in sink.batches for _doc in _d] == list(range(7))
+
+
+def test_count_follows_callable():
+    sink = Sink()
+    limit = {'n': 2}
+    batcher = Batcher(sink, _max_documents=lambda: limit['n'])
+    batcher.add(documents(4))
+    limit['n'] = 5
+    batcher.add(documents(5, _start=4))
+    assert [len(_d) for _d, _, _ in sink.batches] == [2, 2, 5]
+
+
+def test_bytes():
+    sink = Sink()
+    docs = documents(10)
+    max_bytes = 3 * size(docs[0]) + 10
+    batcher = Batcher(sink, _max_documents=100, _max_bytes=max_bytes)
+    batcher.add(docs)
+    batcher.close()
+    assert [len(_d) for _d, _, _ in sink.batches] == [3, 3, 3, 1]
+    for _documents, _, n_bytes in sink.batches:
+        assert n_bytes == sum(size(_doc) for _doc in _documents) <= max_bytes
+    assert batcher.metrics()['flushes']['bytes'] == 3
+
+
+def test_single_oversize_document():
+    sink = Sink()
+    small, large = documents(1, 10)[0], documents(1, 10000, _start=1)[0]
+    batcher = Batcher(sink, _max_documents=100, _max_bytes=1000)
+    batcher.add([small, large, dict(small, _id=2)])
+    batcher.close()
+    # goes in a batch of its own
+    assert [[_doc['_id'] for _doc in _d] for _d, _, _ in sink.batches] == [[0], [1], [2]]
+    assert sink.batches[1][2] == size(large)
+    assert batcher.max_batch_bytes == size(large)
+
+
+def test_age():
+    sink = Sink()
+    batcher = Batcher(sink, _max_documents=100, _max_age=0.05)
+    batcher.add(documents(2))
+    assert len(sink.batches) == 0
+    time.sleep(0.1)
+    batcher.add(documents(1, _start=2))
+    assert [len(_d) for _d, _, _ in sink.batches] == [3]
+    assert batcher.metrics()['flushes']['age'] == 1
+
+
+def test_flush_if_stale():
+    sink = Sink()
+    batcher = Batcher(sink, _max_documents=100, _max_age=0.05)
+    batcher.add(documents(2))
+    assert not batcher.flush_if_stale()
+    time.sleep(0.1)
+    # nothing else added: the deadline still holds
+    assert batcher.flush_if_stale()
+    assert [len(_d) for _d, _, _ in sink.batches] == [2]
+    assert not batcher.flush_if_stale()
+
+
+def test_timer_flushes_while_nothing_comes_in():
+    sink = Sink()
+    batcher = Batcher(sink, _max_documents=100, _max_age=0.05)
+    batcher.start_timer()
+    batcher.add(documents(2))
+    deadline = time.time() + 2
+    while (len(sink.batches) == 0) and (time.time() < deadline):
+        time.sleep(0.01)
+    assert [len(_d) for _d, _, _ in sink.batches] == [2]
+    assert batcher.metrics()['flushes']['age'] == 1
+
+    batcher.add(documents(1, _start=2))
+    batcher.close()
+    assert not batcher.timer
+    assert [len(_d) for _d, _, _ in sink.batches] == [2, 1]
+    assert batcher.metrics()['flushes']['final'] == 1
+
+
+def test_sizes_passed_in_are_not_measured(monkeypatch):
+    sink = Sink()
+    batcher = Batcher(sink, _max_documents=100, _max_bytes=1000, _slack=10)
+
+    def encode(*_args, **_kwargs):
+        raise AssertionError('sized again')
+
+    docs = documents(5)
+    monkeypatch.setattr(bson.BSON, 'encode', encode)
+    batcher.add(docs, _sizes=[290] * 5)
+    batcher.close()
+    # 300 bytes each with slack
+    assert [(len(_d), n_bytes) for _d, _, n_bytes in sink.batches] == [(3, 900), (2, 600)]
+
+
+def test_unknown_sizes_are_measured():
+    sink = Sink()
+    batcher = Batcher(sink, _slack=10)
+    docs = documents(2)
+    batcher.add(docs, _sizes=[None, 500])
+    batcher.close()
+    assert sink.batches[0][2] == size(docs[0]) + 510
+
+
+@pytest.mark.parametrize('n', [1, 50])
+def test_buffer_empty_after_close(n):
+    sink = Sink()
+    batcher = Batcher(sink, _max_documents=7)
+    batcher.add(documents(n))
+    batcher.close()
+    assert batcher.documents == [] and batcher.n_bytes == 0
+    assert sum(len(_d) for _d, _, _ in sink.batches) == n
+
+
+@pytest.mark.parametrize('batch_size, max_bytes, bound', [(20, 32 * 1024 * 1024, 'count'), (200, 400 * 1024, 'bytes')])
+def test_synthetic_night_stays_within_bounds(make_config, batch_size, max_bytes, bound):
+    from fetcher import FetcherArchive
+    from synthetic import AlertGenerator
+
+    config = make_config(misc={'objects': False, 'batch_size': batch_size, 'batch_size_min': batch_size,
+                               'batch_max_bytes': max_bytes, 'batch_max_age': None, 'adaptive_writes': False})
+    fetcher = FetcherArchive(config, _db={'client': None, 'db': {}})
+
+    batches = []
+
+    def insert_batch(_documents, _sources=None, _n_bytes=None):
+        batches.append((len(_documents), _n_bytes, sum(size(_doc) for _doc in _documents)))
+
+    # what FetcherArchive.fetch does for every packet of a night, with db left out
+    fetcher.insert_batch = insert_batch
+    fetcher.t_start = time.time()
+    fetcher.start_ingest()
+    buffered = {'documents': 0, 'bytes': 0}
+    for member, packet in AlertGenerator(_prv_candidates=(0, 5)).night(60, _alerts_per_packet=5):
+        fetcher.ingest(packet, member)
+        buffered['documents'] = max(buffered['documents'], len(fetcher.batcher.documents))
+        buffered['bytes'] = max(buffered['bytes'], fetcher.batcher.n_bytes)
+    fetcher.finish_ingest()
+
+    assert sum(_n for _n, _, _ in batches) == fetcher.n_alerts == 300
+    assert fetcher.batching['flushes'][bound] > 0
+    # the memory ceiling: never more than a batch buffered, whatever the length of the night
+    assert buffered['documents'] < batch_size
+    assert buffered['bytes'] <= max_bytes
+    for n_documents, n_bytes, n_bytes_actual in batches:
+        assert n_documents <= batch_size
+        assert n_bytes <= max_bytes
+        # sizes from the decode bound what pymongo will actually encode
+        assert n_bytes_actual <= n_bytes
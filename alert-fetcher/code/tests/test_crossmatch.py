@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+from crossmatch import HEALPIX_ORDER, CrossMatch, ang2pix, ang2pix_scalar, neighbours, pixel_size, query_order, \
+    to_radians
+from fetcher import Fetcher
+from synthetic import AlertGenerator
+
+
+@pytest.mark.parametrize('order', [3, 10, 16, 29])
+def test_ang2pix_scalar(order):
+    rs = np.random.RandomState(order)
+    ra = np.concatenate([rs.uniform(-10, 370, 20000), np.repeat([0.0, 45.0, 90.0, 180.0, 359.9999999999], 5)])
+    dec = np.concatenate([np.degrees(np.arcsin(rs.uniform(-1, 1, 20000))),
+                          np.tile([0.0, 90.0, -90.0, 41.8103148957786, -41.8103148957786], 5)])
+    assert ang2pix(ra, dec, order).tolist() == [ang2pix_scalar(_r, _d, order)
+                                                for _r, _d in zip(ra.tolist(), dec.tolist())]
+
+
+def test_mongify_healpix_matches_batch():
+    generator = AlertGenerator()
+    alerts = [generator.alert() for _ in range(200)]
+    one_by_one = [Fetcher.alert_mongify(_a)['coordinates'] for _a in alerts]
+    batch = [_d['coordinates'] for _d in Fetcher.alerts_mongify(alerts)]
+    assert [_c['healpix'] for _c in one_by_one] == [_c['healpix'] for _c in batch]
+    assert all(isinstance(_c['healpix'], int) for _c in one_by_one)
+
+
+def offset(ra, dec, distance, bearing):
+    """
+        [deg] positions distance [rad] away from (ra, dec) [deg] towards bearing [rad]
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    dec2 = np.arcsin(np.sin(dec) * np.cos(distance) + np.cos(dec) * np.sin(distance) * np.cos(bearing))
+    ra2 = ra + np.arctan2(np.sin(bearing) * np.sin(distance) * np.cos(dec),
+                          np.cos(distance) - np.sin(dec) * np.sin(dec2))
+    return np.mod(np.degrees(ra2), 360.0), np.degrees(dec2)
+
+
+def separation(ra1, dec1, ra2, dec2):
+    """
+        [rad] haversine angular distance between positions in [deg]
+    """
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    return 2 * np.arcsin(np.sqrt(np.sin((dec2 - dec1) / 2) ** 2 +
+                                 np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2))
+
+
+def positions(_rs, _n):
+    """
+        Random positions plus some on face edges and corners, the equator, the poles and ra = 0:
+        pixel edges at every order
+    """
+    ra = np.concatenate([_rs.uniform(0, 360, _n), np.tile(np.arange(0, 360, 45.0), 5), [0.0, 180.0, 0.0, 180.0]])
+    dec = np.concatenate([np.degrees(np.arcsin(_rs.uniform(-1, 1, _n))),
+                          np.repeat([41.8103148957786, -41.8103148957786, 0.0, 89.9999, -89.9999], 8),
+                          [90.0, 90.0, -90.0, -90.0]])
+    return ra, dec
+
+
+@pytest.mark.parametrize('order', [1, 4, 10, 16])
+def test_disc_is_covered_by_pixel_and_neighbours(order):
+    """
+        What cross_match relies on: anything within query_order's radius of a position is in its pixel or
+        one of the 8 around it
+    """
+    rs = np.random.RandomState(order)
+    ra, dec = positions(rs, 2000)
+    center = ang2pix(ra, dec, order)
+    around = np.concatenate([center[:, None], neighbours(center, order)], axis=1)
+    radius = pixel_size(order) / 4
+    for _ in range(10):
+        _ra, _dec = offset(ra, dec, radius * rs.uniform(0, 1, len(ra)), rs.uniform(0, 2 * np.pi, len(ra)))
+        pix = ang2pix(_ra, _dec, order)
+        assert np.all(np.any(around == pix[:, None], axis=1))
+
+
+@pytest.mark.parametrize('order', [1, 3, 8])
+def test_neighbours_are_mutual(order):
+    pixels = np.arange(12 * 4 ** order) if order < 8 else np.random.RandomState(0).randint(0, 12 * 4 ** order, 5000)
+    nb = neighbours(pixels, order)
+    # 8 distinct neighbours, 7 at the 24 face corners where only 3 faces meet
+    assert all(len(set(_n[_n >= 0])) == np.count_nonzero(_n >= 0) for _n in nb)
+    assert set(np.count_nonzero(nb >= 0, axis=1).tolist()) <= {7, 8}
+    back = neighbours(nb[nb >= 0], order)
+    assert np.all(np.any(back == np.repeat(pixels, np.count_nonzero(nb >= 0, axis=1))[:, None], axis=1))
+
+
+def test_query_order():
+    for radius in to_radians(np.array([0.1, 1.0, 5.0, 60.0, 3600.0, 36000.0]), 'arcsec'):
+        order = query_order(radius)
+        assert (order == 0) or (pixel_size(order) / 4 >= radius)
+        assert (order == HEALPIX_ORDER) or (pixel_size(order + 1) / 4 < radius)
+    assert query_order(1e-12) == HEALPIX_ORDER
+    assert query_order(1.0) == 0
+
+
+@pytest.mark.parametrize('radius, unit', [(5.0, 'arcsec'), (2.0, 'arcmin'), (1.5, 'deg')])
+def test_cross_match_against_brute_force(radius, unit):
+    mongomock = pytest.importorskip('mongomock')
+
+    rs = np.random.RandomState(int(radius * 10))
+    ra, dec = positions(rs, 60)
+    r = to_radians(radius, unit)
+    # alerts around the positions, both inside and outside the radius, and some anywhere
+    n = 4
+    alert_ra, alert_dec = offset(np.repeat(ra, n), np.repeat(dec, n), r * rs.uniform(0, 2, n * len(ra)),
+                                 rs.uniform(0, 2 * np.pi, n * len(ra)))
+    _ra, _dec = positions(rs, 200)
+    alert_ra, alert_dec = np.concatenate([alert_ra, _ra]), np.concatenate([alert_dec, _dec])
+
+    collection = mongomock.MongoClient()['ztf']['alerts']
+    collection.insert_many([{'_id': i, 'coordinates': {'radec': [np.radians(_r), np.radians(_d)],
+                                                       'healpix': ang2pix_scalar(_r, _d)}}
+                            for i, (_r, _d) in enumerate(zip(alert_ra.tolist(), alert_dec.tolist()))])
+
+    # per-position radii too: the query order follows the largest
+    radii = np.full(len(ra), radius)
+    radii[::3] /= 2
+    matches = CrossMatch(collection).cross_match(ra, dec, radii, unit=unit)
+
+    distance = separation(ra[:, None], dec[:, None], alert_ra[None, :], alert_dec[None, :])
+    expected = distance <= to_radians(radii, unit)[:, None]
+    # nothing right on the radius, where chord vs haversine rounding could go either way
+    ambiguous = np.abs(distance - to_radians(radii, unit)[:, None]) < 1e-12
+    assert np.count_nonzero(expected) > len(ra)
+    for i, found in enumerate(matches):
+        ids = [_doc['_id'] for _doc in found]
+        assert len(ids) == len(set(ids))
+        assert set(ids) ^ set(np.flatnonzero(expected[i]).tolist()) <= set(np.flatnonzero(ambiguous[i]).tolist())
+
+    one = CrossMatch(collection).cone_search(ra[0], dec[0], radius, unit=unit)
+    assert {_doc['_id'] for _doc in one} == set(np.flatnonzero(distance[0] <= r).tolist())
@@ -0,0 +1,39 @@
+import hashlib
+import os
+import threading
+
+from cutouts import FileCutoutStore
+
+
+def test_concurrent_writers_of_the_same_blob(tmp_path):
+    store = FileCutoutStore(str(tmp_path))
+    data = os.urandom(1 << 20)
+    key = hashlib.sha256(data).hexdigest()
+
+    start = threading.Barrier(8)
+    errors = []
+
+    def put():
+        start.wait()
+        try:
+            for _ in range(20):
+                store.put_many({key: data})
+                # next round writes it again
+                try:
+                    os.remove(store.get_path(key))
+                except FileNotFoundError:
+                    pass
+            store.put_many({key: data})
+        except Exception as _e:
+            errors.append(_e)
+
+    threads = [threading.Thread(target=put) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert store.get(key) == data
+    # no temp files left behind
+    assert os.listdir(os.path.dirname(store.get_path(key))) == [key]
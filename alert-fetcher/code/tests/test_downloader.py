@@ -0,0 +1,128 @@
+import http.server
+import os
+import re
+import threading
+import time
+
+import pytest
+import requests
+
+from downloader import Downloader
+
+
+DATA = os.urandom(256 * 1024)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+        Serves DATA at /data with Range support. What goes wrong is up to self.server:
+        statuses - status codes to answer the next GETs with; cut - bytes to send of each range before hanging up
+    """
+    def log_message(self, *_args):
+        pass
+
+    def do_HEAD(self):
+        if self.path != '/data':
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(DATA)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if len(self.server.statuses) > 0:
+            self.send_error(self.server.statuses.pop(0))
+            return
+        if self.path != '/data':
+            self.send_error(404)
+            return
+        start, end = (int(_b) for _b in re.match(r'bytes=(\d+)-(\d+)', self.headers['Range']).groups())
+        self.send_response(206)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(DATA)}')
+        self.end_headers()
+        chunk = DATA[start:end + 1]
+        if self.server.cut is not None:
+            chunk = chunk[:self.server.cut]
+        self.wfile.write(chunk)
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.requests = []
+    httpd.statuses = []
+    httpd.cut = None
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(_server, _path='/data'):
+    return f'http://127.0.0.1:{_server.server_address[1]}{_path}'
+
+
+def make_downloader(_retries=5, _backoff=0.01):
+    return Downloader(_segments=4, _retries=_retries, _backoff=_backoff, _timeout=5,
+                      _chunk_size=4096, _min_segment_size=64 * 1024)
+
+
+def test_download(server, tmp_path):
+    file_name = str(tmp_path / 'data.tar.gz')
+    make_downloader().download(url(server), file_name)
+    with open(file_name, 'rb') as f:
+        assert f.read() == DATA
+    assert len(server.requests) == 4
+    assert not os.path.exists(f'{file_name}.part')
+    assert not os.path.exists(f'{file_name}.part.json')
+
+
+def test_server_errors_are_retried(server, tmp_path):
+    file_name = str(tmp_path / 'data.tar.gz')
+    server.statuses = [503, 429]
+    make_downloader().download(url(server), file_name)
+    with open(file_name, 'rb') as f:
+        assert f.read() == DATA
+    assert len(server.requests) == 6
+
+
+def test_client_errors_are_not_retried(server, tmp_path):
+    file_name = str(tmp_path / 'data.tar.gz')
+    # would take minutes if retried
+    downloader = make_downloader(_retries=5, _backoff=60)
+    tic = time.time()
+    with pytest.raises(requests.HTTPError):
+        downloader.download(url(server, '/missing'), file_name)
+    server.statuses = [403]
+    with pytest.raises(requests.HTTPError):
+        downloader.download(url(server), file_name)
+    assert time.time() - tic < 5
+    # one request per segment, the refused one not repeated
+    assert len(server.requests) == 4
+    assert not os.path.exists(file_name)
+
+
+def test_resume(server, tmp_path):
+    file_name = str(tmp_path / 'data.tar.gz')
+    # connection drops 10000 bytes into every segment, no retries
+    server.cut = 10000
+    with pytest.raises(Exception):
+        make_downloader(_retries=1).download(url(server), file_name)
+    assert not os.path.exists(file_name)
+    assert os.path.getsize(f'{file_name}.part') == len(DATA)
+    assert os.path.exists(f'{file_name}.part.json')
+
+    # picks up every segment where it stopped
+    server.cut = None
+    server.requests = []
+    make_downloader().download(url(server), file_name)
+    with open(file_name, 'rb') as f:
+        assert f.read() == DATA
+    starts = sorted(int(re.match(r'bytes=(\d+)-', _range).group(1)) for _, _range in server.requests)
+    assert starts == [i * len(DATA) // 4 + 10000 for i in range(4)]
+    assert not os.path.exists(f'{file_name}.part')
+    assert not os.path.exists(f'{file_name}.part.json')
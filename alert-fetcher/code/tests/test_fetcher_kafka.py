@@ -0,0 +1,136 @@
+import threading
+import time
+
+import pymongo
+
+from fetcher import FetcherArchive, FetcherKafka
+from kafka_transport import InMemoryTransport
+from synthetic import AlertGenerator
+
+
+class Collection(object):
+    """
+        Just enough of a pymongo collection for FetcherKafka, failing inserts while self.down
+    """
+    def __init__(self, _down=False, _delay=0.0):
+        self.documents = []
+        self.down = _down
+        self.delay = _delay
+        self.n_attempts = 0
+
+    def with_options(self, **_kwargs):
+        return self
+
+    def insert_many(self, _documents, ordered=True):
+        self.n_attempts += 1
+        time.sleep(self.delay)
+        if self.down:
+            raise pymongo.errors.AutoReconnect('db is down')
+        self.documents.extend(_documents)
+
+    def find(self, _filter, _projection=None):
+        ids = set(_filter['_id']['$in'])
+        return [{'_id': doc['_id']} for doc in self.documents if doc['_id'] in ids]
+
+
+class Client(object):
+    def server_info(self):
+        return {}
+
+
+def make_db(_alerts):
+    return {'client': Client(), 'db': {'alerts': _alerts, 'dead_letter': Collection()}}
+
+
+def make_fetcher(_make_config, _transport, _db, _write_attempts=2, _queue_size=4):
+    config = _make_config(misc={'objects': False, 'write_retries': 0, 'batch_size': 50},
+                          kafka={'poll_timeout': 0.01, 'queue_size': _queue_size, 'write_attempts': _write_attempts})
+    return FetcherKafka(config, _transport=_transport, _db=_db)
+
+
+def produce(_transport, _n, _topic='ztf_test'):
+    generator = AlertGenerator(_prv_candidates=(0, 2))
+    for _ in range(_n):
+        _transport.produce(_topic, generator.packet())
+
+
+def test_ingest(make_config):
+    transport = InMemoryTransport()
+    produce(transport, 120)
+    db = make_db(Collection())
+    fetcher = make_fetcher(make_config, transport, db)
+    fetcher.fetch(_topics=['ztf_test'], _idle_timeout=0.2)
+
+    assert len(db['db']['alerts'].documents) == 120
+    assert len(db['db']['dead_letter'].documents) == 0
+    assert transport.lag() == 0
+
+
+def test_write_concern(make_config):
+    fetcher = make_fetcher(make_config, InMemoryTransport(), make_db(Collection()))
+    assert fetcher.write_concern == pymongo.WriteConcern(w='majority', j=True)
+    # archive fetch keeps db's default unless configured
+    archive = FetcherArchive(make_config(misc={'objects': False}), _db=make_db(Collection()))
+    assert archive.write_concern is None
+
+
+def test_failed_batches_go_to_dead_letter(make_config):
+    transport = InMemoryTransport()
+    produce(transport, 120)
+    db = make_db(Collection(_down=True))
+    fetcher = make_fetcher(make_config, transport, db, _write_attempts=2)
+    fetcher.fetch(_topics=['ztf_test'], _idle_timeout=0.2)
+
+    # every batch tried write_attempts times, then set aside and committed past
+    assert len(db['db']['dead_letter'].documents) == 120
+    assert transport.lag() == 0
+    assert db['db']['alerts'].n_attempts == 2 * db['db']['dead_letter'].n_attempts
+
+
+def test_undecodable_messages_go_to_dead_letter(make_config):
+    transport = InMemoryTransport()
+    produce(transport, 10)
+    transport.produce('ztf_test', b'not avro')
+    produce(transport, 10)
+    db = make_db(Collection())
+    fetcher = make_fetcher(make_config, transport, db)
+    fetcher.fetch(_topics=['ztf_test'], _idle_timeout=0.2)
+
+    assert len(db['db']['alerts'].documents) == 20
+    # kept as it came, with where it came from, before being committed past
+    [doc] = db['db']['dead_letter'].documents
+    assert (doc['_id'], doc['topic'], doc['partition'], doc['offset']) == ('ztf_test-0-10', 'ztf_test', 0, 10)
+    assert bytes(doc['value']) == b'not avro'
+    assert transport.lag() == 0
+
+
+class InterruptedTransport(InMemoryTransport):
+    """
+        ctrl-c after a number of polls
+    """
+    def __init__(self, _polls):
+        super(InterruptedTransport, self).__init__()
+        self.polls = _polls
+
+    def poll(self, max_messages, timeout):
+        self.polls -= 1
+        if self.polls < 0:
+            raise KeyboardInterrupt
+        return super(InterruptedTransport, self).poll(max_messages, timeout)
+
+
+def test_interrupt_with_writer_behind(make_config):
+    transport = InterruptedTransport(_polls=6)
+    produce(transport, 400)
+    # db that fails slowly and a writer that would keep trying for long: the queue fills up
+    db = make_db(Collection(_down=True, _delay=0.05))
+    fetcher = make_fetcher(make_config, transport, db, _write_attempts=1000, _queue_size=2)
+
+    done = threading.Event()
+    thread = threading.Thread(target=lambda: (fetcher.fetch(_topics=['ztf_test']), done.set()), daemon=True)
+    thread.start()
+    assert done.wait(10), 'fetcher did not stop'
+
+    # nothing was written, so nothing is committed: it is all consumed again next time
+    assert transport.lag() == 400
+    assert len(db['db']['dead_letter'].documents) == 0
@@ -0,0 +1,64 @@
+import copy
+
+from fetcher import Fetcher
+from lightcurves import LightCurves
+from synthetic import AlertGenerator
+
+
+def make_documents(_n, _n_objects=3):
+    generator = AlertGenerator(_prv_candidates=(1, 4), _n_objects=_n_objects)
+    return Fetcher.alerts_mongify([generator.alert() for _ in range(_n)])
+
+
+def points(_lightcurves, _object_ids):
+    return {_o: _lightcurves.get(_o) for _o in _object_ids}
+
+
+def test_one_unordered_update_per_object(mongo):
+    collection = mongo['ztf']['objects']
+    calls = []
+    bulk_write = collection.bulk_write
+
+    def counted(_requests, ordered=True, **_kwargs):
+        calls.append((len(_requests), ordered))
+        return bulk_write(_requests, ordered=ordered, **_kwargs)
+
+    collection.bulk_write = counted
+    documents = make_documents(30)
+    LightCurves(collection).update(documents)
+    assert calls == [(len({_d['objectId'] for _d in documents}), False)]
+
+
+def test_reingest_does_not_duplicate_points(mongo):
+    lightcurves = LightCurves(mongo['ztf']['objects'])
+    documents = make_documents(30)
+    object_ids = {_d['objectId'] for _d in documents}
+    lightcurves.update(documents)
+    before = points(lightcurves, object_ids)
+
+    lightcurves.update(documents)
+    lightcurves.update(documents[::-1][:10])
+    assert points(lightcurves, object_ids) == before
+    for object_id, lightcurve in before.items():
+        keys = [tuple(_p.values()) for _p in lightcurve]
+        assert len(keys) == len(set(keys))
+        assert [_p['jd'] for _p in lightcurve] == sorted(_p['jd'] for _p in lightcurve)
+        doc = mongo['ztf']['objects'].find_one({'_id': object_id})
+        assert sorted(doc['candids']) == sorted(_d['candid'] for _d in documents if _d['objectId'] == object_id)
+
+
+def test_detection_seen_again_as_prv_candidate(mongo):
+    lightcurves = LightCurves(mongo['ztf']['objects'])
+    first, second = make_documents(2, _n_objects=1)
+    lightcurves.update([first])
+    n_points = len(lightcurves.get(first['objectId']))
+
+    # the next alert of the object carries the first one's detection in its history
+    second = copy.deepcopy(second)
+    second['prv_candidates'] = (second.get('prv_candidates') or []) + [dict(first['candidate'])]
+    lightcurves.update([second])
+    lightcurve = lightcurves.get(first['objectId'])
+    # its own candidate is new, the copied detection is not
+    assert len(lightcurve) == n_points + len(second['prv_candidates'])
+    assert [_p['candid'] for _p in lightcurve].count(first['candid']) == 1
+    assert [_p['jd'] for _p in lightcurve] == sorted(_p['jd'] for _p in lightcurve)
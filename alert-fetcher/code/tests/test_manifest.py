@@ -0,0 +1,111 @@
+import os
+
+import pymongo
+import pytest
+
+from fetcher import FetcherArchive
+from synthetic import AlertGenerator
+
+
+OBS_DATE = '20180713'
+
+
+class Fetcher(FetcherArchive):
+    """
+        FetcherArchive that remembers which avro packets it ingested
+    """
+    def __init__(self, _config_file, _db):
+        super(Fetcher, self).__init__(_config_file, _db=_db)
+        self.members = []
+
+    def ingest(self, _data, _member=None):
+        self.members.append(os.path.basename(_data) if _member is None else _member)
+        return super(Fetcher, self).ingest(_data, _member)
+
+
+@pytest.fixture
+def db(mongo):
+    return {'client': mongo, 'db': mongo['ztf']}
+
+
+def make_fetcher(_make_config, _db):
+    config = _make_config(misc={'workers': 1, 'batch_size': 10, 'batch_size_min': 10, 'adaptive_writes': False,
+                                'write_retries': 0, 'batch_max_age': None, 'objects': False, 'stream': False,
+                                'archive': False, 'parquet': False, 'skip_existing': False},
+                          database={'indexes': []})
+    return Fetcher(config, _db)
+
+
+def fail_after(_db, _n_batches):
+    """
+        Make db stop taking alerts after _n_batches insert_many's, as if it went away mid-night
+    """
+    alerts = _db['db']['alerts']
+    insert_many = alerts.insert_many
+    calls = {'n': 0}
+
+    def failing(_documents, *_args, **_kwargs):
+        calls['n'] += 1
+        if calls['n'] > _n_batches:
+            raise pymongo.errors.AutoReconnect('db went away')
+        return insert_many(_documents, *_args, **_kwargs)
+
+    alerts.insert_many = failing
+    return lambda: setattr(alerts, 'insert_many', insert_many)
+
+
+def test_resume_reingests_only_unacknowledged_members(make_config, db):
+    fetcher = make_fetcher(make_config, db)
+    AlertGenerator(_prv_candidates=(0, 2)).tarball(fetcher.get_file_name(OBS_DATE), 60)
+    manifest = fetcher.get_manifest(OBS_DATE)
+    alerts = db['db']['alerts']
+
+    restore = fail_after(db, 3)
+    assert fetcher.fetch(OBS_DATE)
+    committed = manifest.committed()
+    # 3 batches of 10 made it, the night is not done
+    assert len(committed) == 30
+    assert not manifest.is_complete()
+    in_db = {f'{_doc["candid"]}.avro' for _doc in alerts.find({}, {'candid': 1})}
+    assert committed == in_db
+    report = manifest.verify(alerts)
+    assert (report['complete'], report['n_alerts_manifest'], report['n_alerts_db'], report['ok']) == \
+        (False, 30, 30, True)
+
+    # restart with db back
+    restore()
+    fetcher = make_fetcher(make_config, db)
+    assert fetcher.fetch(OBS_DATE)
+    assert len(fetcher.members) == 30
+    assert set(fetcher.members).isdisjoint(committed)
+    assert manifest.is_complete()
+    assert manifest.verify(alerts) == {'obs_date': OBS_DATE, 'complete': True, 'n_members': 60,
+                                       'n_alerts_manifest': 60, 'n_alerts_db': 60, 'ok': True}
+
+    # complete nights are not fetched again
+    fetcher = make_fetcher(make_config, db)
+    fetcher.fetch(OBS_DATE)
+    assert fetcher.members == []
+
+
+def test_reingest(make_config, db):
+    fetcher = make_fetcher(make_config, db)
+    AlertGenerator(_prv_candidates=(0, 2)).tarball(fetcher.get_file_name(OBS_DATE), 40)
+    assert fetcher.fetch(OBS_DATE)
+
+    fetcher = make_fetcher(make_config, db)
+    assert fetcher.fetch(OBS_DATE, _reingest=True)
+    # everything again, duplicates count as acknowledged
+    assert len(fetcher.members) == 40
+    report = fetcher.verify(OBS_DATE)
+    assert (report['complete'], report['n_members'], report['n_alerts_db'], report['ok']) == (True, 40, 40, True)
+
+
+def test_verify_reports_missing_alerts(make_config, db):
+    fetcher = make_fetcher(make_config, db)
+    AlertGenerator(_prv_candidates=(0, 2)).tarball(fetcher.get_file_name(OBS_DATE), 20)
+    assert fetcher.fetch(OBS_DATE)
+
+    db['db']['alerts'].delete_one({})
+    report = fetcher.verify(OBS_DATE)
+    assert (report['n_alerts_manifest'], report['n_alerts_db'], report['ok']) == (20, 19, False)
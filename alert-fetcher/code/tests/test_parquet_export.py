@@ -0,0 +1,58 @@
+import pytest
+
+from parquet_export import ParquetExporter
+from synthetic import AlertGenerator, ZTF_SCHEMA
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+
+
+def make_alerts(_n, _seed, _nulls):
+    generator = AlertGenerator(_prv_candidates=(1, 3), _seed=_seed)
+    alerts = [generator.alert() for _ in range(_n)]
+    for alert in alerts:
+        # same field so that both parts land in the same partition
+        alert['candidate']['field'] = 600
+        if _nulls:
+            alert['candidate']['rb'] = None
+            alert['candidate']['ssnamenr'] = None
+            for prv_candidate in alert['prv_candidates']:
+                prv_candidate['magpsf'] = None
+        else:
+            alert['candidate']['rb'] = 0.7
+            alert['candidate']['ssnamenr'] = 'null'
+            for prv_candidate in alert['prv_candidates']:
+                prv_candidate['magpsf'] = 18.5
+    return alerts
+
+
+def test_parts_with_mismatched_nulls_read_back(tmp_path):
+    exporter = ParquetExporter(str(tmp_path), '20180713', _rows=5, _schema=ZTF_SCHEMA)
+    # a column all null in one part file and set in the next
+    exporter.add(make_alerts(5, 1, _nulls=True))
+    exporter.add(make_alerts(5, 2, _nulls=False))
+    exporter.close()
+    assert len(list((tmp_path / 'candidates' / 'obs_date=20180713' / 'field=600').iterdir())) == 2
+
+    candidates = pd.read_parquet(str(tmp_path / 'candidates'))
+    assert len(candidates) == 10
+    assert candidates['rb'].isna().sum() == 5
+    assert sorted(candidates['rb'].dropna().round(3).unique()) == [0.7]
+    assert candidates['ssnamenr'].isna().sum() == 5
+
+    prv_candidates = pd.read_parquet(str(tmp_path / 'prv_candidates'))
+    assert prv_candidates['magpsf'].notna().any() and prv_candidates['magpsf'].isna().any()
+    assert set(prv_candidates['alert_candid']) == set(candidates['candid'])
+
+
+def test_schema_follows_avro_types(tmp_path):
+    exporter = ParquetExporter(str(tmp_path), '20180713', _schema=ZTF_SCHEMA)
+    candidates = exporter.schemas['candidates']
+    assert 'field' not in candidates.names
+    assert str(candidates.field('objectId').type) == 'string'
+    assert str(candidates.field('candid').type) == 'int64'
+    assert str(candidates.field('rb').type) == 'float'
+    assert str(candidates.field('jd').type) == 'double'
+    prv_candidates = exporter.schemas['prv_candidates']
+    assert prv_candidates.names[:2] == ['objectId', 'alert_candid']
+    assert 'field' in prv_candidates.names
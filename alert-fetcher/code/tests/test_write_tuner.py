@@ -0,0 +1,187 @@
+import asyncio
+import threading
+import time
+
+import pymongo
+import pytest
+
+from write_tuner import WriteTuner
+
+
+class Collection(object):
+    """
+        Just enough of a pymongo collection: insert_many takes as long as told, or raises what it is told to
+    """
+    def __init__(self):
+        self.latency = 0.0
+        # exceptions to raise, one per call, before inserts go through again
+        self.errors = []
+        self.n_attempts = 0
+        self.n_inserted = 0
+        self.lock = threading.Lock()
+        self.n_in_flight = 0
+        self.max_in_flight = 0
+
+    def insert_many(self, _documents, ordered=True):
+        with self.lock:
+            self.n_attempts += 1
+            self.n_in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.n_in_flight)
+        try:
+            time.sleep(self.latency)
+            if len(self.errors) > 0:
+                raise self.errors.pop(0)
+            self.n_inserted += len(_documents)
+        finally:
+            with self.lock:
+                self.n_in_flight -= 1
+
+
+def make_tuner(**_kwargs):
+    kwargs = dict(_batch_size=100, _min_batch_size=50, _max_batch_size=300, _step=50, _target_seconds=0.05,
+                  _decrease=0.5, _retries=3, _retry_delay=0.001, _max_retry_delay=0.01)
+    kwargs.update(_kwargs)
+    return WriteTuner(**kwargs)
+
+
+def write(_tuner, _collection, _n_documents):
+    return _tuner.write(lambda: _collection.insert_many([{}] * _n_documents, ordered=False), _n_documents)
+
+
+def test_aimd_trajectory():
+    tuner = make_tuner()
+    tuner.set_max_in_flight(4)
+    collection = Collection()
+
+    trajectory = []
+    # (latency, batch filled up to the current batch size?)
+    for latency, full in [(0, True), (0, True), (0, False), (0.1, True), (0.1, True), (0.1, True),
+                          (0, True), (0, True), (0, True), (0, True), (0, True), (0, True)]:
+        collection.latency = latency
+        write(tuner, collection, tuner.batch_size if full else 10)
+        trajectory.append((tuner.batch_size, tuner.in_flight))
+
+    assert trajectory == [
+        # fast full batches: additive increase, in flight capped by what the pipeline has
+        (150, 4), (200, 4),
+        # a partial batch says nothing about a larger one
+        (200, 4),
+        # slow: multiplicative decrease, down to the minimums
+        (100, 2), (50, 1), (50, 1),
+        # and back up, batch size capped
+        (100, 2), (150, 3), (200, 4), (250, 4), (300, 4), (300, 4)]
+    stats = tuner.stats()
+    assert (stats['n_batches'], stats['n_congested'], stats['n_increases'], stats['n_decreases']) == (12, 3, 7, 2)
+
+
+def test_batches_sent_before_a_cut_do_not_cut_again():
+    tuner = make_tuner()
+    tuner.set_max_in_flight(4)
+    started = time.time()
+    tuner.observe(100, None, 0.1, True, started)
+    assert (tuner.batch_size, tuner.in_flight) == (50, 2)
+    # in flight at the same time as the one that caused the cut
+    tuner.observe(100, None, 0.1, True, started)
+    assert (tuner.batch_size, tuner.in_flight) == (50, 2)
+    # sent after it
+    tuner.observe(50, None, 0.1, False, time.time())
+    assert (tuner.batch_size, tuner.in_flight) == (50, 1)
+
+
+def test_not_adaptive():
+    tuner = make_tuner(_adaptive=False)
+    tuner.set_max_in_flight(3)
+    collection = Collection()
+    for latency in (0, 0, 0.1, 0):
+        collection.latency = latency
+        write(tuner, collection, 100)
+        assert (tuner.batch_size, tuner.in_flight) == (100, 3)
+    assert tuner.stats()['n_congested'] == 1
+
+
+@pytest.mark.parametrize('error', [pymongo.errors.AutoReconnect('primary stepped down'),
+                                   pymongo.errors.NotPrimaryError('not primary'),
+                                   pymongo.errors.ServerSelectionTimeoutError('no servers')])
+def test_transient_errors_are_retried(error):
+    tuner = make_tuner()
+    collection = Collection()
+    collection.errors = [error, error]
+    write(tuner, collection, 100)
+    assert (collection.n_attempts, collection.n_inserted) == (3, 100)
+    # failed attempts count as congestion
+    stats = tuner.stats()
+    assert (stats['n_retries'], stats['n_congested'], stats['n_decreases']) == (2, 2, 1)
+
+
+def test_retries_run_out():
+    tuner = make_tuner(_retries=2)
+    collection = Collection()
+    collection.errors = [pymongo.errors.AutoReconnect('db is down')] * 10
+    with pytest.raises(pymongo.errors.AutoReconnect):
+        write(tuner, collection, 100)
+    assert collection.n_attempts == 3
+    assert tuner.stats()['n_retries'] == 2
+
+
+@pytest.mark.parametrize('error', [pymongo.errors.OperationFailure('not authorized'),
+                                   pymongo.errors.DocumentTooLarge('too large'),
+                                   pymongo.errors.WriteConcernError('timeout'),
+                                   ValueError('not a document')])
+def test_other_errors_fail_fast(error):
+    tuner = make_tuner()
+    collection = Collection()
+    collection.errors = [error]
+    with pytest.raises(type(error)):
+        write(tuner, collection, 100)
+    assert collection.n_attempts == 1
+    assert tuner.stats()['n_retries'] == 0
+
+
+def test_bulk_write_errors():
+    tuner = make_tuner()
+    tuner.set_max_in_flight(2)
+    collection = Collection()
+    # duplicates: db took the batch
+    collection.errors = [pymongo.errors.BulkWriteError({'writeErrors': [{'code': 11000}], 'writeConcernErrors': []})]
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        write(tuner, collection, 100)
+    assert (collection.n_attempts, tuner.batch_size, tuner.stats()['n_congested']) == (1, 150, 0)
+
+    # db could not satisfy the write concern: congestion, not retried either
+    collection.errors = [pymongo.errors.BulkWriteError({'writeErrors': [], 'writeConcernErrors': [{'code': 64}]})]
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        write(tuner, collection, 150)
+    assert (collection.n_attempts, tuner.batch_size, tuner.stats()['n_congested']) == (2, 75, 1)
+
+
+def test_in_flight_limit():
+    tuner = make_tuner(_adaptive=False)
+    tuner.set_max_in_flight(2)
+    collection = Collection()
+    collection.latency = 0.02
+    threads = [threading.Thread(target=write, args=(tuner, collection, 100)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert collection.n_inserted == 800
+    assert collection.max_in_flight == 2
+
+
+def test_write_async():
+    tuner = make_tuner()
+    errors = [pymongo.errors.AutoReconnect('primary stepped down'), pymongo.errors.OperationFailure('no')]
+    attempts = []
+
+    async def insert():
+        attempts.append(time.time())
+        raise errors.pop(0)
+
+    async def run():
+        with pytest.raises(pymongo.errors.OperationFailure):
+            await tuner.write_async(insert, 100)
+
+    asyncio.run(run())
+    # retried the transient one, gave up on the other
+    assert len(attempts) == 2
+    assert tuner.stats()['n_retries'] == 1
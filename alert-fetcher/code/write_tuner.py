@@ -0,0 +1,270 @@
+import asyncio
+import contextlib
+import random
+import threading
+import time
+
+import pymongo
+
+
+# worth trying a batch again: db is unreachable or changing primaries for a moment.
+# ServerSelectionTimeoutError is an AutoReconnect, listed for clarity
+TRANSIENT_ERRORS = (pymongo.errors.AutoReconnect, pymongo.errors.ServerSelectionTimeoutError)
+
+
+class WriteTuner(object):
+    """
+        Size insert_many batches and the number of them in flight from how db copes, AIMD-style:
+        every full batch acknowledged within the target latency adds _step documents to the batch size
+        and one insert to those allowed in flight; a slow or failed batch cuts both by _decrease.
+        Batches started before the last cut do not cut again, they were sized and sent under the old settings.
+
+        Writes are retried with exponential backoff (and jitter) on transient errors, outside their in-flight slot.
+        Every change is logged with the batch that caused it, for auditing the tuning
+    """
+    def __init__(self, _batch_size=200, _min_batch_size=50, _max_batch_size=2000, _step=50,
+                 _target_seconds=1.0, _decrease=0.5, _retries=5, _retry_delay=0.5, _max_retry_delay=30.0,
+                 _adaptive=True, _log=None, _metrics=None):
+        """
+
+        :param _batch_size: to start with
+        :param _min_batch_size:
+        :param _max_batch_size:
+        :param _step: documents added to the batch size per full batch written in time
+        :param _target_seconds: [s] max insert latency of a batch before it counts as congestion
+        :param _decrease: batch size and inserts in flight are multiplied by it on congestion
+        :param _retries: max number of retries of a batch on transient errors
+        :param _retry_delay: [s] before the first retry, doubled for every next one
+        :param _max_retry_delay: [s]
+        :param _adaptive: tune? if not, batch size stays at _batch_size and in flight at its max
+        :param _log: callable(message) to log decisions with
+        :param _metrics: metrics.Metrics
+        """
+        self.min_batch_size = max(int(_min_batch_size), 1)
+        self.max_batch_size = max(int(_max_batch_size), self.min_batch_size)
+        self.batch_size = min(max(int(_batch_size), self.min_batch_size), self.max_batch_size)
+        self.step = max(int(_step), 1)
+        self.target_seconds = float(_target_seconds)
+        self.decrease = float(_decrease)
+        self.retries = int(_retries)
+        self.retry_delay = float(_retry_delay)
+        self.max_retry_delay = float(_max_retry_delay)
+        self.adaptive = _adaptive
+        self.log = _log
+        self.metrics = _metrics
+
+        # allowed in flight, up to what the pipeline can do, see set_max_in_flight
+        self.max_in_flight = 1
+        self.in_flight = 1
+        self.n_in_flight = 0
+        self.condition = threading.Condition()
+        # when the last cut was made
+        self.t_decrease = 0.0
+
+        # stats
+        self.n_batches = 0
+        self.n_documents = 0
+        self.n_bytes = 0
+        self.t_writes = 0.0
+        self.n_congested = 0
+        self.n_retries = 0
+        self.n_increases = 0
+        self.n_decreases = 0
+
+    def set_max_in_flight(self, _max_in_flight):
+        """
+            How many inserts the pipeline about to start can have in flight: writer threads or async slots.
+            Tuning state carries over, e.g. from one night of a backfill to the next
+
+        :param _max_in_flight:
+        :return:
+        """
+        with self.condition:
+            first = self.n_batches == 0
+            self.max_in_flight = max(int(_max_in_flight), 1)
+            self.in_flight = self.max_in_flight if (first or not self.adaptive) \
+                else min(self.in_flight, self.max_in_flight)
+            self.condition.notify_all()
+        self.gauges()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+            Wait until another insert may go in flight, for writer threads
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.n_in_flight < self.in_flight)
+            self.n_in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.n_in_flight -= 1
+                self.condition.notify()
+
+    def gauges(self):
+        if self.metrics is not None:
+            self.metrics.gauge('write_batch_size', 'max documents per insert_many batch, as tuned').set(
+                self.batch_size)
+            self.metrics.gauge('write_in_flight', 'max insert_many batches in flight, as tuned').set(self.in_flight)
+
+    def observe(self, _n_documents, _n_bytes, _seconds, _ok, _started=None):
+        """
+            Tune from how a batch went
+
+        :param _n_documents: in the batch
+        :param _n_bytes: its BSON size, None if not known
+        :param _seconds: [s] insert latency
+        :param _ok: acknowledged by db?
+        :param _started: time.time() when the insert was sent
+        :return:
+        """
+        if _started is None:
+            _started = time.time() - _seconds
+
+        with self.condition:
+            self.n_batches += 1
+            self.n_documents += _n_documents
+            self.n_bytes += _n_bytes or 0
+            self.t_writes += _seconds
+
+            congested = (not _ok) or (_seconds > self.target_seconds)
+            if congested:
+                self.n_congested += 1
+            if not self.adaptive:
+                return
+
+            batch_size, in_flight = self.batch_size, self.in_flight
+            if congested and (_started >= self.t_decrease):
+                # multiplicative decrease
+                self.batch_size = max(int(self.batch_size * self.decrease), self.min_batch_size)
+                self.in_flight = max(int(self.in_flight * self.decrease), 1)
+                self.t_decrease = time.time()
+                reason = 'failed' if not _ok else f'slower than {self.target_seconds:.2f} s'
+                increase = False
+            elif (not congested) and (_n_documents >= self.batch_size):
+                # additive increase, once per round of full batches: those sent before the last increase are smaller
+                self.batch_size = min(self.batch_size + self.step, self.max_batch_size)
+                self.in_flight = min(self.in_flight + 1, self.max_in_flight)
+                reason = 'full and in time'
+                increase = True
+            else:
+                return
+
+            new_batch_size, new_in_flight = self.batch_size, self.in_flight
+            if (batch_size, in_flight) == (new_batch_size, new_in_flight):
+                return
+            if increase:
+                self.n_increases += 1
+            else:
+                self.n_decreases += 1
+            self.condition.notify_all()
+
+        self.gauges()
+        if self.log is not None:
+            size = f', {_n_bytes / 1e6:.1f} MB' if _n_bytes is not None else ''
+            self.log(f'Write tuning: batch size {batch_size} -> {new_batch_size}, '
+                     f'in flight {in_flight} -> {new_in_flight}: batch of {_n_documents}{size} '
+                     f'{reason} ({_seconds:.3f} s)')
+
+    def attempted(self, _error, _attempt, _n_documents, _n_bytes, _started):
+        """
+            Bookkeeping after an insert attempt
+
+        :param _error: exception the attempt raised, None if it went through
+        :param _attempt: number of the attempt, from 0
+        :param _n_documents:
+        :param _n_bytes:
+        :param _started: time.time() when the attempt was sent
+        :return: [s] to wait before trying again, None if not to
+        """
+        seconds = time.time() - _started
+        if _error is None:
+            self.observe(_n_documents, _n_bytes, seconds, True, _started)
+            return None
+        if isinstance(_error, pymongo.errors.BulkWriteError):
+            # write errors are per document (e.g. duplicates), db did take the batch unless it could not
+            # satisfy the write concern
+            ok = len(_error.details.get('writeConcernErrors', [])) == 0
+            self.observe(_n_documents, _n_bytes, seconds, ok, _started)
+            return None
+        if not isinstance(_error, TRANSIENT_ERRORS):
+            return None
+
+        self.observe(_n_documents, _n_bytes, seconds, False, _started)
+        if _attempt >= self.retries:
+            return None
+        with self.condition:
+            self.n_retries += 1
+        if self.metrics is not None:
+            self.metrics.counter('write_retries_total', 'insert_many retries on transient errors').inc()
+        delay = min(self.retry_delay * 2 ** _attempt, self.max_retry_delay)
+        # jitter: writers that failed together do not come back together
+        delay *= random.uniform(0.5, 1.0)
+        if self.log is not None:
+            self.log(f'Write failed ({type(_error).__name__}: {_error}), '
+                     f'retry {_attempt + 1}/{self.retries} in {delay:.2f} s')
+        return delay
+
+    def write(self, _insert, _n_documents, _n_bytes=None):
+        """
+            Run an insert in an in-flight slot, retrying on transient errors
+
+        :param _insert: callable() doing the insert
+        :param _n_documents: in the batch
+        :param _n_bytes: its BSON size, if known
+        :return: what _insert returns. Raises what it raised last if it did not go through
+        """
+        attempt = 0
+        while True:
+            with self.slot():
+                started = time.time()
+                try:
+                    result = _insert()
+                    error = None
+                except Exception as _e:
+                    error = _e
+            delay = self.attempted(error, attempt, _n_documents, _n_bytes, started)
+            if error is None:
+                return result
+            if delay is None:
+                raise error
+            time.sleep(delay)
+            attempt += 1
+
+    async def write_async(self, _insert, _n_documents, _n_bytes=None):
+        """
+            Same as write, for coroutines. In-flight slots are up to the caller, see async_ingest.AsyncIngestPipeline
+
+        :param _insert: callable() returning the insert coroutine
+        :param _n_documents:
+        :param _n_bytes:
+        :return:
+        """
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                result = await _insert()
+                error = None
+            except Exception as _e:
+                error = _e
+            delay = self.attempted(error, attempt, _n_documents, _n_bytes, started)
+            if error is None:
+                return result
+            if delay is None:
+                raise error
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        """
+
+        :return: dict
+        """
+        with self.condition:
+            return {'batch_size': self.batch_size, 'in_flight': self.in_flight, 'max_in_flight': self.max_in_flight,
+                    'n_batches': self.n_batches, 'n_documents': self.n_documents, 'n_bytes': self.n_bytes,
+                    'n_congested': self.n_congested, 'n_retries': self.n_retries,
+                    'n_increases': self.n_increases, 'n_decreases': self.n_decreases,
+                    'mean_write_s': self.t_writes / self.n_batches if self.n_batches > 0 else 0.0}